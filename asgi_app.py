@@ -0,0 +1,829 @@
+"""
+YouTube Downloader API - نسخة ASGI (FastAPI + uvicorn)
+نفس نقاط النهاية ونفس الحالة المشتركة في index.py، لكن الاتصالات الطويلة
+(متابعة الحالة، إرسال الملفات، WebSocket) تنتظر على حلقة asyncio واحدة
+بدلاً من حجز خيط لكل اتصال
+
+التشغيل:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+
+المسارات غير المنقولة هنا (/, /api/download/playlist, /api/stream, /cmd)
+يخدمها تطبيق Flask نفسه عبر WSGIMiddleware
+"""
+
+import asyncio
+import json
+import mimetypes
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import urlencode
+
+import anyio
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.middleware.wsgi import WSGIMiddleware
+
+import index
+from index import (
+    DOWNLOAD_ENGINE,
+    FILE_CACHE_MAX_AGE,
+    FILE_SERVING_MODE,
+    INFO_BATCH_CONCURRENCY,
+    PLAYLIST_PAGE_LIMIT,
+    PLAYLIST_PAGE_MAX,
+    SSE_HEARTBEAT_INTERVAL,
+    STREAM_CHUNK_SIZE,
+    TAIL_FOLLOW_POLL,
+    TAIL_FOLLOW_TIMEOUT,
+    TERMINAL_STATES,
+    WS_MAX_UPDATE_RATE,
+    ProgressDeltas,
+    StatusSubscriber,
+    YtdlpOutput,
+    bandwidth,
+    build_ytdlp_command,
+    content_disposition_header,
+    download_error_fields,
+    download_options,
+    download_video_thread1,
+    downloads_status,
+    file_etag,
+    formats_payload,
+    fragment_tuner,
+    group_children_status,
+    health_payload,
+    iter_playlist_page,
+    info_batch_line,
+    janitor,
+    job_timelines,
+    metadata_cache,
+    metrics,
+    parse_download_batch,
+    parse_downloads_query,
+    parse_info_batch,
+    process_usage,
+    request_priority,
+    scheduler,
+    status_events,
+    status_with_queue_info,
+    submit_download,
+    submit_download_batch,
+    update_download_status,
+    video_info_payload,
+    ws_update_rate,
+    x_accel_location,
+)
+
+# خيوط الاستخراج (yt-dlp متزامن) - الحلقة نفسها لا تنتظر أي عملية حاجبة
+ASGI_EXTRACT_WORKERS = int(os.environ.get('ASGI_EXTRACT_WORKERS', 8))
+# أقصى طول لسطر من مخرجات yt-dlp (سطر التقدم JSON قد يكون طويلاً)
+YTDLP_LINE_LIMIT = 1024 * 1024
+
+extract_executor = ThreadPoolExecutor(ASGI_EXTRACT_WORKERS, thread_name_prefix='extract')
+
+
+class AsyncStatusWaiters:
+    """
+    جسر بين StatusEvents (خيوط) و asyncio: مشترك واحد لكل العملية
+    يوقظ كل من ينتظر تحميلاً معيناً على الحلقة بدلاً من خيط لكل متابع
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        # تُستخدم من خيط الحلقة فقط
+        self._events = {}
+        # مشتركو WebSocket: StatusSubscriber -> حدث يوقظ مرسل الدفعات
+        self._subscribers = {}
+
+    def mark(self, download_id):
+        # يُستدعى من أي خيط عند تغير الحالة
+        self.loop.call_soon_threadsafe(self._wake, download_id)
+
+    def _wake(self, download_id):
+        event = self._events.pop(download_id, None)
+        if event:
+            event.set()
+        for subscriber, wakeup in self._subscribers.items():
+            subscriber.mark(download_id)
+            wakeup.set()
+
+    async def wait_for_change(self, download_id, last_version, timeout):
+        """مثل StatusEvents.wait_for_change لكن بدون حجز خيط"""
+        current = status_events.version(download_id)
+        if current != last_version:
+            return current
+        # التسجيل يتم قبل أي await، فلا يضيع إشعار يصل بين الفحص والانتظار
+        event = self._events.setdefault(download_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return status_events.version(download_id)
+
+    def subscribe(self):
+        """اشتراك WebSocket - يعيد (StatusSubscriber, حدث يُضبط عند أي تغيير)"""
+        subscriber = StatusSubscriber()
+        wakeup = asyncio.Event()
+        self._subscribers[subscriber] = wakeup
+        return subscriber, wakeup
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.pop(subscriber, None)
+
+
+runtime = {}
+
+
+@asynccontextmanager
+async def lifespan(app):
+    loop = asyncio.get_running_loop()
+    runtime['loop'] = loop
+    runtime['waiters'] = AsyncStatusWaiters(loop)
+    status_events.subscribe(runtime['waiters'])
+    try:
+        yield
+    finally:
+        status_events.unsubscribe(runtime['waiters'])
+        extract_executor.shutdown(wait=False)
+
+
+app = FastAPI(title='YouTube Downloader API', lifespan=lifespan)
+app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])
+
+
+def json_response(payload, status_code=200, headers=None):
+    return JSONResponse(payload, status_code=status_code, headers=headers)
+
+
+def download_gone_response(download_id):
+    """410 للمعرفات التي حُذفت بعد انتهاء صلاحيتها، و404 لغير المعروفة"""
+    if downloads_status.was_evicted(download_id):
+        return json_response({
+            'error': 'Download expired and was removed',
+            'status': 'expired',
+        }, 410)
+    return json_response({'error': 'Download ID not found'}, 404)
+
+
+async def run_blocking(function, *args):
+    """تشغيل دالة حاجبة (استخراج yt-dlp) في خيوط الاستخراج"""
+    return await asyncio.get_running_loop().run_in_executor(extract_executor, function, *args)
+
+
+async def run_ytdlp_command_async(command, download_id):
+    """مثل run_ytdlp_command لكن العملية تُدار من حلقة asyncio"""
+    output = YtdlpOutput(download_id)
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        limit=YTDLP_LINE_LIMIT
+    )
+    timeline = job_timelines.get(download_id)
+    if timeline is not None:
+        timeline.attach(lambda: process_usage(process.pid))
+    try:
+        async for line in process.stdout:
+            output.feed(line.decode('utf-8', 'replace'))
+        if timeline is not None:
+            # حلقة asyncio تحصد العملية بنفسها (بلا rusage) - آخر قياس من /proc عند إغلاق مخرجاتها
+            timeline.exited(process_usage(process.pid))
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+        raise
+    finally:
+        returncode = await process.wait()
+
+    return output.check(returncode, command)
+
+
+async def download_video_async(url, download_id, options):
+    """تنفيذ أمر yt-dlp كعملية asyncio (المقابل لـ download_video_thread)"""
+    try:
+        # حصة ثابتة من RATE_LIMIT لكل عملية yt-dlp عند تشغيلها
+        rate_limit = bandwidth.start_job(download_id, adjustable=False)
+        tuning = fragment_tuner.start_job(download_id, url)
+        command, format_spec = build_ytdlp_command(url, options, rate_limit, tuning)
+        update_download_status(download_id, {
+            'status': 'downloading',
+            'progress': '0%',
+            # ملف واحد بدون دمج - يمكن إرساله أثناء التحميل (/api/get-file)
+            'single_stream': '+' not in format_spec,
+        })
+        try:
+            output = await run_ytdlp_command_async(command, download_id)
+        finally:
+            fragment_tuner.finish_job(download_id)
+            bandwidth.finish_job(download_id)
+        # التسجيل يحسب بصمة الملف للأرشيف - خارج حلقة الأحداث
+        await run_blocking(output.complete, url, download_id, options)
+
+    except Exception as e:
+        update_download_status(download_id, download_error_fields(e), replace=True)
+
+
+def download_video_bridge(url, download_id, options):
+    """
+    هدف المجدول في وضع ASGI: العامل يحجز مكانه في حد التزامن فقط،
+    أما العملية ومخرجاتها فتُدار على حلقة asyncio
+    """
+    future = asyncio.run_coroutine_threadsafe(
+        download_video_async(url, download_id, options),
+        runtime['loop']
+    )
+    future.result()
+
+
+def download_target():
+    return download_video_thread1 if DOWNLOAD_ENGINE == 'pool' else download_video_bridge
+
+
+async def wait_until_finished(download_id):
+    """انتظار انتهاء التحميل (وضع async=false) دون حجز خيط"""
+    version = status_events.version(download_id)
+    while True:
+        status = downloads_status.get(download_id)
+        if status is None or status.get('status') in TERMINAL_STATES:
+            return status
+        version = await runtime['waiters'].wait_for_change(download_id, version, SSE_HEARTBEAT_INTERVAL)
+
+
+@app.get('/api/health')
+async def health_check():
+    """فحص صحة API"""
+    return json_response({**health_payload(), 'server': 'asgi'})
+
+
+@app.post('/api/info')
+async def get_video_info(request: Request):
+    """الحصول على معلومات الفيديو بدون تحميل"""
+    try:
+        data = await request.json()
+        url = data.get('url')
+
+        if not url:
+            return json_response({'error': 'URL is required'}, 400)
+
+        info = await run_blocking(metadata_cache.get, url)
+        return json_response(video_info_payload(info))
+
+    except Exception as e:
+        return json_response({'error': str(e)}, 500)
+
+
+@app.post('/api/info/batch')
+async def get_video_info_batch(request: Request):
+    """معلومات عدة فيديوهات كسطور NDJSON بترتيب الانتهاء (نفس سلوك نسخة Flask)"""
+    try:
+        urls = parse_info_batch(await request.json())
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+
+    async def generate():
+        slots = asyncio.Semaphore(INFO_BATCH_CONCURRENCY)
+
+        async def extract(url):
+            async with slots:
+                return await run_blocking(metadata_cache.get, url)
+
+        tasks = {asyncio.ensure_future(extract(url)): (index, url) for index, url in enumerate(urls)}
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    index, url = tasks[task]
+                    yield info_batch_line(index, url, task)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        generate(),
+        media_type='application/x-ndjson',
+        headers={'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.post('/api/playlist/entries')
+async def list_playlist_entries(request: Request):
+    """عناصر قائمة تشغيل صفحة صفحة كسطور NDJSON (نفس سلوك نسخة Flask)"""
+    try:
+        data = await request.json()
+        url = data.get('url')
+        cursor = max(int(data.get('cursor') or 0), 0)
+        limit = min(max(int(data.get('limit') or PLAYLIST_PAGE_LIMIT), 1), PLAYLIST_PAGE_MAX)
+    except (TypeError, ValueError) as e:
+        return json_response({'error': f'Invalid parameter: {e}'}, 400)
+    if not url:
+        return json_response({'error': 'URL is required'}, 400)
+
+    # المولّد متزامن (يقرأ من yt-dlp) - كل خطوة منه في خيوط الاستخراج
+    items = iter_playlist_page(url, cursor, limit)
+    try:
+        first = await run_blocking(next, items)
+    except Exception as e:
+        await run_blocking(items.close)
+        return json_response({'error': str(e)}, 500)
+
+    async def generate():
+        try:
+            yield json.dumps(first) + '\n'
+            while True:
+                item = await run_blocking(next, items, None)
+                if item is None:
+                    return
+                yield json.dumps(item) + '\n'
+        except Exception as e:
+            yield json.dumps({'type': 'error', 'error': str(e)}) + '\n'
+        finally:
+            await run_blocking(items.close)
+
+    return StreamingResponse(
+        generate(),
+        media_type='application/x-ndjson',
+        headers={'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.post('/api/formats')
+async def get_available_formats(request: Request):
+    """الحصول على جميع الصيغ المتاحة للفيديو"""
+    try:
+        data = await request.json()
+        url = data.get('url')
+
+        if not url:
+            return json_response({'error': 'URL is required'}, 400)
+
+        info = await run_blocking(metadata_cache.get, url)
+        return json_response(formats_payload(info))
+
+    except Exception as e:
+        return json_response({'error': str(e)}, 500)
+
+
+@app.post('/api/download')
+async def download_video(request: Request):
+    """تحميل فيديو"""
+    try:
+        data = await request.json()
+        url = data.get('url')
+        is_async = data.get('async', True)
+        try:
+            priority = request_priority(data)
+        except ValueError as e:
+            return json_response({'error': str(e)}, 400)
+
+        if not url:
+            return json_response({'error': 'URL is required'}, 400)
+
+        download_id, job, reused, replayed = submit_download(
+            url, download_options(data), priority, request.headers.get('Idempotency-Key'),
+            target=download_target()
+        )
+        if replayed:
+            return json_response({
+                'download_id': download_id,
+                **status_with_queue_info(download_id),
+                'idempotent_replay': True,
+                'status_url': f'/api/status/{download_id}',
+            })
+
+        if reused and downloads_status[download_id].get('status') == 'completed':
+            return json_response({
+                'download_id': download_id,
+                **downloads_status[download_id],
+                'reused': True,
+            })
+
+        if is_async:
+            return json_response({
+                'download_id': download_id,
+                'status': downloads_status[download_id].get('status'),
+                'message': 'Attached to in-progress download' if reused else 'Download queued',
+                'attached': reused,
+                **(scheduler.queue_info(download_id) or {}),
+                'status_url': f'/api/status/{download_id}',
+                'note': 'Files will be automatically deleted after 1 hour'
+            }, 202)
+
+        return json_response(await wait_until_finished(download_id))
+
+    except Exception as e:
+        return json_response({'error': str(e)}, 500)
+
+
+@app.post('/api/download/batch')
+async def download_batch(request: Request):
+    """تحميل عدة روابط كمجموعة واحدة (نفس سلوك نسخة Flask)"""
+    try:
+        data = await request.json()
+        urls = parse_download_batch(data)
+        priority = request_priority(data)
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+
+    try:
+        group_id, replayed = submit_download_batch(
+            urls, download_options(data), priority, request.headers.get('Idempotency-Key'),
+            target=download_target()
+        )
+        return json_response({
+            'group_id': group_id,
+            **downloads_status[group_id],
+            'idempotent_replay': replayed,
+            'status_url': f'/api/download/batch/{group_id}',
+            'events_url': f'/api/status/{group_id}/stream',
+        }, 200 if replayed else 202)
+    except Exception as e:
+        return json_response({'error': str(e)}, 500)
+
+
+@app.get('/api/download/batch/{group_id}')
+async def get_download_batch(group_id: str):
+    """حالة مجموعة التحميل مع حالة كل رابط فيها"""
+    if group_id not in downloads_status:
+        return download_gone_response(group_id)
+
+    group = downloads_status[group_id]
+    if group.get('type') not in ('group', 'playlist'):
+        return json_response({'error': 'Not a download group'}, 404)
+    return json_response({**group, 'jobs': group_children_status(group)})
+
+
+@app.get('/api/status/{download_id}')
+async def get_download_status(download_id: str):
+    """الحصول على حالة التحميل"""
+    if download_id not in downloads_status:
+        return download_gone_response(download_id)
+
+    return json_response(status_with_queue_info(download_id))
+
+
+@app.get('/api/status/{download_id}/stream')
+async def stream_download_status(download_id: str, request: Request):
+    """بث حالة التحميل عبر Server-Sent Events (نفس سلوك نسخة Flask)"""
+    if download_id not in downloads_status:
+        return download_gone_response(download_id)
+
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID') or request.query_params.get('last_event_id') or 0)
+    except ValueError:
+        last_event_id = 0
+
+    def format_event(version, status):
+        event = 'done' if status.get('status') in TERMINAL_STATES else 'progress'
+        return f"id: {version}\nevent: {event}\ndata: {json.dumps(status)}\n\n"
+
+    async def generate():
+        version = last_event_id
+        yield f"retry: {SSE_HEARTBEAT_INTERVAL * 1000}\n\n"
+        while True:
+            current = await runtime['waiters'].wait_for_change(download_id, version, SSE_HEARTBEAT_INTERVAL)
+            if download_id not in downloads_status:
+                yield "event: gone\ndata: {}\n\n"
+                return
+            status = status_with_queue_info(download_id)
+
+            if current != version:
+                version = current
+                yield format_event(version, status)
+            elif status.get('status') in TERMINAL_STATES + ('queued',):
+                yield format_event(version, status)
+            else:
+                yield ": heartbeat\n\n"
+
+            if status.get('status') in TERMINAL_STATES:
+                return
+
+    return StreamingResponse(
+        generate(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.websocket('/api/ws/progress')
+async def progress_websocket(ws: WebSocket):
+    """قناة WebSocket واحدة لمتابعة عدة تحميلات (نفس بروتوكول نسخة Flask)"""
+    await ws.accept()
+    waiters = runtime['waiters']
+    subscriber, wakeup = waiters.subscribe()
+    deltas = ProgressDeltas()
+    rate = WS_MAX_UPDATE_RATE
+
+    async def handle_message(message):
+        nonlocal rate
+        try:
+            data = json.loads(message)
+        except ValueError:
+            await ws.send_text(json.dumps({'type': 'error', 'error': 'Invalid JSON'}))
+            return
+        action = data.get('action')
+        ids = [str(i) for i in data.get('ids', [])]
+        if action == 'subscribe':
+            subscriber.watch(ids, all_jobs=bool(data.get('all')))
+        elif action == 'unsubscribe':
+            subscriber.unwatch(ids, all_jobs=bool(data.get('all')))
+            deltas.forget(ids)
+        elif action == 'set_rate':
+            try:
+                rate = ws_update_rate(data.get('max_rate', WS_MAX_UPDATE_RATE))
+            except ValueError as e:
+                await ws.send_text(json.dumps({'type': 'error', 'error': str(e)}))
+        else:
+            await ws.send_text(json.dumps({'type': 'error', 'error': f'Unknown action: {action}'}))
+
+    async def receive_messages():
+        while True:
+            await handle_message(await ws.receive_text())
+
+    async def send_batches():
+        last_message_at = time.time()
+        while True:
+            # دفعة واحدة كل 1/rate ثانية على الأكثر، والنوم حتى يتغير شيء
+            await asyncio.sleep(1 / rate)
+            wakeup.clear()
+            jobs, removed = deltas.build(subscriber.drain())
+            if jobs or removed:
+                await ws.send_text(json.dumps({'type': 'progress', 'jobs': jobs, 'removed': removed}))
+                last_message_at = time.time()
+                continue
+            try:
+                await asyncio.wait_for(
+                    wakeup.wait(),
+                    max(SSE_HEARTBEAT_INTERVAL - (time.time() - last_message_at), 0)
+                )
+            except asyncio.TimeoutError:
+                await ws.send_text(json.dumps({'type': 'heartbeat'}))
+                last_message_at = time.time()
+
+    try:
+        args = ws.query_params
+        subscriber.watch(
+            [i for i in args.get('ids', '').split(',') if i],
+            all_jobs=args.get('all') in ('1', 'true')
+        )
+        if args.get('max_rate'):
+            await handle_message(json.dumps({'action': 'set_rate', 'max_rate': args.get('max_rate')}))
+
+        tasks = [asyncio.create_task(receive_messages()), asyncio.create_task(send_batches())]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        waiters.unsubscribe(subscriber)
+
+
+@app.get('/api/downloads')
+async def list_downloads(request: Request):
+    """قائمة التحميلات مقسمة إلى صفحات (نفس معاملات نسخة Flask)"""
+    try:
+        statuses, since, limit, cursor = parse_downloads_query(request.query_params)
+    except ValueError as e:
+        return json_response({'error': f'Invalid query parameter: {e}'}, 400)
+
+    page, next_cursor = downloads_status.query(statuses or None, since or None, cursor, limit)
+
+    def generate():
+        yield '{'
+        for i, (download_id, status) in enumerate(page):
+            separator = ', ' if i else ''
+            yield f'{separator}{json.dumps(download_id)}: {json.dumps(status_with_queue_info(download_id, status))}'
+        yield '}'
+
+    headers = {}
+    if next_cursor is not None:
+        headers['X-Next-Cursor'] = str(next_cursor)
+        query = urlencode({**dict(request.query_params), 'cursor': next_cursor})
+        headers['Link'] = f'</api/downloads?{query}>; rel="next"'
+    return StreamingResponse(generate(), media_type='application/json', headers=headers)
+
+
+def parse_range(header, size):
+    """
+    نطاق بايتات واحد من ترويسة Range -> (start, end) شاملاً
+    None يعني إرسال الملف كاملاً، و ValueError يعني نطاقاً خارج الملف (416)
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    try:
+        first = int(first) if first else None
+        last = int(last) if last else None
+    except ValueError:
+        # ترويسة غير مفهومة تُتجاهل حسب RFC 9110
+        return None
+    if first is not None:
+        start, end = first, size - 1 if last is None else min(last, size - 1)
+    elif last:
+        start, end = max(size - last, 0), size - 1
+    else:
+        raise ValueError('range not satisfiable')
+    if start > end or start >= size:
+        raise ValueError('range not satisfiable')
+    return start, end
+
+
+def not_modified(request, etag, mtime):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        return if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+async def read_file_range(file_path, start, length):
+    """قراءة جزء من الملف على دفعات دون حجز الحلقة"""
+    async with await anyio.open_file(file_path, 'rb') as f:
+        await f.seek(start)
+        while length > 0:
+            chunk = await f.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+async def follow_growing_file_async(download_id):
+    """مثل follow_growing_file: إرسال ملف .part أثناء كتابته"""
+    waiters = runtime['waiters']
+    deadline = time.time() + TAIL_FOLLOW_TIMEOUT
+    version = status_events.version(download_id)
+
+    while True:
+        status = downloads_status.get(download_id) or {}
+        part_path = status.get('tmpfilename')
+        if part_path and os.path.exists(part_path):
+            break
+        if status.get('status') in TERMINAL_STATES or time.time() > deadline:
+            return
+        version = await waiters.wait_for_change(download_id, version, TAIL_FOLLOW_TIMEOUT)
+
+    async with await anyio.open_file(part_path, 'rb') as f:
+        while True:
+            chunk = await f.read(STREAM_CHUNK_SIZE)
+            if chunk:
+                deadline = time.time() + TAIL_FOLLOW_TIMEOUT
+                yield chunk
+                continue
+
+            status = downloads_status.get(download_id) or {}
+            state = status.get('status')
+            if state == 'error':
+                return
+            if state in ('finished', 'completed') or status.get('tmpfilename') != part_path:
+                rest = await f.read()
+                if rest:
+                    yield rest
+                return
+            if time.time() > deadline:
+                print(f"Progressive download timed out ({download_id})")
+                return
+            version = await waiters.wait_for_change(download_id, version, TAIL_FOLLOW_POLL)
+
+
+async def throttle_async(chunks, client):
+    """مثل bandwidth.throttle لكن الانتظار لا يحجز الحلقة"""
+    buckets = bandwidth.egress_buckets(client)
+    try:
+        async for chunk in chunks:
+            if buckets:
+                delay = bandwidth.egress_delay(buckets, len(chunk))
+                if delay:
+                    await asyncio.sleep(delay)
+            yield chunk
+    finally:
+        await chunks.aclose()
+
+
+async def count_served_async(chunks, mode):
+    """مثل count_served: عدّ البايتات المرسلة فعلاً"""
+    try:
+        async for chunk in chunks:
+            metrics.inc('ytdl_served_bytes_total', len(chunk), mode=mode)
+            yield chunk
+    finally:
+        await chunks.aclose()
+
+
+def shaped(chunks, request):
+    """تمرير قطع الملف عبر دلاء عرض النطاق إن كان الصادر محدوداً"""
+    if not bandwidth.shapes_egress:
+        return chunks
+    return throttle_async(chunks, request.client.host if request.client else None)
+
+
+@app.get('/api/get-file/{download_id}')
+async def get_file(download_id: str, request: Request):
+    """إرسال الملف مع دعم Range و ETag، والقراءة من القرص دون حجز الحلقة"""
+    if download_id not in downloads_status:
+        return download_gone_response(download_id)
+
+    status = downloads_status[download_id]
+    if status.get('status') != 'completed':
+        if status.get('single_stream') and status.get('status') not in TERMINAL_STATES + ('queued',):
+            filename = os.path.basename(status.get('filename') or f'{download_id}.mp4')
+            return StreamingResponse(
+                shaped(count_served_async(follow_growing_file_async(download_id), 'progressive'), request),
+                media_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                headers={
+                    'Content-Disposition': content_disposition_header(filename),
+                    'X-Progressive': 'true',
+                    'X-Accel-Buffering': 'no',
+                }
+            )
+        return json_response({'error': 'File not ready yet'}, 400)
+
+    file_path = status.get('filename')
+    if not file_path:
+        return json_response({'error': 'File deleted or not found'}, 404)
+
+    # منع المنظف من حذف الملف حتى ينتهي إرساله
+    janitor.pin(file_path)
+    if not os.path.exists(file_path):
+        janitor.unpin(file_path)
+        return json_response({'error': 'File deleted or not found'}, 404)
+
+    try:
+        janitor.touch(file_path)
+        filename = os.path.basename(file_path)
+
+        if FILE_SERVING_MODE == 'x-accel':
+            # nginx يقرأ الملف بعد الاستجابة - المهلة تحميه من الحذف
+            janitor.lease(file_path)
+            janitor.unpin(file_path)
+            metrics.inc('ytdl_served_bytes_total', os.path.getsize(file_path), mode='x-accel')
+            return Response(headers={
+                'X-Accel-Redirect': x_accel_location(file_path),
+                'Content-Disposition': content_disposition_header(filename),
+            })
+
+        st = os.stat(file_path)
+        etag = f'"{file_etag(st)}"'
+        headers = {
+            'ETag': etag,
+            'Last-Modified': formatdate(st.st_mtime, usegmt=True),
+            'Cache-Control': f'public, max-age={FILE_CACHE_MAX_AGE}',
+            'Accept-Ranges': 'bytes',
+            'Content-Disposition': content_disposition_header(filename),
+        }
+        if FILE_SERVING_MODE == 'x-sendfile':
+            janitor.lease(file_path)
+            janitor.unpin(file_path)
+            metrics.inc('ytdl_served_bytes_total', st.st_size, mode='x-sendfile')
+            return Response(headers={**headers, 'X-Sendfile': file_path})
+
+        if not_modified(request, etag, st.st_mtime):
+            janitor.unpin(file_path)
+            return Response(status_code=304, headers=headers)
+
+        byte_range = None
+        if_range = request.headers.get('If-Range')
+        if not if_range or if_range.strip() in (etag, headers['Last-Modified']):
+            try:
+                byte_range = parse_range(request.headers.get('Range'), st.st_size)
+            except ValueError:
+                janitor.unpin(file_path)
+                return Response(status_code=416, headers={'Content-Range': f'bytes */{st.st_size}'})
+
+        status_code = 200
+        start, end = 0, st.st_size - 1
+        if byte_range:
+            status_code = 206
+            start, end = byte_range
+            headers['Content-Range'] = f'bytes {start}-{end}/{st.st_size}'
+        headers['Content-Length'] = str(end - start + 1)
+
+        return StreamingResponse(
+            shaped(count_served_async(read_file_range(file_path, start, end - start + 1), 'direct'), request),
+            status_code=status_code,
+            media_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+            headers=headers,
+            # يُنفذ بعد انتهاء الإرسال أو انقطاع العميل
+            background=BackgroundTask(janitor.unpin, file_path)
+        )
+    except Exception as e:
+        janitor.unpin(file_path)
+        return json_response({'error': str(e)}, 500)
+
+
+# باقي المسارات من تطبيق Flask كما هي
+app.mount('/', WSGIMiddleware(index.app))
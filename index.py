@@ -4,9 +4,13 @@ YouTube Downloader API - نسخة Render.com
 معدّلة للعمل على منصة Render.com
 """
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS
+from flask_sock import Sock
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import ClosingIterator
 import yt_dlp
+import io
 import os
 import json
 from datetime import datetime
@@ -15,9 +19,23 @@ import uuid
 from pathlib import Path
 import subprocess
 import shlex
+import heapq
+import bisect
+import itertools
+import time
+import re
+import hashlib
+import sqlite3
+import mimetypes
+import sys
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlencode, quote, urlparse
+from ytdlp_worker import iter_playlist_entries, postprocessor_phase, requested_files
 
 app = Flask(__name__)
 CORS(app)
+sock = Sock(app)
 
 # الحصول على المنفذ من متغيرات البيئة (Render يستخدم PORT)
 PORT = int(os.environ.get('PORT', 5000))
@@ -26,36 +44,2051 @@ PORT = int(os.environ.get('PORT', 5000))
 DOWNLOAD_DIR = Path(os.environ.get('DOWNLOAD_DIR', '/tmp/downloads'))
 DOWNLOAD_DIR.mkdir(exist_ok=True, parents=True)
 
+# الحالات النهائية للمهمة - أي حالة أخرى تعني أن المهمة ما زالت تعمل
+TERMINAL_STATES = ('completed', 'error')
+
+# مدة الاحتفاظ بسجلات المهام المنتهية (بالثواني) قبل حذفها مع ملفاتها
+JOB_TTLS = {
+    'completed': int(os.environ.get('JOB_TTL_COMPLETED', 3600)),
+    'error': int(os.environ.get('JOB_TTL_ERROR', 900)),
+}
+# الحد الأقصى لعدد السجلات - الأقدم انتهاءً يُحذف أولاً عند التجاوز
+JOB_MAX_RECORDS = int(os.environ.get('JOB_MAX_RECORDS', 10000))
+JOB_SWEEP_INTERVAL = int(os.environ.get('JOB_SWEEP_INTERVAL', 60))
+# المعرفات المحذوفة تُذكر لهذه المدة لإرجاع 410 بدلاً من 404
+JOB_TOMBSTONE_TTL = 24 * 3600
+JOB_TOMBSTONE_LIMIT = 100000
+
+# مخزن حالة التحميلات: memory (الافتراضي) أو sqlite ليبقى بعد إعادة التشغيل
+JOB_STORE = os.environ.get('JOB_STORE', 'memory')
+JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH', '/tmp/jobs.sqlite3')
+# كل كم ثانية تُكتب تحديثات التقدم المتراكمة إلى SQLite
+JOB_STORE_FLUSH_INTERVAL = float(os.environ.get('JOB_STORE_FLUSH_INTERVAL', 1.0))
+
+
+def record_paths(record):
+    """مسارات الملفات التي يشير إليها سجل مهمة"""
+    paths = set(record.get('files') or []) | {record.get('filename')}
+    paths.discard(None)
+    paths.discard('Unknown')
+    return paths
+
+
+class MemoryJobStore(dict):
+    """
+    المخزن الافتراضي - قاموس في الذاكرة كما كان دائماً
+    مع فهارس مرتبة حسب ترتيب الإنشاء لكل حالة، لتقسيم /api/downloads
+    إلى صفحات وعدّ المهام في /api/health دون المرور على كل السجلات
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._sequence = itertools.count(1)
+        # رقم تسلسلي لكل مهمة حسب ترتيب إنشائها (يستخدم كـ cursor)
+        self._seq_by_id = {}
+        self._id_by_seq = {}
+        self._created_at = {}
+        self._all = []
+        self._by_status = {}
+        # المهام المنتهية بترتيب وقت انتهائها لكل حالة: (الوقت، المعرف)
+        self._finished = {}
+        self._finished_at = {}
+        self._tombstones = OrderedDict()
+        # عدد السجلات التي تشير إلى كل ملف (حتى لا يمر الكنس على كل السجلات)
+        self._path_refs = Counter()
+
+    def put(self, download_id, record):
+        with self._lock:
+            previous = dict.get(self, download_id)
+            self[download_id] = record
+            self._reindex(download_id, previous and previous.get('status'), record.get('status'))
+            self._repath(record_paths(previous) if previous else set(), record_paths(record))
+
+    def merge(self, download_id, fields):
+        with self._lock:
+            record = self.get(download_id)
+            if record is None:
+                self[download_id] = dict(fields)
+                self._reindex(download_id, None, fields.get('status'))
+                self._repath(set(), record_paths(fields))
+            else:
+                previous_status = record.get('status')
+                previous_paths = record_paths(record) if 'files' in fields or 'filename' in fields else None
+                record.update(fields)
+                self._reindex(download_id, previous_status, record.get('status'))
+                if previous_paths is not None:
+                    self._repath(previous_paths, record_paths(record))
+
+    def _repath(self, old_paths, new_paths):
+        for path in old_paths - new_paths:
+            self._path_refs[path] -= 1
+            if self._path_refs[path] <= 0:
+                del self._path_refs[path]
+        for path in new_paths - old_paths:
+            self._path_refs[path] += 1
+
+    def references(self, path):
+        """هل ما زال سجل مهمة يشير إلى هذا الملف"""
+        with self._lock:
+            return self._path_refs.get(path, 0) > 0
+
+    def _reindex(self, download_id, old_status, new_status):
+        seq = self._seq_by_id.get(download_id)
+        if seq is None:
+            seq = next(self._sequence)
+            self._seq_by_id[download_id] = seq
+            self._id_by_seq[seq] = download_id
+            self._created_at[seq] = time.time()
+            self._all.append(seq)
+        elif old_status == new_status:
+            return
+        else:
+            index = self._by_status[old_status]
+            del index[bisect.bisect_left(index, seq)]
+        bisect.insort(self._by_status.setdefault(new_status, []), seq)
+        
+        if new_status in TERMINAL_STATES:
+            finished_at = time.time()
+            self._finished_at[download_id] = (new_status, finished_at)
+            self._finished.setdefault(new_status, deque()).append((finished_at, download_id))
+        else:
+            self._finished_at.pop(download_id, None)
+
+    def expired(self, ttls, max_records):
+        """
+        السجلات المنتهية التي تجاوزت مدة الاحتفاظ، ثم الأقدم انتهاءً حتى
+        ينزل العدد إلى max_records - الطوابير مرتبة زمنياً فالكلفة بعدد المحذوف فقط
+        """
+        now = time.time()
+        chosen = {}
+        with self._lock:
+            for state, ttl in ttls.items():
+                queue = self._finished.get(state, ())
+                while queue and queue[0][0] <= now - ttl:
+                    finished_at, download_id = queue.popleft()
+                    if self._finished_at.get(download_id) == (state, finished_at):
+                        chosen[download_id] = self[download_id]
+            
+            excess = len(self) - len(chosen) - max_records
+            while excess > 0:
+                heads = [(queue[0], queue) for queue in self._finished.values() if queue]
+                if not heads:
+                    break
+                (finished_at, download_id), queue = min(heads, key=lambda head: head[0][0])
+                queue.popleft()
+                if download_id not in chosen and self._finished_at.get(download_id, (None, None))[1] == finished_at:
+                    chosen[download_id] = self[download_id]
+                    excess -= 1
+        return list(chosen.items())
+
+    def remove(self, download_id):
+        with self._lock:
+            record = dict.pop(self, download_id, None)
+            if record is None:
+                return
+            seq = self._seq_by_id.pop(download_id)
+            del self._id_by_seq[seq]
+            del self._created_at[seq]
+            for index in (self._all, self._by_status[record.get('status')]):
+                del index[bisect.bisect_left(index, seq)]
+            self._finished_at.pop(download_id, None)
+            self._repath(record_paths(record), set())
+            
+            self._tombstones[download_id] = time.time()
+            while len(self._tombstones) > JOB_TOMBSTONE_LIMIT:
+                self._tombstones.popitem(last=False)
+
+    def was_evicted(self, download_id):
+        with self._lock:
+            evicted_at = self._tombstones.get(download_id)
+            return evicted_at is not None and time.time() - evicted_at < JOB_TOMBSTONE_TTL
+
+    def count_by_status(self):
+        with self._lock:
+            return {status: len(seqs) for status, seqs in self._by_status.items() if seqs}
+
+    def query(self, statuses=None, since=None, cursor=0, limit=100):
+        """
+        صفحة من المهام مرتبة حسب الإنشاء: [(المعرف، السجل)...] والـ cursor التالي
+        البحث الثنائي في الفهارس يجعل كلفة الصفحة مستقلة عن عدد المهام الكلي
+        """
+        with self._lock:
+            start = cursor or 0
+            if since is not None:
+                i = bisect.bisect_left(self._all, since, key=self._created_at.__getitem__)
+                if i == len(self._all):
+                    return [], None
+                start = max(start, self._all[i] - 1)
+            
+            indexes = [self._by_status.get(s, []) for s in statuses] if statuses else [self._all]
+            seqs = []
+            for index in indexes:
+                i = bisect.bisect_right(index, start)
+                seqs.extend(index[i:i + limit + 1])
+            seqs = sorted(seqs)[:limit + 1]
+            
+            next_cursor = seqs[limit - 1] if len(seqs) > limit else None
+            return [(self._id_by_seq[seq], self[self._id_by_seq[seq]]) for seq in seqs[:limit]], next_cursor
+
+
+class SQLiteJobStore:
+    """
+    مخزن حالة التحميلات في SQLite بوضع WAL
+    - يمكن لعدة عمليات مشاركة نفس الملف
+    - تغيير الحالة (queued, downloading, completed...) يُكتب فوراً
+    - تحديثات التقدم تُجمع في الذاكرة وتُكتب دفعة واحدة كل فترة قصيرة
+    - المهام التي توقفت عمليتها (انهيار أو إعادة تشغيل) تُعلَّم كخطأ
+    """
+    # عملية لم تحدّث نبضها خلال هذه المدة تعتبر متوقفة
+    OWNER_TIMEOUT = 60
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = str(path)
+        self.flush_interval = flush_interval
+        self.owner = f'{os.uname().nodename}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # سجلات المهام الجارية في هذه العملية، والمعرفات التي لم تُكتب بعد
+        self._live = {}
+        self._dirty = set()
+
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT,
+                owner TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+            CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at);
+            CREATE INDEX IF NOT EXISTS jobs_status_updated_at ON jobs (status, updated_at);
+            -- الملفات التي يشير إليها كل سجل (لكنس الملفات دون قراءة كل السجلات)
+            CREATE TABLE IF NOT EXISTS job_paths (
+                id TEXT NOT NULL,
+                path TEXT NOT NULL,
+                PRIMARY KEY (id, path)
+            );
+            CREATE INDEX IF NOT EXISTS job_paths_path ON job_paths (path);
+            CREATE TABLE IF NOT EXISTS evicted (
+                id TEXT PRIMARY KEY,
+                evicted_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS owners (
+                owner TEXT PRIMARY KEY,
+                heartbeat REAL NOT NULL
+            );
+            
+            -- عدد المهام في كل حالة، تحدّثه المشغلات (triggers) مع كل كتابة
+            CREATE TABLE IF NOT EXISTS job_counts (
+                status TEXT PRIMARY KEY,
+                n INTEGER NOT NULL
+            );
+            CREATE TRIGGER IF NOT EXISTS jobs_count_insert AFTER INSERT ON jobs BEGIN
+                INSERT INTO job_counts VALUES (COALESCE(new.status, 'unknown'), 1)
+                    ON CONFLICT (status) DO UPDATE SET n = n + 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS jobs_count_update AFTER UPDATE OF status ON jobs
+            WHEN old.status IS NOT new.status BEGIN
+                UPDATE job_counts SET n = n - 1 WHERE status = COALESCE(old.status, 'unknown');
+                INSERT INTO job_counts VALUES (COALESCE(new.status, 'unknown'), 1)
+                    ON CONFLICT (status) DO UPDATE SET n = n + 1;
+            END;
+            CREATE TRIGGER IF NOT EXISTS jobs_count_delete AFTER DELETE ON jobs BEGIN
+                UPDATE job_counts SET n = n - 1 WHERE status = COALESCE(old.status, 'unknown');
+            END;
+        ''')
+        # إعادة بناء العدادات مرة واحدة عند البدء (لقواعد بيانات أنشئت قبل المشغلات)
+        db.executescript('''
+            BEGIN IMMEDIATE;
+            DELETE FROM job_counts;
+            INSERT INTO job_counts SELECT COALESCE(status, 'unknown'), COUNT(*) FROM jobs GROUP BY 1;
+            COMMIT;
+        ''')
+        self._rebuild_paths()
+        self._heartbeat()
+        self.recover()
+
+        flusher = threading.Thread(target=self._flush_loop, name='job-store-flusher', daemon=True)
+        flusher.start()
+
+    def _rebuild_paths(self):
+        """إعادة بناء فهرس الملفات مرة واحدة عند البدء (لقواعد بيانات أنشئت قبله)"""
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM job_paths')
+            for download_id, data in db.execute('SELECT id, data FROM jobs'):
+                db.executemany(
+                    'INSERT OR IGNORE INTO job_paths (id, path) VALUES (?, ?)',
+                    [(download_id, path) for path in record_paths(json.loads(data))]
+                )
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def _db(self):
+        """اتصال مستقل لكل خيط (WAL يسمح بالقراءة المتزامنة مع الكتابة)"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    # --- واجهة القاموس المستخدمة في باقي الملف ---
+
+    def get(self, download_id, default=None):
+        with self._lock:
+            record = self._live.get(download_id)
+        if record is not None:
+            return record
+        row = self._db().execute('SELECT data FROM jobs WHERE id = ?', (download_id,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def __getitem__(self, download_id):
+        record = self.get(download_id)
+        if record is None:
+            raise KeyError(download_id)
+        return record
+
+    def __contains__(self, download_id):
+        with self._lock:
+            if download_id in self._live:
+                return True
+        return self._db().execute('SELECT 1 FROM jobs WHERE id = ?', (download_id,)).fetchone() is not None
+
+    def __iter__(self):
+        self.flush()
+        rows = self._db().execute('SELECT id FROM jobs ORDER BY created_at').fetchall()
+        return iter([row[0] for row in rows])
+
+    def __len__(self):
+        self.flush()
+        return self._db().execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [record for _, record in self.items()]
+
+    def items(self):
+        self.flush()
+        rows = self._db().execute('SELECT id, data FROM jobs ORDER BY created_at').fetchall()
+        return [(row[0], json.loads(row[1])) for row in rows]
+
+    def count_by_status(self):
+        rows = self._db().execute('SELECT status, n FROM job_counts WHERE n > 0').fetchall()
+        return dict(rows)
+
+    def query(self, statuses=None, since=None, cursor=0, limit=100):
+        """صفحة من المهام مرتبة حسب الإنشاء (rowid هو الـ cursor)"""
+        self.flush()
+        sql = 'SELECT rowid, id, data FROM jobs WHERE rowid > ?'
+        params = [cursor or 0]
+        if statuses:
+            sql += f" AND status IN ({','.join('?' * len(statuses))})"
+            params.extend(statuses)
+        if since is not None:
+            sql += ' AND created_at >= ?'
+            params.append(since)
+        sql += ' ORDER BY rowid LIMIT ?'
+        params.append(limit + 1)
+        rows = self._db().execute(sql, params).fetchall()
+        
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        with self._lock:
+            page = [(i, self._live.get(i) or json.loads(data)) for _, i, data in rows[:limit]]
+        return page, next_cursor
+
+    # --- الكتابة ---
+
+    def put(self, download_id, record):
+        record = dict(record)
+        with self._lock:
+            if record.get('status') in TERMINAL_STATES:
+                self._live.pop(download_id, None)
+            else:
+                self._live[download_id] = record
+            self._dirty.discard(download_id)
+        self._write(download_id, record)
+
+    def merge(self, download_id, fields):
+        with self._lock:
+            record = self._live.get(download_id)
+            if (record is not None and fields.get('status', record.get('status')) == record.get('status')
+                    and ('files' not in fields and 'filename' not in fields
+                         or record_paths({**record, **fields}) == record_paths(record))):
+                # تحديث تقدم فقط (نفس الحالة ونفس الملفات) - يُكتب مع الدفعة التالية
+                record.update(fields)
+                self._dirty.add(download_id)
+                return
+        # تغيرت الحالة أو الملفات أو السجل ليس لمهمة جارية هنا - كتابة فورية
+        if record is None:
+            record = self.get(download_id) or {}
+        self.put(download_id, {**record, **fields})
+
+    def flush(self):
+        """كتابة تحديثات التقدم المتراكمة في معاملة واحدة"""
+        with self._lock:
+            if not self._dirty:
+                return
+            batch = [(i, dict(self._live[i])) for i in self._dirty if i in self._live]
+            self._dirty.clear()
+        now = time.time()
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany(
+                'UPDATE jobs SET status = ?, data = ?, updated_at = ? WHERE id = ?',
+                [(record.get('status'), json.dumps(record), now, download_id) for download_id, record in batch]
+            )
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def expired(self, ttls, max_records):
+        """السجلات المنتهية التي تجاوزت مدة الاحتفاظ ثم الأقدم حتى الحد الأقصى"""
+        db = self._db()
+        now = time.time()
+        chosen = {}
+        for state, ttl in ttls.items():
+            rows = db.execute(
+                'SELECT id, data FROM jobs WHERE status = ? AND updated_at <= ?',
+                (state, now - ttl)
+            ).fetchall()
+            chosen.update((i, json.loads(data)) for i, data in rows)
+        
+        total = db.execute('SELECT COALESCE(SUM(n), 0) FROM job_counts').fetchone()[0]
+        excess = total - len(chosen) - max_records
+        if excess > 0:
+            rows = db.execute(
+                f'''SELECT id, data FROM jobs
+                    WHERE status IN ({','.join('?' * len(ttls))})
+                    ORDER BY updated_at LIMIT ?''',
+                (*ttls, excess + len(chosen))
+            ).fetchall()
+            for i, data in rows:
+                if excess <= 0:
+                    break
+                if i not in chosen:
+                    chosen[i] = json.loads(data)
+                    excess -= 1
+        return list(chosen.items())
+
+    def remove(self, download_id):
+        with self._lock:
+            self._live.pop(download_id, None)
+            self._dirty.discard(download_id)
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM jobs WHERE id = ?', (download_id,))
+            db.execute('DELETE FROM job_paths WHERE id = ?', (download_id,))
+            db.execute('INSERT OR REPLACE INTO evicted (id, evicted_at) VALUES (?, ?)', (download_id, time.time()))
+            db.execute('DELETE FROM evicted WHERE evicted_at < ?', (time.time() - JOB_TOMBSTONE_TTL,))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def references(self, path):
+        """هل ما زال سجل مهمة يشير إلى هذا الملف (بحث في فهرس المسارات)"""
+        row = self._db().execute('SELECT 1 FROM job_paths WHERE path = ? LIMIT 1', (path,)).fetchone()
+        return row is not None
+
+    def was_evicted(self, download_id):
+        row = self._db().execute('SELECT evicted_at FROM evicted WHERE id = ?', (download_id,)).fetchone()
+        return row is not None and time.time() - row[0] < JOB_TOMBSTONE_TTL
+
+    def recover(self):
+        """تعليم المهام غير المنتهية التي توقفت عمليتها كخطأ"""
+        db = self._db()
+        stale_before = time.time() - self.OWNER_TIMEOUT
+        rows = db.execute(
+            f'''SELECT id, data FROM jobs
+                WHERE status NOT IN ({','.join('?' * len(TERMINAL_STATES))})
+                AND owner != ?
+                AND owner NOT IN (SELECT owner FROM owners WHERE heartbeat >= ?)''',
+            (*TERMINAL_STATES, self.owner, stale_before)
+        ).fetchall()
+        for download_id, data in rows:
+            record = json.loads(data)
+            record.update({
+                'status': 'error',
+                'error': 'Interrupted by a server restart, please submit again',
+                'interrupted': True,
+            })
+            self._write(download_id, record)
+        db.execute('DELETE FROM owners WHERE heartbeat < ?', (stale_before,))
+        return len(rows)
+
+    def _write(self, download_id, record):
+        now = time.time()
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute(
+                '''INSERT INTO jobs (id, status, owner, created_at, updated_at, data)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (id) DO UPDATE SET
+                       status = excluded.status, owner = excluded.owner,
+                       updated_at = excluded.updated_at, data = excluded.data''',
+                (download_id, record.get('status'), self.owner, now, now, json.dumps(record))
+            )
+            db.execute('DELETE FROM job_paths WHERE id = ?', (download_id,))
+            db.executemany(
+                'INSERT INTO job_paths (id, path) VALUES (?, ?)',
+                [(download_id, path) for path in record_paths(record)]
+            )
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def _heartbeat(self):
+        self._db().execute(
+            'INSERT OR REPLACE INTO owners (owner, heartbeat) VALUES (?, ?)',
+            (self.owner, time.time())
+        )
+
+    def _flush_loop(self):
+        last_heartbeat = time.time()
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if time.time() - last_heartbeat >= self.OWNER_TIMEOUT / 3:
+                    self._heartbeat()
+                    self.recover()
+                    last_heartbeat = time.time()
+            except Exception as e:
+                print(f"Job store flush error: {e}")
+
+
+def create_job_store():
+    """إنشاء مخزن الحالة حسب JOB_STORE"""
+    if JOB_STORE == 'sqlite':
+        return SQLiteJobStore(JOB_STORE_PATH, JOB_STORE_FLUSH_INTERVAL)
+    return MemoryJobStore()
+
+
 # تتبع حالة التحميلات
-downloads_status = {}
+downloads_status = create_job_store()
+
+# تحديد حد أقصى لحجم التحميلات على الخطة المجانية
+MAX_FILE_SIZE_MB = 100  # 100MB للخطة المجانية
+
+# الحد الأقصى لعدد التحميلات المتزامنة (الباقي ينتظر في الطابور)
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', 2))
+
+
+class StatusSubscriber:
+    """
+    مجموعة التحميلات التي يتابعها اتصال واحد، مع المعرفات التي تغيرت
+    منذ آخر دفعة - التغييرات المتكررة لنفس التحميل تُدمج في واحد
+    """
+    def __init__(self):
+        self.job_ids = set()
+        self.all_jobs = False
+        self._changed = set()
+        self._lock = threading.Lock()
+
+    def mark(self, download_id):
+        if self.all_jobs or download_id in self.job_ids:
+            with self._lock:
+                self._changed.add(download_id)
+
+    def watch(self, job_ids=(), all_jobs=False):
+        """إضافة تحميلات للمتابعة، مع إرسال حالتها الحالية في الدفعة التالية"""
+        with self._lock:
+            if all_jobs:
+                self.all_jobs = True
+                self._changed.update(list(downloads_status))
+            self.job_ids.update(job_ids)
+            self._changed.update(job_ids)
+
+    def unwatch(self, job_ids=(), all_jobs=False):
+        with self._lock:
+            if all_jobs:
+                self.all_jobs = False
+            self.job_ids.difference_update(job_ids)
+            self._changed.difference_update(job_ids)
+
+    def drain(self):
+        """المعرفات التي تغيرت منذ آخر استدعاء"""
+        with self._lock:
+            changed, self._changed = self._changed, set()
+        return changed
+
+
+class StatusEvents:
+    """
+    إشعار من يتابع تحميلاً معيناً عند تغير حالته
+    كل تغيير يرفع رقم إصدار السجل، والمتابع ينام حتى يتغير الرقم
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._conditions = {}
+        self._subscribers = set()
+
+    def publish(self, download_id):
+        with self._lock:
+            self._versions[download_id] = self._versions.get(download_id, 0) + 1
+            if download_id in self._conditions:
+                self._conditions[download_id][0].notify_all()
+            for subscriber in self._subscribers:
+                subscriber.mark(download_id)
+
+    def forget(self, download_id):
+        """إزالة تحميل محذوف وإيقاظ من يتابعه ليعرف أنه لم يعد موجوداً"""
+        with self._lock:
+            self._versions.pop(download_id, None)
+            if download_id in self._conditions:
+                self._conditions[download_id][0].notify_all()
+            for subscriber in self._subscribers:
+                subscriber.mark(download_id)
+
+    def subscribe(self, subscriber=None):
+        """
+        اشتراك في تغيرات عدة تحميلات معاً (لوحات المتابعة عبر WebSocket)
+        يمكن تمرير أي كائن له mark(download_id) بدلاً من StatusSubscriber
+        """
+        subscriber = subscriber or StatusSubscriber()
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def version(self, download_id):
+        with self._lock:
+            return self._versions.get(download_id, 0)
+
+    def wait_for_change(self, download_id, last_version, timeout):
+        """الانتظار حتى يتغير الإصدار أو تنتهي المهلة، وإرجاع الإصدار الحالي"""
+        with self._lock:
+            # شرط واحد لكل تحميل له متابعون، يُحذف عند مغادرة آخر متابع
+            cond, waiters = self._conditions.get(download_id) or (threading.Condition(self._lock), 0)
+            self._conditions[download_id] = (cond, waiters + 1)
+            try:
+                cond.wait_for(
+                    lambda: self._versions.get(download_id, 0) != last_version,
+                    timeout
+                )
+                return self._versions.get(download_id, 0)
+            finally:
+                cond, waiters = self._conditions[download_id]
+                if waiters > 1:
+                    self._conditions[download_id] = (cond, waiters - 1)
+                else:
+                    del self._conditions[download_id]
+
+
+status_events = StatusEvents()
+
+
+def update_download_status(download_id, fields, replace=False):
+    """تعديل سجل التحميل (أو استبداله) وإشعار من يتابع تغيراته"""
+    if replace:
+        downloads_status.put(download_id, dict(fields))
+    else:
+        downloads_status.merge(download_id, fields)
+    status_events.publish(download_id)
+    # مجاميع المجموعة التي ينتمي إليها هذا التحميل (/api/download/batch)
+    job_groups.child_updated(download_id)
+
+
+class JobGroups:
+    """
+    مجموعات التحميل: كل مجموعة سجل عادي في downloads_status (type=group)
+    فتعمل معها /api/status و SSE و WebSocket والحذف بعد انتهاء الصلاحية كما هي
+    المجاميع تُحدَّث بالفرق مع كل تغيير في أحد الأبناء بدلاً من إعادة حسابها عند كل استعلام
+    """
+    def __init__(self):
+        # يحمي المجاميع ويرتب كتابة سجل المجموعة حسب ترتيب تحديثات الأبناء
+        self._lock = threading.Lock()
+        # المجموعات غير المنتهية فقط: group_id -> {'children': {child_id: مساهمة}, 'totals': {...}}
+        self._groups = {}
+        # child_id -> المجموعات التي تنتظره (قد يشترك تحميل مكرر بين مجموعتين)
+        self._parents = {}
+
+    @staticmethod
+    def _contribution(record):
+        """(الحالة، نسبة الإنجاز، البايتات المحملة، الحجم الكلي) لابن واحد"""
+        record = record or {}
+        state = record.get('status')
+        if state == 'completed':
+            size = record.get('total_bytes') or record.get('downloaded_bytes') or 0
+            return 'completed', 1.0, size, size
+        if state == 'error':
+            return 'failed', 1.0, 0, 0
+        if state in (None, 'queued'):
+            return 'queued', 0.0, 0, 0
+        downloaded = record.get('downloaded_bytes') or 0
+        total = record.get('total_bytes') or 0
+        fraction = min(downloaded / total, 1.0) if total else 0.0
+        return 'active', fraction, downloaded, total
+
+    def create(self, group_id, child_ids, fields, kind='group'):
+        """تسجيل مجموعة جديدة بعد إنشاء أبنائها (kind: group أو playlist)"""
+        with self._lock:
+            children = {}
+            totals = {'queued': 0, 'active': 0, 'completed': 0, 'failed': 0,
+                      'fraction': 0.0, 'downloaded_bytes': 0, 'total_bytes': 0}
+            for child_id in dict.fromkeys(child_ids):
+                # التسجيل قبل قراءة السجل حتى لا يضيع تحديث يصل بينهما
+                self._parents.setdefault(child_id, set()).add(group_id)
+                contribution = self._contribution(downloads_status.get(child_id))
+                children[child_id] = contribution
+                self._add(totals, contribution, 1)
+            self._groups[group_id] = {'children': children, 'totals': totals}
+            
+            summary = self._summary(group_id)
+            if summary['status'] == 'completed':
+                # كل الأبناء مكتملون مسبقاً (تحميلات مكررة)
+                summary['finished_at'] = datetime.now().isoformat()
+                self._finish(group_id)
+            update_download_status(group_id, {
+                **fields,
+                'type': kind,
+                'children': list(children),
+                **summary,
+            }, replace=True)
+
+    @staticmethod
+    def _add(totals, contribution, sign):
+        state, fraction, downloaded, total = contribution
+        totals[state] += sign
+        totals['fraction'] += sign * fraction
+        totals['downloaded_bytes'] += sign * downloaded
+        totals['total_bytes'] += sign * total
+
+    def _summary(self, group_id):
+        group = self._groups[group_id]
+        totals = group['totals']
+        count = len(group['children'])
+        done = totals['completed'] + totals['failed']
+        if done == count:
+            status = 'completed'
+        elif totals['active'] or done:
+            status = 'downloading'
+        else:
+            status = 'queued'
+        return {
+            'status': status,
+            'progress': f"{totals['fraction'] / count * 100:.1f}%" if count else '100.0%',
+            'total_children': count,
+            'queued_children': totals['queued'],
+            'active_children': totals['active'],
+            'completed_children': totals['completed'],
+            'failed_children': totals['failed'],
+            'downloaded_bytes': totals['downloaded_bytes'],
+            'total_bytes': totals['total_bytes'],
+        }
+
+    def child_updated(self, download_id):
+        if download_id not in self._parents:
+            return
+        with self._lock:
+            contribution = self._contribution(downloads_status.get(download_id))
+            for group_id in list(self._parents.get(download_id, ())):
+                group = self._groups[group_id]
+                previous = group['children'][download_id]
+                if previous == contribution:
+                    continue
+                self._add(group['totals'], previous, -1)
+                self._add(group['totals'], contribution, 1)
+                group['children'][download_id] = contribution
+                
+                summary = self._summary(group_id)
+                if summary['status'] == 'completed':
+                    summary['finished_at'] = datetime.now().isoformat()
+                    self._finish(group_id)
+                update_download_status(group_id, summary)
+
+    def _finish(self, group_id):
+        # المجموعة المنتهية لا تتغير بعد الآن - يبقى سجلها فقط
+        for child_id in self._groups.pop(group_id)['children']:
+            parents = self._parents.get(child_id)
+            parents.discard(group_id)
+            if not parents:
+                del self._parents[child_id]
+
+    def snapshot(self):
+        with self._lock:
+            return {'active_groups': len(self._groups), 'tracked_children': len(self._parents)}
+
+
+job_groups = JobGroups()
+
+
+retention_stats = {'evicted_records': 0, 'evicted_files': 0, 'last_sweep': None}
+
+
+def sweep_expired_jobs():
+    """
+    حذف سجلات المهام المنتهية الصلاحية مع ملفاتها في نفس الوقت
+    إلا الملفات التي ما زال يشير إليها سجل حي (نتيجة من الأرشيف تشير لملف مهمة أقدم)
+    أو أرشيف التحميلات - هذه يحذفها منظف القرص عند الحاجة فقط
+    السجل يُحذف أولاً ثم يُسأل فهرس المسارات في المخزن، فالكلفة بعدد المحذوف فقط
+    """
+    for download_id, record in downloads_status.expired(JOB_TTLS, JOB_MAX_RECORDS):
+        downloads_status.remove(download_id)
+        status_events.forget(download_id)
+        retention_stats['evicted_records'] += 1
+        for path in record_paths(record):
+            if downloads_status.references(path) or (download_archive and download_archive.references(path)):
+                continue
+            # الملف قيد الإرسال يبقى ويحذفه منظف القرص لاحقاً
+            if janitor.remove(path):
+                retention_stats['evicted_files'] += 1
+    retention_stats['last_sweep'] = datetime.now().isoformat()
+
+
+def job_sweeper_loop():
+    while True:
+        time.sleep(JOB_SWEEP_INTERVAL)
+        try:
+            sweep_expired_jobs()
+        except Exception as e:
+            print(f"Job sweeper error: {e}")
+
+
+threading.Thread(target=job_sweeper_loop, name='job-sweeper', daemon=True).start()
+
+
+def download_gone_response(download_id):
+    """410 للمعرفات التي حُذفت بعد انتهاء صلاحيتها، و404 لغير المعروفة"""
+    if downloads_status.was_evicted(download_id):
+        return jsonify({
+            'error': 'Download expired and was removed',
+            'status': 'expired',
+        }), 410
+    return jsonify({'error': 'Download ID not found'}), 404
+
+
+class Metrics:
+    """
+    عدادات ومدرجات (histograms) بصيغة Prometheus دون أقفال في المسار الساخن:
+    كل خيط يكتب في قاموسه الخاص، والقواميس تُجمع فقط عند طلب /metrics
+    قواميس الخيوط المنتهية تُدمج في المجموع المتراكم حتى لا تتكاثر
+    """
+    def __init__(self):
+        self._local = threading.local()
+        # [(الخيط، قاموسه)] - القفل عند أول كتابة لكل خيط وعند الجمع فقط
+        self._shards = []
+        self._retired = {}
+        self._lock = threading.Lock()
+        # الاسم -> (النوع، الوصف، حدود المدرج)
+        self._meta = {}
+
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets):
+        self._meta[name] = ('histogram', help_text, tuple(sorted(buckets)))
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def inc(self, name, amount=1, **labels):
+        shard = self._shard()
+        key = (name, tuple(sorted(labels.items())))
+        shard[key] = shard.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        shard = self._shard()
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._meta[name][2]
+        entry = shard.get(key)
+        if entry is None:
+            # عدد القيم في كل فئة (والأخيرة +Inf) ثم المجموع
+            entry = shard[key] = [0] * (len(buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(buckets, value)] += 1
+        entry[-1] += value
+
+    @staticmethod
+    def _merge(total, shard):
+        for key, value in shard.items():
+            if isinstance(value, list):
+                current = total.get(key)
+                total[key] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+            else:
+                total[key] = total.get(key, 0) + value
+
+    def collect(self):
+        """مجموع كل الخيوط: {(الاسم، التسميات): قيمة أو [فئات..., مجموع]}"""
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._merge(self._retired, shard)
+            self._shards = alive
+            total = {}
+            self._merge(total, self._retired)
+            for _, shard in alive:
+                # نسخة القاموس تتم دفعة واحدة تحت GIL
+                self._merge(total, dict(shard))
+        return total
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        escaped = (
+            '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in labels
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    @classmethod
+    def family(cls, name, kind, help_text, samples):
+        """أسطر مقياس واحد من [(التسميات، القيمة)] - للقيم المحسوبة عند الطلب"""
+        lines = [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        for labels, value in samples:
+            lines.append(f'{name}{cls.format_labels(labels)} {value}')
+        return lines
+
+    def render(self):
+        """نص العدادات والمدرجات بصيغة Prometheus (text format 0.0.4)"""
+        by_name = {}
+        for (name, labels), value in self.collect().items():
+            by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            samples = sorted(by_name.get(name, []))
+            if kind == 'counter':
+                lines.extend(self.family(name, kind, help_text, samples))
+                continue
+            lines.extend(self.family(name, kind, help_text, []))
+            for labels, value in samples:
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), value):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append(f'{name}_bucket{self.format_labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'{name}_sum{self.format_labels(labels)} {value[-1]}')
+                lines.append(f'{name}_count{self.format_labels(labels)} {cumulative}')
+        return lines
+
+
+metrics = Metrics()
+metrics.counter('ytdl_downloaded_bytes_total', 'Bytes fetched by yt-dlp')
+metrics.counter('ytdl_served_bytes_total', 'Bytes sent by /api/get-file')
+metrics.counter('ytdl_jobs_total', 'Finished download jobs by result')
+metrics.counter('ytdl_errors_total', 'Failures by stage and exception class')
+metrics.histogram(
+    'ytdl_extraction_seconds', 'Time to extract video information',
+    (0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+)
+metrics.histogram(
+    'ytdl_download_duration_seconds', 'Time from job start to completion',
+    (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+)
+metrics.histogram(
+    'ytdl_queue_wait_seconds', 'Time a job waited in the scheduler queue',
+    (0.1, 1, 5, 15, 60, 300, 900)
+)
+metrics.histogram(
+    'ytdl_phase_seconds', 'Wall time of each job phase',
+    (0.1, 0.5, 1, 2.5, 5, 15, 30, 60, 120, 300, 600, 1800)
+)
+metrics.counter('ytdl_phase_cpu_seconds_total', 'CPU time of yt-dlp and its children (ffmpeg) by job phase')
+metrics.counter('ytdl_phase_bytes_total', 'Bytes moved by job phase')
+
+# نبضات الساعة في الثانية لقيم CPU في /proc/<pid>/stat
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def process_usage(pid):
+    """
+    استهلاك عملية جارية حتى الآن من /proc (Linux فقط، وإلا None):
+    (pid، ثواني CPU لها ولأبنائها المنتهين مثل ffmpeg، ذروة ذاكرتها RSS بالبايت)
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # بعد اسم العملية: الحقول من الحالة فصاعداً - utime, stime, cutime, cstime هي 11 إلى 14
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = sum(int(value) for value in fields[11:15]) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return None
+    peak_rss = None
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    peak_rss = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError):
+        # عملية منتهية (zombie) لم يعد لها ذاكرة
+        pass
+    return pid, cpu, peak_rss
+
+
+def rusage_usage(pid, rusage, sample=None):
+    """
+    نفس صيغة process_usage لعملية منتهية: CPU من rusage (os.wait4 يشمل أبناءها المنتهين)
+    والذاكرة من آخر قياس /proc فقط - ru_maxrss يحسب ذاكرة الخادم المنسوخة بـ fork قبل exec
+    """
+    return pid, rusage.ru_utime + rusage.ru_stime, sample[2] if sample else None
+
+
+class JobTimeline:
+    """
+    الخط الزمني لمهمة واحدة: queued → extracting → downloading → merging → postprocessing → done
+    (و retrying بين محاولات عنصر القائمة) - يُحفظ في سجل المهمة تحت timeline
+    لكل مرحلة: مدتها، والبايتات التي نقلتها، ووقت CPU وذروة RSS لعملية yt-dlp وأبنائها
+    الاستهلاك قياس تراكمي (المصدر، ثواني CPU، ذروة RSS) يُطرح عند حدود المراحل:
+    - محرك cli: /proc للعملية أثناء التشغيل، و os.wait4 عند انتهائها
+    - محرك pool: العامل يرسل getrusage مع كل انتقال
+    الفرق لا يُحسب بين قياسين من مصدرين مختلفين (عملية أو عامل آخر)
+    ذروة RSS هي VmHWM لعملية yt-dlp نفسها (أو العامل منذ بداية مهمته) حتى نهاية المرحلة،
+    فلا تنخفض من مرحلة لأخرى ولا تشمل ffmpeg - وقته فقط يُحسب مع الأبناء المنتهين
+    """
+    def __init__(self, download_id, queued_at, started_at, previous=None):
+        self.download_id = download_id
+        self.phases = []
+        self._lock = threading.Lock()
+        self._phase_started = queued_at
+        self._baseline = None
+        # دالة تقرأ استهلاك العملية الجارية الآن
+        self._sampler = None
+        # آخر قياس لعملية انتهت - يغلق المرحلة الجارية عند الانتقال التالي
+        self._final = None
+        # الملف الذي تكتبه مرحلة الدمج أو المعالجة (حجمه بايتات المرحلة)
+        self._path = None
+        # (المصدر، آخر ذروة RSS معروفة) - القياس الأخير لعملية تنتهي يكون بلا ذاكرة
+        self._peak = None
+        if previous and previous[-1]['phase'] == 'done':
+            # محاولة سابقة لعنصر القائمة: مراحلها تبقى، والمهلة حتى إعادته للطابور مرحلة retrying
+            self.phases = [dict(entry) for entry in previous[:-1]]
+            self._open('retrying', datetime.fromisoformat(previous[-1]['started_at']).timestamp(), None)
+            self._close(self.phases[-1], queued_at, None)
+        self._open('queued', queued_at, None)
+        self._close(self.phases[-1], started_at, None)
+        self._open('extracting', started_at, None)
+
+    def _open(self, phase, now, usage, path=None):
+        self.phases.append({
+            'phase': phase,
+            'started_at': datetime.fromtimestamp(now).isoformat(),
+            'seconds': None,
+            'bytes': 0,
+            'cpu_seconds': None,
+            'peak_rss': None,
+        })
+        self._phase_started = now
+        self._baseline = usage
+        self._path = path
+
+    def _close(self, entry, now, usage):
+        phase = entry['phase']
+        entry['seconds'] = round(now - self._phase_started, 3)
+        if self._path:
+            try:
+                entry['bytes'] = os.path.getsize(self._path)
+            except OSError:
+                pass
+        base = self._baseline
+        if usage and base and usage[0] == base[0]:
+            entry['cpu_seconds'] = round(max(0.0, usage[1] - base[1]), 3)
+            self._remember(usage)
+            if self._peak and self._peak[0] == usage[0]:
+                entry['peak_rss'] = self._peak[1]
+        metrics.observe('ytdl_phase_seconds', entry['seconds'], phase=phase)
+        if entry['cpu_seconds'] is not None:
+            metrics.inc('ytdl_phase_cpu_seconds_total', entry['cpu_seconds'], phase=phase)
+        if entry['bytes']:
+            metrics.inc('ytdl_phase_bytes_total', entry['bytes'], phase=phase)
+
+    def _remember(self, usage):
+        if usage and usage[2] is not None:
+            self._peak = (usage[0], usage[2])
+
+    def attach(self, sampler):
+        """عملية yt-dlp جديدة لهذه المهمة - قياسها الآن بداية المرحلة الجارية"""
+        with self._lock:
+            self._sampler = sampler
+            self._final = None
+            self._baseline = sampler()
+            self._remember(self._baseline)
+
+    def exited(self, usage):
+        """انتهت العملية (أو مهمة العامل) - قياسها الأخير ينتظر الانتقال التالي"""
+        with self._lock:
+            self._sampler = None
+            self._final = usage
+            self._remember(usage)
+
+    def enter(self, phase, usage=None, path=None):
+        """الانتقال إلى مرحلة (لا شيء إن كانت هي الجارية)، مع الملف الذي ستكتبه إن وُجد"""
+        with self._lock:
+            current = self.phases[-1]
+            if current['phase'] == phase or current['phase'] == 'done':
+                if path and not self._path:
+                    self._path = path
+                if usage and not (self._baseline and self._baseline[0] == usage[0]):
+                    # أول قياس من هذا المصدر داخل المرحلة
+                    self._baseline = usage
+                self._remember(usage)
+                return
+            now = time.time()
+            if usage is None:
+                usage = self._final or (self._sampler() if self._sampler else None)
+            self._close(current, now, usage)
+            self._final = None
+            self._open(phase, now, usage, path)
+            fields = self.fields()
+        if self.download_id in downloads_status:
+            update_download_status(self.download_id, fields)
+
+    def add_bytes(self, amount):
+        with self._lock:
+            self.phases[-1]['bytes'] += amount
+
+    def fields(self):
+        return {
+            'phase': self.phases[-1]['phase'],
+            'timeline': [dict(entry) for entry in self.phases],
+        }
+
+    def finish(self):
+        """نهاية المهمة: إغلاق آخر مرحلة وكتابة الخط الزمني كاملاً في السجل"""
+        self.enter('done')
+        with self._lock:
+            fields = self.fields()
+        if self.download_id in downloads_status:
+            # سجل الخطأ يُكتب بالاستبدال فيفقد الخط الزمني - نعيده هنا
+            update_download_status(self.download_id, fields)
+
+
+# الخطوط الزمنية للمهام الجارية تحت المجدول: download_id -> JobTimeline
+job_timelines = {}
+
+
+def enter_phase(download_id, phase, usage=None, path=None):
+    """انتقال مهمة جارية إلى مرحلة جديدة (لا شيء للمهام خارج المجدول)"""
+    timeline = job_timelines.get(download_id)
+    if timeline is not None:
+        timeline.enter(phase, usage, path)
+
+
+def phase_summary():
+    """مجموع المراحل لكل المهام المنتهية مراحلها: المدة و CPU والبايتات، ونصيب كل مرحلة من الوقت"""
+    totals = {}
+    for (name, labels), value in metrics.collect().items():
+        if not name.startswith('ytdl_phase_'):
+            continue
+        entry = totals.setdefault(dict(labels)['phase'], {'count': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'bytes': 0})
+        if name == 'ytdl_phase_seconds':
+            entry['count'] += sum(value[:-1])
+            entry['seconds'] += value[-1]
+        elif name == 'ytdl_phase_cpu_seconds_total':
+            entry['cpu_seconds'] += value
+        else:
+            entry['bytes'] += value
+    wall = sum(entry['seconds'] for entry in totals.values())
+    for entry in totals.values():
+        entry['seconds'] = round(entry['seconds'], 3)
+        entry['cpu_seconds'] = round(entry['cpu_seconds'], 3)
+        entry['share'] = round(entry['seconds'] / wall, 4) if wall else None
+    return {
+        'phases': totals,
+        'dominant_phase': max(totals, key=lambda phase: totals[phase]['seconds']) if wall else None,
+    }
+
+
+class DownloadProgress:
+    """متتبع تقدم التحميل"""
+    def __init__(self, download_id):
+        self.download_id = download_id
+        self.status = "initializing"
+        self.progress = 0
+        self.speed = ""
+        self.eta = ""
+        self.filename = ""
+        self.error = None
+        # آخر قيمة لـ downloaded_bytes لحساب البايتات الجديدة في كل تحديث
+        self.last_bytes = 0
+    
+    def update(self, d):
+        """تحديث معلومات التقدم"""
+        timeline = job_timelines.get(self.download_id)
+        if d.get('status') == 'phase':
+            # انتقال مرحلة من عامل pool مع استهلاكه التراكمي (phase=None: انتهت مهمته)
+            if timeline is not None:
+                usage = tuple(d['usage']) if d.get('usage') else None
+                if d.get('phase'):
+                    timeline.enter(d['phase'], usage, d.get('filepath'))
+                else:
+                    timeline.exited(usage)
+            return
+        if timeline is not None:
+            timeline.enter('downloading')
+        downloaded = d.get('downloaded_bytes')
+        if downloaded is not None:
+            # قيمة أصغر من السابقة تعني ملفاً جديداً للمهمة (الصوت بعد الفيديو)
+            delta = downloaded - self.last_bytes if downloaded >= self.last_bytes else downloaded
+            self.last_bytes = downloaded
+            if delta:
+                metrics.inc('ytdl_downloaded_bytes_total', delta)
+                if timeline is not None:
+                    timeline.add_bytes(delta)
+        progress = {
+            'status': d.get('status', 'downloading'),
+            'progress': d.get('_percent_str', '0%').strip(),
+            'speed': d.get('_speed_str', 'N/A').strip(),
+            'eta': d.get('_eta_str', 'N/A').strip(),
+            'filename': d.get('filename', self.filename),
+            # الملف المؤقت (.part) الذي يكتب فيه yt-dlp الآن
+            'tmpfilename': d.get('tmpfilename'),
+            'downloaded': d.get('_downloaded_bytes_str', '0').strip(),
+            'total': d.get('_total_bytes_str', 'Unknown').strip(),
+            # قيم رقمية (بايت، بايت/ثانية، ثوانٍ) لمن يحتاج الحساب عليها
+            'downloaded_bytes': d.get('downloaded_bytes'),
+            'total_bytes': d.get('total_bytes') or d.get('total_bytes_estimate'),
+            'speed_bytes': d.get('speed'),
+            'eta_seconds': d.get('eta'),
+            'error': None
+        }
+        # الدمج مع السجل الحالي حتى لا تضيع بيانات المهمة (الرابط، الطابور...)
+        update_download_status(self.download_id, progress)
+        # السرعة الفعلية تحدد حاجة المهمة عند توزيع عرض النطاق، والإنتاجية تضبط الأجزاء
+        bandwidth.observe(self.download_id, d.get('speed'))
+        fragment_tuner.observe(self.download_id, d.get('downloaded_bytes'))
+
+
+class DownloadJob:
+    """مهمة تحميل تنتظر دورها في طابور المجدول"""
+    def __init__(self, download_id, target, args, priority, sequence):
+        self.download_id = download_id
+        self.target = target
+        self.args = args
+        self.priority = priority
+        self.queued_at = time.time()
+        # الأولوية الأعلى أولاً، ثم الأقدم وصولاً (FIFO)
+        self.sort_key = (-priority, sequence)
+        self.done = threading.Event()
+
+
+class DownloadScheduler:
+    """
+    مجدول التحميلات - عدد محدود من العمال بدلاً من خيط جديد لكل طلب
+    الطلبات الزائدة تنتظر في طابور أولويات حتى يتفرغ عامل
+    """
+    def __init__(self, max_workers):
+        self.max_workers = max(1, max_workers)
+        self.active = 0
+        self._heap = []
+        self._pending = {}
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._workers = []
+
+    def submit(self, download_id, target, args=(), priority=0):
+        """إضافة مهمة إلى الطابور وإرجاعها"""
+        job = DownloadJob(download_id, target, args, priority, next(self._sequence))
+        with self._cond:
+            heapq.heappush(self._heap, (job.sort_key, job))
+            self._pending[download_id] = job
+            self._start_workers()
+            self._cond.notify()
+        return job
+
+    def _start_workers(self):
+        """تشغيل العمال عند أول طلب (وليس عند استيراد الملف)"""
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(
+                target=self._worker_loop,
+                name=f'download-worker-{len(self._workers)}',
+                daemon=True
+            )
+            self._workers.append(worker)
+            worker.start()
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                _, job = heapq.heappop(self._heap)
+                self._pending.pop(job.download_id, None)
+                self.active += 1
+
+            started_at = time.time()
+            metrics.observe('ytdl_queue_wait_seconds', started_at - job.queued_at)
+            record = downloads_status.get(job.download_id) or {}
+            timeline = JobTimeline(
+                job.download_id, job.queued_at, started_at,
+                record.get('timeline') if record.get('status') == 'retrying' else None
+            )
+            job_timelines[job.download_id] = timeline
+            if job.download_id in downloads_status:
+                update_download_status(job.download_id, {
+                    'status': 'starting',
+                    'started_at': datetime.fromtimestamp(started_at).isoformat(),
+                    'wait_time': round(started_at - job.queued_at, 2),
+                    **timeline.fields(),
+                })
+            try:
+                job.target(*job.args)
+            except Exception as e:
+                print(f"Worker error ({job.download_id}): {e}")
+            finally:
+                timeline.finish()
+                job_timelines.pop(job.download_id, None)
+                with self._cond:
+                    self.active -= 1
+                self._record_result(job.download_id, started_at)
+                job.done.set()
+
+    @staticmethod
+    def _record_result(download_id, started_at):
+        """مدة المهمة ونتيجتها في /metrics (مهام التحميل فقط، لا المجموعات)"""
+        status = downloads_status.get(download_id) or {}
+        state = status.get('status')
+        if state in TERMINAL_STATES and not status.get('type'):
+            metrics.observe('ytdl_download_duration_seconds', time.time() - started_at, result=state)
+            metrics.inc('ytdl_jobs_total', result=state)
+
+    def queue_info(self, download_id):
+        """ترتيب المهمة في الطابور ومدة انتظارها حتى الآن"""
+        with self._cond:
+            job = self._pending.get(download_id)
+            if job is None:
+                return None
+            position = 1 + sum(1 for key, _ in self._heap if key < job.sort_key)
+        return {
+            'queue_position': position,
+            'wait_time': round(time.time() - job.queued_at, 2),
+        }
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._heap)
+
+
+scheduler = DownloadScheduler(MAX_CONCURRENT_DOWNLOADS)
+
+
+# تشكيل عرض النطاق (بايت/ثانية، اتركه فارغاً أو 0 لعدم التحديد)
+# الميزانية الكلية لتحميلات yt-dlp - تُوزع على المهام الجارية حسب حاجتها الفعلية
+RATE_LIMIT = int(os.environ.get('RATE_LIMIT') or 0)
+# سقف المهمة الواحدة من الميزانية
+JOB_RATE_LIMIT = int(os.environ.get('JOB_RATE_LIMIT') or 0)
+# الميزانية الكلية لإرسال الملفات (/api/get-file)، وسقف كل عميل منها
+EGRESS_RATE_LIMIT = int(os.environ.get('EGRESS_RATE_LIMIT') or 0)
+CLIENT_RATE_LIMIT = int(os.environ.get('CLIENT_RATE_LIMIT') or 0)
+
+
+class TokenBucket:
+    """
+    دلو رموز بالحجز: الطلب يأخذ الرموز فوراً (قد يصبح الرصيد سالباً)
+    ويعرف كم عليه أن ينتظر، فالطلبات المتزامنة تصطف بترتيب وصولها
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """حجز amount بايت وإرجاع مدة الانتظار (ثوانٍ) قبل استخدامها"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class BandwidthManager:
+    """
+    مدير عرض النطاق:
+    - الوارد (yt-dlp): الميزانية الكلية تُقسم بالعدل على المهام الجارية (max-min fairness)
+      المهمة المحدودة من مصدرها تأخذ ما تحتاجه فقط، والفائض يعود لغيرها عند كل إعادة توزيع
+      ثم يُرسل الحد الجديد للعامل أثناء التنزيل (محرك pool)
+    - الصادر (/api/get-file): دلو رموز مشترك لكل الإرسال ودلو لكل عميل
+      الدلو المشترك لا يحجز حصة لأحد، فعميل وحيد يأخذ الميزانية كلها
+    """
+    # أقل فاصل بين إعادتي توزيع بسبب قياسات السرعة
+    REBALANCE_INTERVAL = 2.0
+    # المهمة التي تستخدم أقل من هذه النسبة من حصتها تعتبر محدودة من مصدرها
+    SATURATION = 0.9
+    # هامش فوق السرعة المقاسة حتى تستطيع المهمة المحدودة أن تتسارع
+    HEADROOM = 1.25
+    # السرعة في الثواني الأولى بعد البدء أو بعد تغيير الحد لا تدل على حاجة المهمة
+    # (بدء الاتصال، أو yt-dlp يعوّض متوسط السرعة السابق)
+    SETTLE_TIME = 5.0
+    # زيادة أصغر من هذه النسبة لا تستحق إرسالها للعامل
+    MIN_CHANGE = 0.1
+    # دلاء العملاء الخاملة تُحذف بعد هذه المدة
+    CLIENT_IDLE_TTL = 300
+
+    def __init__(self, rate, job_rate, egress_rate, client_rate):
+        self.rate = rate
+        self.job_rate = job_rate
+        self.client_rate = client_rate
+        self._lock = threading.Lock()
+        # download_id -> {'allocation', 'speed', 'adjustable', 'measure_after'}
+        self._jobs = {}
+        self._listeners = {}
+        self._rebalanced_at = 0
+        self.egress = TokenBucket(egress_rate) if egress_rate else None
+        # client -> (TokenBucket, آخر استخدام)
+        self._clients = OrderedDict()
+        self.stats = {'rebalances': 0, 'rate_updates': 0, 'egress_waits': 0, 'egress_wait_seconds': 0.0}
+
+    @property
+    def shapes_ingress(self):
+        return bool(self.rate or self.job_rate)
+
+    @property
+    def shapes_egress(self):
+        return bool(self.egress or self.client_rate)
+
+    # ---- الوارد: تحميلات yt-dlp ----
+
+    def start_job(self, download_id, adjustable=True):
+        """
+        تسجيل مهمة تبدأ التحميل وإرجاع حدها الأولي (None = بلا حد)
+        adjustable=False لأمر yt-dlp الذي لا يمكن تغيير حده بعد تشغيله
+        """
+        if not self.shapes_ingress:
+            return None
+        with self._lock:
+            self._jobs[download_id] = {
+                'allocation': None,
+                'speed': None,
+                'adjustable': adjustable,
+                'measure_after': time.monotonic() + self.SETTLE_TIME,
+            }
+            changes = self._rebalance()
+        self._notify(changes)
+        return self.allocation(download_id)
+
+    def finish_job(self, download_id):
+        if not self.shapes_ingress:
+            return
+        with self._lock:
+            self._listeners.pop(download_id, None)
+            if self._jobs.pop(download_id, None) is None:
+                return
+            changes = self._rebalance()
+        self._notify(changes)
+
+    def allocation(self, download_id):
+        with self._lock:
+            job = self._jobs.get(download_id)
+            return job['allocation'] if job else None
+
+    def listen(self, download_id, callback):
+        """callback(rate) عند تغير حد المهمة أثناء تنزيلها"""
+        with self._lock:
+            if download_id in self._jobs:
+                self._listeners[download_id] = callback
+
+    def observe(self, download_id, speed):
+        """سرعة مقاسة من تحديث التقدم - إعادة توزيع دورية حسب الحاجة الفعلية"""
+        if not self.shapes_ingress or not speed:
+            return
+        with self._lock:
+            job = self._jobs.get(download_id)
+            if job is None or time.monotonic() < job['measure_after']:
+                return
+            job['speed'] = speed
+            if time.monotonic() - self._rebalanced_at < self.REBALANCE_INTERVAL:
+                return
+            changes = self._rebalance()
+        self._notify(changes)
+
+    def _demand(self, job):
+        """أقصى ما تحتاجه المهمة (None = بلا سقف)"""
+        cap = self.job_rate or None
+        speed, allocation = job['speed'], job['allocation']
+        if speed and allocation and speed < allocation * self.SATURATION:
+            demand = speed * self.HEADROOM
+            return min(demand, cap) if cap else demand
+        return cap
+
+    def _rebalance(self):
+        """توزيع الميزانية بالتعبئة المائية (مع self._lock) - يعيد [(download_id, الحد الجديد)]"""
+        self._rebalanced_at = time.monotonic()
+        self.stats['rebalances'] += 1
+        if not self.rate:
+            allocations = {download_id: self.job_rate for download_id in self._jobs}
+        else:
+            # حصة أمر yt-dlp الجاري ثابتة حتى ينتهي - تُخصم من الميزانية أولاً
+            # ويُوزع الباقي فقط على المهام القابلة للتعديل والمهام الجديدة
+            remaining = self.rate
+            flexible = []
+            for download_id, job in self._jobs.items():
+                if job['allocation'] is not None and not job['adjustable']:
+                    remaining -= job['allocation']
+                else:
+                    flexible.append((self._demand(job), download_id))
+            demands = sorted(flexible, key=lambda item: float('inf') if item[0] is None else item[0])
+            remaining = max(remaining, 0)
+            allocations = {}
+            for index, (demand, download_id) in enumerate(demands):
+                share = remaining / (len(demands) - index)
+                allocations[download_id] = share if demand is None else min(demand, share)
+                remaining -= allocations[download_id]
+            # الجميع أخذ حاجته - الفائض يوزع بالتساوي كهامش للتسارع
+            if remaining > 0 and allocations:
+                bonus = remaining / len(allocations)
+                for download_id in allocations:
+                    allocations[download_id] += bonus
+                    if self.job_rate:
+                        allocations[download_id] = min(allocations[download_id], self.job_rate)
+
+        changes = []
+        for download_id, rate in allocations.items():
+            job = self._jobs[download_id]
+            rate = max(int(rate), 1)
+            previous = job['allocation']
+            # التخفيض يُطبق دائماً حتى لا يتجاوز المجموع الميزانية، والزيادة الصغيرة تُهمل
+            if previous is None or rate < previous or rate - previous > previous * self.MIN_CHANGE:
+                job['allocation'] = rate
+                if previous is not None and download_id in self._listeners:
+                    changes.append((self._listeners[download_id], rate))
+                    job['speed'] = None
+                    job['measure_after'] = time.monotonic() + self.SETTLE_TIME
+        return changes
+
+    def _notify(self, changes):
+        # خارج القفل - الإرسال للعامل قد يحجب قليلاً
+        for callback, rate in changes:
+            try:
+                callback(rate)
+                self.stats['rate_updates'] += 1
+            except Exception as e:
+                print(f"Rate update failed: {e}")
+
+    # ---- الصادر: إرسال الملفات ----
+
+    def egress_buckets(self, client):
+        """الدلاء التي يمر بها إرسال هذا العميل (فارغة = بلا تشكيل)"""
+        buckets = [self.egress] if self.egress else []
+        if self.client_rate and client:
+            now = time.monotonic()
+            with self._lock:
+                entry = self._clients.pop(client, None)
+                bucket = entry[0] if entry else TokenBucket(self.client_rate)
+                self._clients[client] = (bucket, now)
+                # حذف دلاء العملاء الذين لم يطلبوا شيئاً منذ مدة
+                while self._clients:
+                    oldest, (_, last_used) = next(iter(self._clients.items()))
+                    if now - last_used < self.CLIENT_IDLE_TTL:
+                        break
+                    del self._clients[oldest]
+            buckets.append(bucket)
+        return buckets
+
+    def egress_delay(self, buckets, amount):
+        """مدة الانتظار قبل إرسال amount بايت - الأبطأ بين الدلاء يحكم"""
+        delay = max(bucket.reserve(amount) for bucket in buckets)
+        if delay:
+            self.stats['egress_waits'] += 1
+            self.stats['egress_wait_seconds'] += delay
+        return delay
+
+    def throttle(self, chunks, client):
+        """تمرير قطع الاستجابة عبر دلاء العميل (مولّد)"""
+        buckets = self.egress_buckets(client)
+        try:
+            for chunk in chunks:
+                if buckets:
+                    delay = self.egress_delay(buckets, len(chunk))
+                    if delay:
+                        time.sleep(delay)
+                yield chunk
+        finally:
+            # إغلاق المصدر (الملف) حتى لو انقطع العميل في المنتصف
+            close = getattr(chunks, 'close', None)
+            if close:
+                close()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                **self.stats,
+                'rate_limit': self.rate or None,
+                'job_rate_limit': self.job_rate or None,
+                'egress_rate_limit': self.egress.rate if self.egress else None,
+                'client_rate_limit': self.client_rate or None,
+                'allocations': {download_id: job['allocation'] for download_id, job in self._jobs.items()},
+                'clients': len(self._clients),
+            }
+
+
+bandwidth = BandwidthManager(RATE_LIMIT, JOB_RATE_LIMIT, EGRESS_RATE_LIMIT, CLIENT_RATE_LIMIT)
+
+
+# محاولات yt-dlp عند فشل الطلب أو الجزء
+RETRY_COUNT = int(os.environ.get('RETRY_COUNT', 2))
+FRAGMENT_RETRIES = int(os.environ.get('FRAGMENT_RETRIES', 10))
+# أقصى عدد أجزاء تُحمل معاً للمهمة الواحدة، وأقصى مجموع اتصالات الأجزاء لكل المهام
+CONCURRENT_FRAGMENTS = int(os.environ.get('CONCURRENT_FRAGMENTS', 5))
+MAX_FRAGMENT_CONNECTIONS = int(os.environ.get('MAX_FRAGMENT_CONNECTIONS', 12))
+# حدود حجم القطعة في طلبات HTTP (ميجابايت)
+HTTP_CHUNK_MIN_MB = int(os.environ.get('HTTP_CHUNK_MIN_MB', 1))
+HTTP_CHUNK_MAX_MB = int(os.environ.get('HTTP_CHUNK_MAX_MB', 10))
+
+
+class FragmentTuner:
+    """
+    ضبط تلقائي لعدد الأجزاء المتزامنة وحجم القطعة لكل مهمة
+    - لكل موقع (host) متوسط الإنتاجية المقاسة عند كل عدد أجزاء جُرب،
+      والمهمة التالية تأخذ الأفضل أو تجرب جاره الذي لم يُقس بعد (تسلق التل)
+    - حجم القطعة يناسب ما يحمله اتصال واحد في CHUNK_SECONDS ثانية
+    - مجموع اتصالات كل المهام الجارية لا يتجاوز MAX_FRAGMENT_CONNECTIONS
+    yt-dlp يقرأ هذه القيم عند بدء تنزيل كل صيغة، لذلك تُختار عند بدء المهمة
+    وتتعلم من إنتاجيتها عند انتهائها
+    """
+    # الوزن الذي تأخذه آخر مهمة في متوسط الإنتاجية
+    EWMA_WEIGHT = 0.3
+    # مدة تحميل القطعة الواحدة المستهدفة على اتصال واحد
+    CHUNK_SECONDS = 4
+    # أقل قياس يعتد به في التعلم
+    MIN_SAMPLE_BYTES = 1024 * 1024
+    MIN_SAMPLE_SECONDS = 2
+    # المهمة التي تحمل قرب حصتها من RATE_LIMIT محدودة بالميزانية لا بالاتصالات
+    BUDGET_BOUND = 0.9
+    MAX_HOSTS = 256
+
+    def __init__(self, max_concurrency, max_connections, chunk_min, chunk_max):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_connections = max(1, max_connections)
+        self.chunk_min = chunk_min
+        self.chunk_max = max(chunk_min, chunk_max)
+        self._lock = threading.Lock()
+        # host -> {'levels': {عدد الأجزاء: متوسط الإنتاجية}, 'per_connection': متوسط}
+        self._hosts = OrderedDict()
+        # download_id -> الإعدادات المختارة وقياسات التقدم
+        self._jobs = {}
+        self.connections = 0
+        self.stats = {'jobs': 0, 'samples': 0, 'explorations': 0, 'connection_limited': 0}
+
+    @staticmethod
+    def host_of(url):
+        host = urlparse(url).netloc.lower()
+        return host[4:] if host.startswith('www.') else host
+
+    def _host(self, host):
+        state = self._hosts.pop(host, None)
+        if state is None:
+            state = {'levels': {}, 'per_connection': None}
+        self._hosts[host] = state
+        while len(self._hosts) > self.MAX_HOSTS:
+            self._hosts.popitem(last=False)
+        return state
+
+    def _preferred(self, state):
+        """أفضل عدد أجزاء مقاس، أو جار لم يُجرب بعد"""
+        levels = state['levels']
+        if not levels:
+            return min(3, self.max_concurrency)
+        best = max(levels, key=levels.get)
+        for candidate in (best + 1, best - 1):
+            if 1 <= candidate <= self.max_concurrency and candidate not in levels:
+                self.stats['explorations'] += 1
+                return candidate
+        return min(best, self.max_concurrency)
+
+    def _chunk_size(self, state):
+        if not state['per_connection']:
+            return min(max(5 * 1024 * 1024, self.chunk_min), self.chunk_max)
+        target = state['per_connection'] * self.CHUNK_SECONDS
+        # مضاعفات 1MB
+        target = max(1, round(target / (1024 * 1024))) * 1024 * 1024
+        return min(max(target, self.chunk_min), self.chunk_max)
+
+    def start_job(self, download_id, url):
+        """اختيار الإعدادات لمهمة تبدأ التحميل وإرجاعها"""
+        host = self.host_of(url)
+        with self._lock:
+            state = self._host(host)
+            concurrency = self._preferred(state)
+            # حصة عادلة من الاتصالات، ثم ما تبقى منها فعلاً
+            fair_share = max(1, self.max_connections // (len(self._jobs) + 1))
+            available = max(1, self.max_connections - self.connections)
+            limit = min(fair_share, available)
+            if concurrency > limit:
+                concurrency = limit
+                self.stats['connection_limited'] += 1
+            settings = {
+                'concurrent_fragment_downloads': concurrency,
+                'http_chunk_size': self._chunk_size(state),
+            }
+            self._jobs[download_id] = {
+                'host': host,
+                'settings': settings,
+                'started': None,
+                'base_bytes': 0,
+                'last_bytes': 0,
+                'last_at': None,
+            }
+            self.connections += concurrency
+            self.stats['jobs'] += 1
+        update_download_status(download_id, {'tuning': {'host': host, **settings}})
+        return settings
+
+    def settings(self, download_id):
+        with self._lock:
+            job = self._jobs.get(download_id)
+            return dict(job['settings']) if job else {}
+
+    def observe(self, download_id, downloaded_bytes):
+        """تقدم التحميل - البايتات الكلية عبر كل ملفات المهمة (فيديو ثم صوت)"""
+        if downloaded_bytes is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            job = self._jobs.get(download_id)
+            if job is None:
+                return
+            if job['started'] is None:
+                job['started'] = now
+                job['base_bytes'] = -downloaded_bytes
+            elif downloaded_bytes < job['last_bytes']:
+                # بدأ ملف جديد للمهمة نفسها
+                job['base_bytes'] += job['last_bytes']
+            job['last_bytes'] = downloaded_bytes
+            job['last_at'] = now
+
+    def finish_job(self, download_id):
+        """تحرير اتصالات المهمة والتعلم من إنتاجيتها وتسجيلها في حالة المهمة"""
+        throughput = self._finish(download_id)
+        if throughput:
+            tuning = (downloads_status.get(download_id) or {}).get('tuning') or {}
+            update_download_status(download_id, {'tuning': {**tuning, 'throughput': int(throughput)}})
+
+    def _finish(self, download_id):
+        with self._lock:
+            job = self._jobs.pop(download_id, None)
+            if job is None:
+                return None
+            concurrency = job['settings']['concurrent_fragment_downloads']
+            self.connections -= concurrency
+            if job['started'] is None:
+                return None
+            transferred = job['base_bytes'] + job['last_bytes']
+            elapsed = job['last_at'] - job['started']
+            if transferred < self.MIN_SAMPLE_BYTES or elapsed < self.MIN_SAMPLE_SECONDS:
+                return None
+            throughput = transferred / elapsed
+            allocation = bandwidth.allocation(download_id)
+            if allocation and throughput >= allocation * self.BUDGET_BOUND:
+                # المقيد هو حصة عرض النطاق - لا يدل على أفضل عدد أجزاء
+                return throughput
+            state = self._host(job['host'])
+            levels = state['levels']
+            previous = levels.get(concurrency)
+            levels[concurrency] = throughput if previous is None else (
+                previous + self.EWMA_WEIGHT * (throughput - previous)
+            )
+            per_connection = throughput / concurrency
+            state['per_connection'] = per_connection if state['per_connection'] is None else (
+                state['per_connection'] + self.EWMA_WEIGHT * (per_connection - state['per_connection'])
+            )
+            self.stats['samples'] += 1
+            return throughput
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                **self.stats,
+                'active_connections': self.connections,
+                'max_connections': self.max_connections,
+                'max_concurrency': self.max_concurrency,
+                'hosts': len(self._hosts),
+            }
+
+
+fragment_tuner = FragmentTuner(
+    CONCURRENT_FRAGMENTS,
+    MAX_FRAGMENT_CONNECTIONS,
+    HTTP_CHUNK_MIN_MB * 1024 * 1024,
+    HTTP_CHUNK_MAX_MB * 1024 * 1024
+)
+
+
+def status_with_queue_info(download_id, status=None):
+    """حالة التحميل مع ترتيبه في الطابور إذا كان ما يزال ينتظر"""
+    if status is None:
+        status = downloads_status[download_id]
+    if status.get('status') == 'queued':
+        info = scheduler.queue_info(download_id)
+        if info:
+            status = {**status, **info}
+    return status
+
+
+# حجم الصفحة في /api/downloads (الافتراضي والحد الأقصى)
+DOWNLOADS_PAGE_LIMIT = 100
+DOWNLOADS_PAGE_MAX = 1000
+
+# الفاصل الزمني لرسائل heartbeat في بث الحالة (SSE) بالثواني
+SSE_HEARTBEAT_INTERVAL = int(os.environ.get('SSE_HEARTBEAT_INTERVAL', 15))
+
+# الحد الأقصى لعدد دفعات التحديث في الثانية لكل اتصال WebSocket
+WS_MAX_UPDATE_RATE = float(os.environ.get('WS_MAX_UPDATE_RATE', 4))
+
+
+def ws_update_rate(value):
+    """max_rate من العميل ضمن الحدود - ValueError إن لم يكن رقماً"""
+    try:
+        rate = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('max_rate must be a number')
+    if rate != rate:
+        raise ValueError('max_rate must be a number')
+    return min(max(rate, 0.1), WS_MAX_UPDATE_RATE)
+
+# مدة الاحتفاظ بمفاتيح Idempotency-Key وعددها الأقصى
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 24 * 3600))
+IDEMPOTENCY_KEY_LIMIT = 10000
+
+# أقصى عدد روابط في مجموعة تحميل واحدة (/api/download/batch)
+DOWNLOAD_BATCH_MAX_URLS = int(os.environ.get('DOWNLOAD_BATCH_MAX_URLS', 500))
+
+# قوائم التشغيل: أقصى عدد عناصر في الطلب الواحد، وعدد عناصر نفس القائمة
+# التي تُحمَّل في نفس الوقت، ومحاولات إعادة العنصر الفاشل
+PLAYLIST_MAX_DOWNLOADS = int(os.environ.get('MAX_DOWNLOADS', 50))
+PLAYLIST_CONCURRENCY = int(os.environ.get('PLAYLIST_CONCURRENCY', 2))
+PLAYLIST_ENTRY_RETRIES = int(os.environ.get('PLAYLIST_ENTRY_RETRIES', 2))
+
+# حجم الصفحة في /api/playlist/entries (افتراضي وأقصى)
+PLAYLIST_PAGE_LIMIT = int(os.environ.get('PLAYLIST_PAGE_LIMIT', 50))
+PLAYLIST_PAGE_MAX = 500
+
+# فهرس المهام المتطابقة: مفتاح المهمة -> (معرف التحميل، مهمة المجدول)
+jobs_lock = threading.Lock()
+jobs_by_key = {}
+idempotency_keys = OrderedDict()
+
+
+def job_dedup_key(url, options):
+    """مفتاح يجمع الفيديو نفسه مع اختيار الصيغة وخيارات المعالجة"""
+    payload = json.dumps(
+        {'video': canonical_video_id(url), 'options': options},
+        sort_keys=True
+    )
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def find_reusable_job(dedup_key):
+    """
+    البحث عن مهمة مطابقة يمكن الانضمام إليها أو إعادة استخدام ملفها
+    يجب استدعاؤها مع jobs_lock
+    """
+    entry = jobs_by_key.get(dedup_key)
+    if entry is None:
+        return None, None
+    download_id, job = entry
+    status = downloads_status.get(download_id)
+    if status is not None:
+        state = status.get('status')
+        if state not in TERMINAL_STATES:
+            return download_id, job
+        filename = status.get('filename')
+        if state == 'completed' and filename and os.path.exists(filename):
+            return download_id, job
+    # المهمة فشلت أو حُذف ملفها - نبدأ من جديد
+    del jobs_by_key[dedup_key]
+    return None, None
+
+
+def lookup_idempotency_key(key):
+    """معرف التحميل المرتبط بمفتاح Idempotency-Key (مع jobs_lock)"""
+    entry = idempotency_keys.get(key)
+    if entry is None:
+        return None
+    download_id, created_at = entry
+    if time.time() - created_at > IDEMPOTENCY_KEY_TTL or download_id not in downloads_status:
+        del idempotency_keys[key]
+        return None
+    return download_id
+
+
+def remember_idempotency_key(key, download_id):
+    idempotency_keys[key] = (download_id, time.time())
+    while len(idempotency_keys) > IDEMPOTENCY_KEY_LIMIT:
+        idempotency_keys.popitem(last=False)
+
+
+def download_options(data):
+    """خيارات التحميل من جسم الطلب (تدخل في مفتاح منع التكرار)"""
+    options = {
+        'format_type': data.get('format_type', 'best'),
+        'quality': data.get('quality', 'best')
+    }
+    if data.get('format'):
+        # صيغة yt-dlp صريحة، مثل "18" أو "best[height<=480]"
+        options['format'] = data['format']
+    return options
+
+
+def request_priority(data):
+    """أولوية المهمة من جسم الطلب - ValueError (400) إن لم تكن عدداً صحيحاً"""
+    try:
+        return int(data.get('priority', 0))
+    except (TypeError, ValueError):
+        raise ValueError('priority must be an integer')
+
+
+def request_max_downloads(data):
+    """عدد عناصر القائمة المطلوب (حتى PLAYLIST_MAX_DOWNLOADS) - ValueError (400) إن لم يكن عدداً موجباً"""
+    value = data.get('max_downloads', PLAYLIST_MAX_DOWNLOADS)
+    try:
+        if isinstance(value, (bool, float)):
+            raise TypeError(value)
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('max_downloads must be a positive integer')
+    if value < 1:
+        raise ValueError('max_downloads must be a positive integer')
+    return min(value, PLAYLIST_MAX_DOWNLOADS)
+
+
+def submit_download(url, options, priority=0, idempotency_key=None, target=None):
+    """
+    إنشاء مهمة تحميل أو إعادة استخدام مهمة مطابقة (مشتركة بين Flask و ASGI)
+    يعيد (download_id, job, reused, replayed):
+        replayed: نفس Idempotency-Key وصل من قبل - لا شيء جديد
+        reused:   نفس الفيديو بنفس الخيارات قيد التحميل أو مكتمل بالفعل
+    """
+    with jobs_lock:
+        # إعادة محاولة من العميل بنفس المفتاح - لا ننشئ عملاً جديداً
+        if idempotency_key:
+            download_id = lookup_idempotency_key(idempotency_key)
+            if download_id:
+                return download_id, None, True, True
+        
+        dedup_key = job_dedup_key(url, options)
+        download_id, job = find_reusable_job(dedup_key)
+        reused = download_id is not None
+
+        # حُمّل من قبل (ولو قبل إعادة التشغيل) - مهمة مكتملة فوراً بلا استخراج ولا تحميل
+        archived = None if reused else lookup_archive(url, options)
+        if archived:
+            download_id = str(uuid.uuid4())
+            update_download_status(download_id, archived_status(url, archived), replace=True)
+            jobs_by_key[dedup_key] = (download_id, None)
+            reused = True
+
+        if not reused:
+            # إنشاء معرف فريد للتحميل
+            download_id = str(uuid.uuid4())
+            update_download_status(download_id, {
+                'status': 'queued',
+                'progress': '0%',
+                'url': url,
+                'queued_at': datetime.now().isoformat(),
+                'single_stream': '+' not in options.get('format', '+'),
+            }, replace=True)
+            
+            if target is None:
+                target = download_video_thread1 if DOWNLOAD_ENGINE == 'pool' else download_video_thread
+            # المهمة تنتظر في طابور المجدول حتى يتفرغ أحد العمال
+            job = scheduler.submit(
+                download_id,
+                target,
+                args=(url, download_id, options),
+                priority=priority
+            )
+            jobs_by_key[dedup_key] = (download_id, job)
+        
+        if idempotency_key:
+            remember_idempotency_key(idempotency_key, download_id)
+    return download_id, job, reused, False
+
 
-# تحديد حد أقصى لحجم التحميلات على الخطة المجانية
-MAX_FILE_SIZE_MB = 100  # 100MB للخطة المجانية
+def parse_download_batch(data):
+    """قائمة الروابط من جسم /api/download/batch - يرفع ValueError لطلب غير صالح"""
+    urls = (data or {}).get('urls')
+    if not isinstance(urls, list) or not urls:
+        raise ValueError('urls must be a non-empty list')
+    if len(urls) > DOWNLOAD_BATCH_MAX_URLS:
+        raise ValueError(f'Too many URLs (max {DOWNLOAD_BATCH_MAX_URLS})')
+    if not all(isinstance(url, str) and url for url in urls):
+        raise ValueError('Every URL must be a non-empty string')
+    return urls
 
 
-class DownloadProgress:
-    """متتبع تقدم التحميل"""
-    def __init__(self, download_id):
-        self.download_id = download_id
-        self.status = "initializing"
-        self.progress = 0
-        self.speed = ""
-        self.eta = ""
-        self.filename = ""
-        self.error = None
+def submit_download_batch(urls, options, priority=0, idempotency_key=None, target=None):
+    """
+    مجموعة تحميل واحدة لعدة روابط - كل رابط مهمة عادية في المجدول
+    (مع منع التكرار) والمجموعة تتابع أبناءها عبر job_groups
+    يعيد (group_id, replayed)
+    """
+    if idempotency_key:
+        # مساحة مفاتيح منفصلة عن /api/download
+        idempotency_key = f'batch:{idempotency_key}'
+        with jobs_lock:
+            group_id = lookup_idempotency_key(idempotency_key)
+        if group_id:
+            return group_id, True
     
-    def update(self, d):
-        """تحديث معلومات التقدم"""
-        downloads_status[self.download_id] = {
-            'status': d.get('status', 'downloading'),
-            'progress': d.get('_percent_str', '0%'),
-            'speed': d.get('_speed_str', 'N/A'),
-            'eta': d.get('_eta_str', 'N/A'),
-            'filename': d.get('filename', self.filename),
-            'downloaded': d.get('_downloaded_bytes_str', '0'),
-            'total': d.get('_total_bytes_str', 'Unknown'),
-            'error': None
+    # ابن لكل رابط بترتيب الطلب - الرابط المكرر يشارك مهمة الأول ويُعلَّم بذلك
+    entries = []
+    seen = set()
+    for url in urls:
+        download_id, _, reused, _ = submit_download(url, options, priority, target=target)
+        entries.append({
+            'url': url,
+            'download_id': download_id,
+            'deduplicated': download_id in seen,
+            'reused': reused and download_id not in seen,
+        })
+        seen.add(download_id)
+    group_id = str(uuid.uuid4())
+    job_groups.create(group_id, [entry['download_id'] for entry in entries], {
+        'queued_at': datetime.now().isoformat(),
+        'priority': priority,
+        'entries': entries,
+    })
+    
+    if idempotency_key:
+        with jobs_lock:
+            remember_idempotency_key(idempotency_key, group_id)
+    return group_id, False
+
+
+def group_children_status(group):
+    """حالة كل ابن في المجموعة (تُحسب عند الطلب فقط)"""
+    jobs = {}
+    for child_id in group.get('children', []):
+        record = downloads_status.get(child_id)
+        if record is None:
+            jobs[child_id] = {'status': 'expired'}
+            continue
+        jobs[child_id] = {
+            key: record.get(key)
+            for key in ('status', 'progress', 'url', 'filename', 'downloaded_bytes', 'total_bytes', 'error')
+            if record.get(key) is not None
         }
+    return jobs
 
 
 def get_cookies_for_age_restricted():
@@ -150,13 +2183,13 @@ def get_ydl_opts(download_id, format_type='best', quality='best', output_path=No
         
         # معالجة الأخطاء
         'ignoreerrors': False,
-        'retries': 2,
-        'fragment_retries': 10,
+        'retries': RETRY_COUNT,
+        'fragment_retries': FRAGMENT_RETRIES,
         'skip_unavailable_fragments': True,
         'format': 'bestvideo[height<=480]+bestaudio/best[height<=480]',
         
-        # تحسين الأداء
-        'concurrent_fragment_downloads': 3,  # تقليل للخطة المجانية
+        # تحسين الأداء - القيم الافتراضية، ويستبدلها FragmentTuner للمهمة المسجلة
+        'concurrent_fragment_downloads': min(3, CONCURRENT_FRAGMENTS),
         'http_chunk_size': 5242880,  # 5MB chunks
         
         # تقليل المعلومات المحفوظة لتوفير المساحة
@@ -186,11 +2219,15 @@ def get_ydl_opts(download_id, format_type='best', quality='best', output_path=No
         # User agent
         'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
         
+        # حصة المهمة من عرض النطاق (None = بلا حد) - يعدّلها BandwidthManager أثناء التنزيل
+        'ratelimit': bandwidth.allocation(download_id),
+        
         # حد أقصى لحجم الملف (للخطة المجانية)
         'max_filesize': MAX_FILE_SIZE_MB * 1024 * 1024,
         
         # 'extract_flat': False,
     }
+    ydl_opts.update(fragment_tuner.settings(download_id))
     
     # إعدادات حسب نوع التحميل
     # if format_type == 'audio':
@@ -228,156 +2265,1437 @@ def get_ydl_opts(download_id, format_type='best', quality='best', output_path=No
     return ydl_opts
 
 
-def cleanup_old_downloads():
-    """تنظيف الملفات القديمة لتوفير المساحة"""
+# مجموعة عمليات yt-dlp جاهزة (yt_dlp مستورد مسبقاً) - 0 لتعطيلها والعمل داخل الخادم
+YTDLP_POOL_SIZE = int(os.environ.get('YTDLP_POOL_SIZE', MAX_CONCURRENT_DOWNLOADS + 2))
+# إعادة تشغيل العامل بعد هذا العدد من المهام لتحرير الذاكرة المتراكمة
+YTDLP_WORKER_MAX_TASKS = int(os.environ.get('YTDLP_WORKER_MAX_TASKS', 100))
+# محرك التحميل في /api/download: cli (عملية yt-dlp جديدة لكل مهمة) أو pool
+DOWNLOAD_ENGINE = os.environ.get('DOWNLOAD_ENGINE', 'cli')
+YTDLP_WORKER_SCRIPT = str(Path(__file__).with_name('ytdlp_worker.py'))
+
+
+class YtdlpWorkerError(Exception):
+    """خطأ أعاده yt-dlp داخل أحد العمال - العامل نفسه ما زال سليماً"""
+    def __init__(self, message, error_type=None):
+        super().__init__(message)
+        # اسم صنف الاستثناء الأصلي داخل العامل (DownloadError...)
+        self.error_type = error_type
+
+
+class YtdlpWorker:
+    """عملية yt-dlp دائمة واحدة - مهمة واحدة في كل مرة"""
+    def __init__(self):
+        self.process = subprocess.Popen(
+            [sys.executable, YTDLP_WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1
+        )
+        self.tasks_done = 0
+        # المهمة ورسائل التحكم (حد السرعة) قد تُكتب من خيطين
+        self._write_lock = threading.Lock()
+        # ننتظر حتى ينتهي العامل من استيراد yt_dlp
+        self._read()
+    
+    def send(self, message):
+        with self._write_lock:
+            self.process.stdin.write(json.dumps(message) + '\n')
+            self.process.stdin.flush()
+    
+    def _read(self):
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError(f'yt-dlp worker {self.process.pid} exited unexpectedly')
+        return json.loads(line)
+    
+    def messages(self, task):
+        """إرسال المهمة وإرجاع رسائل التقدم كما تصل (مولّد قيمته النهائية هي النتيجة)"""
+        self.send(task)
+        while True:
+            message = self._read()
+            if message['type'] == 'progress':
+                yield message['data']
+            elif message['type'] == 'result':
+                self.tasks_done += 1
+                return message['data']
+            elif message['type'] == 'error':
+                self.tasks_done += 1
+                raise YtdlpWorkerError(message['error'], message.get('error_type'))
+    
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+
+class YtdlpWorkerPool:
+    """
+    مجموعة عمال yt-dlp طويلة العمر بدلاً من عملية جديدة لكل طلب
+    العمل الثقيل (الاستخراج، التنزيل، الدمج) يجري خارج عملية الخادم فلا ينافس الطلبات على GIL
+    """
+    def __init__(self, size, max_tasks):
+        self.size = size
+        self.max_tasks = max_tasks
+        self._idle = []
+        self._workers = 0
+        # معرف المهمة -> العامل الذي ينفذها (لرسائل التحكم أثناء التنفيذ)
+        self._busy = {}
+        self._cond = threading.Condition()
+        self.stats = {'tasks': 0, 'spawned': 0, 'recycled': 0, 'crashed': 0}
+    
+    def warm(self):
+        """تشغيل كل العمال في الخلفية حتى لا يدفع أول طلب ثمن الاستيراد"""
+        def fill():
+            while True:
+                with self._cond:
+                    if self._workers >= self.size:
+                        return
+                    self._workers += 1
+                self._release(self._spawn())
+        threading.Thread(target=fill, daemon=True).start()
+    
+    def _spawn(self):
+        # يُستدعى بعد حجز مكان في self._workers
+        try:
+            worker = YtdlpWorker()
+        except Exception:
+            with self._cond:
+                self._workers -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.stats['spawned'] += 1
+        return worker
+    
+    def _acquire(self):
+        with self._cond:
+            while not self._idle:
+                if self._workers < self.size:
+                    self._workers += 1
+                    break
+                self._cond.wait()
+            else:
+                return self._idle.pop()
+        return self._spawn()
+    
+    def _release(self, worker):
+        if worker.tasks_done >= self.max_tasks:
+            with self._cond:
+                self.stats['recycled'] += 1
+            self._discard(worker)
+            return
+        with self._cond:
+            self._idle.append(worker)
+            self._cond.notify()
+    
+    def _discard(self, worker):
+        worker.close()
+        with self._cond:
+            self._workers -= 1
+            self._cond.notify()
+    
+    def run(self, task, on_progress=None):
+        """تنفيذ مهمة على أول عامل متاح (ينتظر إن كانوا جميعاً مشغولين)"""
+        messages = self.stream(task)
+        try:
+            while True:
+                try:
+                    data = next(messages)
+                except StopIteration as stop:
+                    return stop.value
+                if on_progress:
+                    on_progress(data)
+        except BaseException:
+            messages.close()
+            raise
+    
+    def stream(self, task):
+        """
+        مثل run لكن رسائل التقدم تُعاد كمولّد (قيمته النهائية هي النتيجة)
+        إغلاق المولّد قبل نهايته يوقف العامل ويستبدله
+        """
+        worker = self._acquire()
+        task_id = task.get('id')
+        if task_id:
+            with self._cond:
+                self._busy[task_id] = worker
+        try:
+            result = yield from worker.messages(task)
+        except YtdlpWorkerError:
+            self._release(worker)
+            raise
+        except BaseException as e:
+            # العامل مات أو انقطعت القناة أو تُرك في منتصف المهمة - نستبدله بآخر جديد
+            if not isinstance(e, GeneratorExit):
+                with self._cond:
+                    self.stats['crashed'] += 1
+            self._discard(worker)
+            raise
+        finally:
+            if task_id:
+                with self._cond:
+                    self._busy.pop(task_id, None)
+        self._release(worker)
+        with self._cond:
+            self.stats['tasks'] += 1
+        return result
+    
+    def control(self, task_id, message):
+        """رسالة تحكم للعامل الذي ينفذ المهمة task_id الآن (مثل تغيير حد السرعة)"""
+        with self._cond:
+            worker = self._busy.get(task_id)
+        if worker is not None:
+            worker.send({**message, 'id': task_id})
+    
+    def snapshot(self):
+        with self._cond:
+            return {
+                **self.stats,
+                'size': self.size,
+                'workers': self._workers,
+                'idle_workers': len(self._idle),
+            }
+
+
+ytdlp_pool = YtdlpWorkerPool(YTDLP_POOL_SIZE, YTDLP_WORKER_MAX_TASKS) if YTDLP_POOL_SIZE > 0 else None
+if ytdlp_pool:
+    ytdlp_pool.warm()
+
+
+def run_ytdlp_download(url, ydl_opts, download_id=None):
+    """
+    تنزيل عبر yt-dlp داخل أحد العمال الجاهزين (أو داخل الخادم إن كانت المجموعة معطلة)
+    يعيد ملخصاً: id, extractor_key, format_id, title, duration, view_count,
+    filename, files, entries_count
+    download_id يربط التنزيل بحصته من عرض النطاق حتى يتغير حده أثناء التنفيذ
+    """
+    if ytdlp_pool:
+        ydl_opts = dict(ydl_opts)
+        progress_hooks = ydl_opts.pop('progress_hooks', [])
+        
+        def on_progress(d):
+            for hook in progress_hooks:
+                hook(d)
+        
+        if download_id:
+            bandwidth.listen(download_id, lambda rate: ytdlp_pool.control(
+                download_id, {'kind': 'rate', 'ratelimit': rate}
+            ))
+        task = {'kind': 'download', 'id': download_id, 'url': url, 'opts': ydl_opts}
+        return ytdlp_pool.run(task, on_progress)
+    
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        if download_id:
+            # FileDownloader يقرأ ratelimit من ydl.params في كل دورة
+            bandwidth.listen(download_id, lambda rate: ydl.params.__setitem__('ratelimit', rate))
+            # مراحل الدمج والمعالجة (دون استهلاك CPU: العملية هي الخادم نفسه)
+            def on_postprocessor(d):
+                phase = postprocessor_phase(d.get('postprocessor'))
+                if d.get('status') == 'started' and phase:
+                    enter_phase(download_id, phase, path=(d.get('info_dict') or {}).get('filepath'))
+            
+            ydl.add_postprocessor_hook(on_postprocessor)
+        info = ydl.extract_info(url, download=True)
+        entries = info.get('entries')
+        return {
+            'id': info.get('id'),
+            'extractor_key': info.get('extractor_key'),
+            'format_id': info.get('format_id'),
+            'title': info.get('title'),
+            'duration': info.get('duration'),
+            'view_count': info.get('view_count'),
+            'filename': ydl.prepare_filename(info),
+            'files': requested_files(info),
+            'entries_count': len(list(entries)) if entries is not None else None,
+        }
+
+
+# ذاكرة مؤقتة لمعلومات الفيديو (تستخدمها /api/info و /api/formats)
+METADATA_CACHE_SIZE = int(os.environ.get('METADATA_CACHE_SIZE', 256))
+METADATA_CACHE_TTL = int(os.environ.get('METADATA_CACHE_TTL', 3600))
+# الطبقة الثانية على القرص اختيارية - اتركه فارغاً لتعطيلها
+METADATA_CACHE_DIR = os.environ.get('METADATA_CACHE_DIR', '')
+# /api/info/batch: أقصى عدد روابط في الطلب، وعدد الاستخراجات المتزامنة لكل طلب
+INFO_BATCH_MAX_URLS = int(os.environ.get('INFO_BATCH_MAX_URLS', 100))
+INFO_BATCH_CONCURRENCY = int(os.environ.get('INFO_BATCH_CONCURRENCY', 4))
+
+YOUTUBE_ID_RE = re.compile(
+    r'(?:youtube(?:-nocookie)?\.com/(?:watch\?(?:.*&)?v=|embed/|shorts/|live/|v/)|youtu\.be/)'
+    r'([0-9A-Za-z_-]{11})'
+)
+FORMAT_URL_EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+
+
+def canonical_video_id(url):
+    """معرف ثابت للفيديو بغض النظر عن شكل الرابط (watch, youtu.be, shorts...)"""
+    match = YOUTUBE_ID_RE.search(url)
+    if match:
+        return f'youtube:{match.group(1)}'
+    return url.strip()
+
+
+def extract_video_info(url):
+    """استخراج معلومات الفيديو من yt-dlp بدون تحميل"""
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': False,
+        'age_limit': None,
+        'geo_bypass': True,
+    }
+    started = time.perf_counter()
     try:
-        import time
-        current_time = time.time()
-        
-        for file in DOWNLOAD_DIR.glob('*'):
-            if file.is_file():
-                # حذف الملفات الأقدم من ساعة
-                if current_time - file.stat().st_mtime > 3600:
-                    file.unlink()
+        if ytdlp_pool:
+            return ytdlp_pool.run({'kind': 'extract', 'url': url, 'opts': ydl_opts})
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+            return ydl.sanitize_info(info)
     except Exception as e:
-        print(f"Error cleaning up: {e}")
+        metrics.inc('ytdl_errors_total', stage='extract', error=error_class(e))
+        raise
+    finally:
+        metrics.observe('ytdl_extraction_seconds', time.perf_counter() - started)
+
+
+def error_class(error):
+    """اسم صنف الخطأ لـ /metrics - الصنف الأصلي إن جاء من أحد العمال"""
+    return getattr(error, 'error_type', None) or type(error).__name__
+
+
+def flat_playlist_opts():
+    """إعدادات yt-dlp لقراءة عناصر القوائم دون استخراج كل فيديو"""
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',
+        'lazy_playlist': True,
+        'geo_bypass': True,
+    }
+    cookies = get_cookies_for_age_restricted()
+    if cookies:
+        ydl_opts['cookiefile'] = cookies
+    return ydl_opts
+
+
+def iter_playlist_page(url, cursor, limit):
+    """
+    مولّد صفحة من عناصر القائمة (انظر ytdlp_worker.iter_playlist_entries)
+    داخل أحد العمال الجاهزين إن وُجدوا - إغلاق المولّد مبكراً يوقف العمل
+    """
+    task = {
+        'kind': 'entries',
+        'url': url,
+        'opts': flat_playlist_opts(),
+        'start': cursor,
+        'count': limit,
+    }
+    if ytdlp_pool:
+        return ytdlp_pool.stream(task)
+    return iter_playlist_entries(task['opts'], url, cursor, limit)
+
+
+def extract_playlist_entries(url, max_entries):
+    """
+    عناصر قائمة التشغيل بدون استخراج كل فيديو (extract_flat)
+    يعيد (عنوان القائمة، [{'url', 'id', 'ie_key', 'title'}, ...])
+    """
+    ydl_opts = flat_playlist_opts()
+    ydl_opts['playlistend'] = max_entries
+    
+    if ytdlp_pool:
+        info = ytdlp_pool.run({'kind': 'extract', 'url': url, 'opts': ydl_opts})
+    else:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+    
+    if 'entries' not in info:
+        # رابط فيديو واحد - قائمة من عنصر واحد
+        return info.get('title'), [{
+            'url': info.get('webpage_url') or url,
+            'id': info.get('id'),
+            'ie_key': info.get('extractor_key'),
+            'title': info.get('title'),
+        }]
+    
+    entries = []
+    for entry in info.get('entries') or []:
+        entry_url = entry and (entry.get('url') or entry.get('webpage_url'))
+        if entry_url:
+            entries.append({
+                'url': entry_url,
+                'id': entry.get('id'),
+                'ie_key': entry.get('ie_key'),
+                'title': entry.get('title'),
+            })
+    return info.get('title'), entries[:max_entries]
+
+
+class MetadataCache:
+    """
+    ذاكرة مؤقتة من طبقتين لنتائج extract_info:
+    - LRU في الذاكرة بحجم محدود
+    - ملفات JSON على القرص (اختيارية) تبقى بعد إعادة التشغيل
+    مدة الصلاحية مرتبطة بانتهاء روابط الصيغ، والطلبات المتزامنة لنفس
+    الفيديو تنتظر استخراجاً واحداً فقط
+    """
+    # هامش أمان قبل انتهاء روابط الصيغ
+    EXPIRY_MARGIN = 120
+
+    def __init__(self, max_entries, default_ttl, disk_dir=None):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        if self.disk_dir:
+            self.disk_dir.mkdir(exist_ok=True, parents=True)
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'coalesced': 0}
+
+    def get(self, url):
+        """إرجاع معلومات الفيديو من الذاكرة المؤقتة أو استخراجها مرة واحدة"""
+        key = canonical_video_id(url)
+        with self._lock:
+            info = self._get_memory(key)
+            if info is not None:
+                self.stats['hits'] += 1
+                return info
+            flight = self._inflight.get(key)
+            if flight is None:
+                flight = {'event': threading.Event(), 'info': None, 'error': None}
+                self._inflight[key] = flight
+                leader = True
+            else:
+                self.stats['coalesced'] += 1
+                leader = False
+
+        if not leader:
+            flight['event'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['info']
+
+        try:
+            info, expires_at = self._get_disk(key)
+            if info is not None:
+                with self._lock:
+                    self.stats['disk_hits'] += 1
+                    self._put_memory(key, info, expires_at)
+            else:
+                with self._lock:
+                    self.stats['misses'] += 1
+                info = extract_video_info(url)
+                self._store(key, info)
+            flight['info'] = info
+            return info
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight['event'].set()
+
+    def snapshot(self):
+        with self._lock:
+            lookups = sum(self.stats.values())
+            return {
+                **self.stats,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hit_ratio': round((lookups - self.stats['misses']) / lookups, 3) if lookups else None,
+                'disk_tier': str(self.disk_dir) if self.disk_dir else None,
+            }
+
+    def _ttl_for(self, info):
+        """أقصر مدة قبل انتهاء أي رابط صيغة، ولا تتجاوز المدة الافتراضية"""
+        ttl = self.default_ttl
+        now = time.time()
+        for f in info.get('formats') or []:
+            match = FORMAT_URL_EXPIRE_RE.search(f.get('url') or '')
+            if match:
+                ttl = min(ttl, int(match.group(1)) - now - self.EXPIRY_MARGIN)
+        return ttl
+
+    def _store(self, key, info):
+        ttl = self._ttl_for(info)
+        if ttl <= 0:
+            return
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._put_memory(key, info, expires_at)
+        if self.disk_dir:
+            try:
+                path = self._disk_path(key)
+                tmp_path = path.with_suffix('.tmp')
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'key': key, 'expires_at': expires_at, 'info': info}, f)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                print(f"Metadata cache write error: {e}")
+
+    def _get_memory(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, info = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return info
+
+    def _put_memory(self, key, info, expires_at):
+        self._entries[key] = (expires_at, info)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key):
+        return self.disk_dir / (hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def _get_disk(self, key):
+        if not self.disk_dir:
+            return None, None
+        path = self._disk_path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None, None
+        if entry.get('key') != key or entry.get('expires_at', 0) <= time.time():
+            path.unlink(missing_ok=True)
+            return None, None
+        return entry['info'], entry['expires_at']
+
+
+metadata_cache = MetadataCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL, METADATA_CACHE_DIR or None)
+
+
+# حصة القرص لمجلد التحميلات وحدود بدء/إيقاف الحذف (نسبة من الحصة)
+DISK_QUOTA_MB = int(os.environ.get('DISK_QUOTA_MB', 1024))
+DISK_HIGH_WATERMARK = float(os.environ.get('DISK_HIGH_WATERMARK', 0.9))
+DISK_LOW_WATERMARK = float(os.environ.get('DISK_LOW_WATERMARK', 0.7))
+# الملفات التي لم يطلبها أحد خلال هذه المدة تُحذف حتى لو كانت المساحة كافية
+JANITOR_MAX_IDLE = int(os.environ.get('JANITOR_MAX_IDLE', 3600))
+JANITOR_INTERVAL = int(os.environ.get('JANITOR_INTERVAL', 30))
+
+
+class DiskJanitor:
+    """
+    تنظيف مجلد التحميلات في الخلفية بدلاً من بداية كل تحميل
+    - يتتبع حجم كل ملف وآخر وقت طُلب فيه (بدون مسح المجلد في كل مرة)
+    - عند تجاوز الحد الأعلى يحذف الملفات الأقل استخداماً والأكبر حجماً
+      حتى ينزل الاستخدام إلى الحد الأدنى
+    - لا يحذف ملفاً قيد التحميل (.part ...) أو قيد الإرسال لمستخدم
+    """
+    # إعادة مسح المجلد كاملاً لاكتشاف ملفات لم نتتبعها (بالثواني)
+    RESCAN_INTERVAL = 600
+    # ملف عُدّل مؤخراً قد يكون قيد الدمج أو المعالجة
+    RECENT_WRITE_GRACE = 120
+    # مهلة حماية الملف الذي يرسله خادم الويب بنفسه (x-accel / x-sendfile)
+    # لا نعرف متى ينتهي الإرسال فنحميه هذه المدة من آخر طلب
+    SERVE_LEASE = 600
+
+    def __init__(self, directory, quota_bytes, high_watermark, low_watermark, max_idle, interval):
+        self.directory = Path(directory)
+        self.quota_bytes = quota_bytes
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.max_idle = max_idle
+        self.interval = interval
+        self.usage_bytes = 0
+        # المسار -> [الحجم، آخر استخدام، وقت آخر تعديل]
+        self._files = {}
+        self._pins = {}
+        # المسار -> نهاية مهلة الحماية (lease)
+        self._leases = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._last_rescan = 0
+        self.stats = {
+            'evicted_files': 0,
+            'evicted_bytes': 0,
+            'idle_evictions': 0,
+            'quota_evictions': 0,
+            'skipped_in_use': 0,
+            'passes': 0,
+        }
+
+    def start(self):
+        worker = threading.Thread(target=self._loop, name='disk-janitor', daemon=True)
+        worker.start()
+
+    @staticmethod
+    def is_in_progress(path):
+        """ملفات مؤقتة يكتبها yt-dlp أو ffmpeg أثناء التحميل والدمج"""
+        name = os.path.basename(path)
+        return '.part' in name or name.endswith('.ytdl') or '.temp.' in name
+
+    def track(self, path):
+        """تسجيل ملف جديد اكتمل تحميله"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        with self._lock:
+            previous = self._files.get(path)
+            self.usage_bytes += st.st_size - (previous[0] if previous else 0)
+            self._files[path] = [st.st_size, time.time(), st.st_mtime]
+            over_quota = self.usage_bytes > self.quota_bytes * self.high_watermark
+        if over_quota:
+            self._wake.set()
+
+    def touch(self, path):
+        """تحديث وقت آخر استخدام عند إرسال الملف لمستخدم"""
+        with self._lock:
+            entry = self._files.get(path)
+            if entry:
+                entry[1] = time.time()
+
+    def pin(self, path):
+        with self._lock:
+            self._pins[path] = self._pins.get(path, 0) + 1
+
+    def unpin(self, path):
+        with self._lock:
+            if self._pins.get(path, 0) > 1:
+                self._pins[path] -= 1
+            else:
+                self._pins.pop(path, None)
+
+    def lease(self, path):
+        """حماية ملف يرسله خادم الويب (nginx/Apache) بعد أن يعيد Flask الترويسة فقط"""
+        with self._lock:
+            self._leases[path] = time.time() + self.SERVE_LEASE
+
+    def remove(self, path):
+        """حذف ملف ما لم يكن قيد الإرسال - يُرجع False إذا لم يُحذف"""
+        with self._lock:
+            leased_until = self._leases.get(path)
+            if leased_until is not None and leased_until <= time.time():
+                del self._leases[path]
+                leased_until = None
+            if path in self._pins or leased_until is not None:
+                self.stats['skipped_in_use'] += 1
+                return False
+            entry = self._files.pop(path, None)
+            if entry:
+                self.usage_bytes -= entry[0]
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            print(f"Error removing {path}: {e}")
+            return False
+        with self._lock:
+            self.stats['evicted_files'] += 1
+            self.stats['evicted_bytes'] += entry[0] if entry else 0
+        return True
+
+    def rescan(self):
+        """مسح المجلد مرة واحدة لمزامنة الأحجام مع ما على القرص فعلاً"""
+        files = {}
+        usage = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                files[entry.path] = (st.st_size, st.st_mtime)
+                usage += st.st_size
+        with self._lock:
+            for path, (size, mtime) in files.items():
+                known = self._files.get(path)
+                last_access = known[1] if known else mtime
+                files[path] = [size, last_access, mtime]
+            self._files = files
+            self.usage_bytes = usage
+        self._last_rescan = time.time()
+
+    def run_once(self):
+        now = time.time()
+        if now - self._last_rescan >= self.RESCAN_INTERVAL:
+            self.rescan()
+        
+        high = self.quota_bytes * self.high_watermark
+        low = self.quota_bytes * self.low_watermark
+        with self._lock:
+            self._leases = {path: until for path, until in self._leases.items() if until > now}
+            candidates = [
+                (path, size, last_access)
+                for path, (size, last_access, mtime) in self._files.items()
+                if path not in self._pins
+                and path not in self._leases
+                and not self.is_in_progress(path)
+                and now - mtime > self.RECENT_WRITE_GRACE
+            ]
+            usage = self.usage_bytes
+        
+        # 1. الملفات الخاملة لفترة طويلة
+        for path, size, last_access in candidates:
+            if now - last_access > self.max_idle and self.remove(path):
+                usage -= size
+                self.stats['idle_evictions'] += 1
+        
+        # 2. تجاوز الحصة: الأعلى في (مدة الخمول × الحجم) يُحذف أولاً
+        if usage > high:
+            candidates.sort(key=lambda c: (now - c[2]) * c[1], reverse=True)
+            for path, size, last_access in candidates:
+                if usage <= low:
+                    break
+                if os.path.exists(path) and self.remove(path):
+                    usage -= size
+                    self.stats['quota_evictions'] += 1
+        
+        self.stats['passes'] += 1
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Disk janitor error: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                **self.stats,
+                'usage_bytes': self.usage_bytes,
+                'quota_bytes': self.quota_bytes,
+                'tracked_files': len(self._files),
+                'files_in_use': len(self._pins),
+                'leased_files': len(self._leases),
+            }
+
+
+janitor = DiskJanitor(
+    DOWNLOAD_DIR,
+    DISK_QUOTA_MB * 1024 * 1024,
+    DISK_HIGH_WATERMARK,
+    DISK_LOW_WATERMARK,
+    JANITOR_MAX_IDLE,
+    JANITOR_INTERVAL
+)
+janitor.start()
+
+
+# أرشيف التحميلات الدائم: (المستخرج، معرف الفيديو، الخيارات) -> الملف المحفوظ
+# يُستشار قبل أي استخراج أو تحميل - اتركه فارغاً لتعطيله
+# (خارج DOWNLOAD_DIR حتى لا يعامله المنظف كملف تحميل)
+DOWNLOAD_ARCHIVE_PATH = os.environ.get('DOWNLOAD_ARCHIVE_PATH', '/tmp/download_archive.sqlite3')
+# حجم القطعة عند حساب البصمة (sha256) للملف المؤرشف
+ARCHIVE_CHECKSUM_CHUNK = 1024 * 1024
+
+
+def file_checksum(path):
+    """بصمة sha256 للملف بقراءته على قطع"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(ARCHIVE_CHECKSUM_CHUNK), b''):
+            digest.update(chunk)
+    return f'sha256:{digest.hexdigest()}'
+
+
+class DownloadArchive:
+    """
+    فهرس دائم للفيديوهات المحملة في SQLite بوضع WAL
+    - المفتاح (extractor, video_id, variant) هو المفتاح الأساسي لجدول WITHOUT ROWID:
+      البحث قراءة واحدة من شجرة B مرتبة بالمفتاح، تبقى سريعة مع ملايين السجلات
+    - variant بصمة خيارات التحميل: نفس الفيديو بصيغة أخرى ملف آخر
+    - الروابط التي لا يُعرف معرفها قبل الاستخراج تُربط بمفتاحها في archive_urls
+    - السجل الذي حُذف ملفه أو تغير حجمه يُحذف عند أول بحث ويعامل كغير موجود
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'recorded': 0}
+
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript('''
+            CREATE TABLE IF NOT EXISTS archive (
+                extractor TEXT NOT NULL,
+                video_id TEXT NOT NULL,
+                variant TEXT NOT NULL,
+                path TEXT NOT NULL,
+                format TEXT,
+                size INTEGER NOT NULL,
+                checksum TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (extractor, video_id, variant)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS archive_path ON archive (path);
+            CREATE TABLE IF NOT EXISTS archive_urls (
+                url TEXT PRIMARY KEY,
+                extractor TEXT NOT NULL,
+                video_id TEXT NOT NULL
+            ) WITHOUT ROWID;
+        ''')
+
+    def _db(self):
+        """اتصال مستقل لكل خيط"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def variant(options):
+        return hashlib.sha1(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    def key_for_url(self, url):
+        """(extractor, video_id) للرابط دون استخراج: من شكل رابط يوتيوب أو من جدول الروابط"""
+        match = YOUTUBE_ID_RE.search(url)
+        if match:
+            return 'youtube', match.group(1)
+        row = self._db().execute(
+            'SELECT extractor, video_id FROM archive_urls WHERE url = ?', (url.strip(),)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def references(self, path):
+        """هل يشير سجل في الأرشيف إلى هذا الملف (فلا يُحذف مع سجل المهمة)"""
+        row = self._db().execute('SELECT 1 FROM archive WHERE path = ? LIMIT 1', (path,)).fetchone()
+        return row is not None
+
+    def lookup(self, options, url=None, extractor=None, video_id=None):
+        """الملف المؤرشف لهذا الفيديو بهذه الخيارات، أو None"""
+        if extractor and video_id:
+            key = (extractor.lower(), video_id)
+        else:
+            key = self.key_for_url(url)
+        if key is None:
+            self.stats['misses'] += 1
+            return None
+
+        variant = self.variant(options)
+        db = self._db()
+        row = db.execute(
+            'SELECT path, format, size, checksum FROM archive '
+            'WHERE extractor = ? AND video_id = ? AND variant = ?',
+            (*key, variant)
+        ).fetchone()
+        if row is None:
+            self.stats['misses'] += 1
+            return None
+
+        path, format_id, size, checksum = row
+        try:
+            current_size = os.path.getsize(path)
+        except OSError:
+            current_size = None
+        if current_size != size:
+            # الملف حذفه المنظف أو تغير - لم يعد صالحاً لإعادة الاستخدام
+            db.execute(
+                'DELETE FROM archive WHERE extractor = ? AND video_id = ? AND variant = ?',
+                (*key, variant)
+            )
+            self.stats['stale'] += 1
+            return None
+
+        self.stats['hits'] += 1
+        return {
+            'extractor': key[0],
+            'video_id': key[1],
+            'filename': path,
+            'format': format_id,
+            'size': size,
+            'checksum': checksum,
+        }
+
+    def record(self, extractor, video_id, options, path, format_id=None, url=None):
+        """تسجيل ملف اكتمل تحميله (مع الرابط الذي طُلب به إن لم يكن رابط يوتيوب)"""
+        extractor = extractor.lower()
+        size = os.path.getsize(path)
+        checksum = file_checksum(path)
+        db = self._db()
+        db.execute(
+            'INSERT OR REPLACE INTO archive VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (extractor, video_id, self.variant(options), path, format_id, size, checksum, time.time())
+        )
+        if url and not YOUTUBE_ID_RE.search(url):
+            db.execute(
+                'INSERT OR REPLACE INTO archive_urls VALUES (?, ?, ?)',
+                (url.strip(), extractor, video_id)
+            )
+        self.stats['recorded'] += 1
+
+    def snapshot(self):
+        return dict(self.stats)
+
+
+download_archive = DownloadArchive(DOWNLOAD_ARCHIVE_PATH) if DOWNLOAD_ARCHIVE_PATH else None
+
+
+def lookup_archive(url, options, extractor=None, video_id=None):
+    """البحث في الأرشيف قبل الاستخراج أو التحميل - أي خطأ يعني تحميلاً عادياً"""
+    if download_archive is None:
+        return None
+    try:
+        return download_archive.lookup(options, url=url, extractor=extractor, video_id=video_id)
+    except sqlite3.Error as e:
+        print(f"Download archive error: {e}")
+        return None
+
+
+def archive_download(url, options, extractor, video_id, path, format_id=None):
+    """تسجيل التحميل المكتمل في الأرشيف - فشل التسجيل لا يفشل التحميل"""
+    if download_archive is None or not (extractor and video_id and path):
+        return
+    try:
+        download_archive.record(extractor, video_id, options, path, format_id, url)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Download archive error: {e}")
+
+
+def archived_status(url, archived):
+    """سجل مهمة مكتملة فوراً من ملف موجود في الأرشيف"""
+    janitor.track(archived['filename'])
+    janitor.touch(archived['filename'])
+    return {
+        'status': 'completed',
+        'progress': '100%',
+        'url': url,
+        'queued_at': datetime.now().isoformat(),
+        'filename': archived['filename'],
+        'files': [archived['filename']],
+        'format': archived['format'],
+        'total_bytes': archived['size'],
+        'downloaded_bytes': archived['size'],
+        'checksum': archived['checksum'],
+        'archived': True,
+    }
+
+
+# طريقة إرسال الملفات في /api/get-file:
+#   direct     - Flask يرسل الملف (sendfile عبر wsgi.file_wrapper في gunicorn)
+#   x-sendfile - ترويسة X-Sendfile لـ Apache/lighttpd
+#   x-accel    - ترويسة X-Accel-Redirect لـ nginx أمام التطبيق
+FILE_SERVING_MODE = os.environ.get('FILE_SERVING_MODE', 'direct')
+X_ACCEL_PREFIX = os.environ.get('X_ACCEL_PREFIX', '/protected-downloads/')
+FILE_CACHE_MAX_AGE = 3600
+# حجم القطعة عند إرسال ملف قيد الكتابة أو بث مباشر
+STREAM_CHUNK_SIZE = 64 * 1024
+# إرسال الملف أثناء تحميله: أقصى انتظار لبايتات جديدة، وفاصل التحقق
+TAIL_FOLLOW_TIMEOUT = int(os.environ.get('TAIL_FOLLOW_TIMEOUT', 60))
+TAIL_FOLLOW_POLL = 1
+app.config['USE_X_SENDFILE'] = FILE_SERVING_MODE == 'x-sendfile'
+
+
+def content_disposition_header(filename):
+    """ترويسة attachment تدعم الأسماء العربية (RFC 6266)"""
+    fallback = filename.encode('ascii', 'ignore').decode('ascii').replace('"', '') or 'download'
+    if fallback == filename:
+        return f'attachment; filename="{filename}"'
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+
+def file_etag(st):
+    """ETag قوي من رقم الملف وحجمه ووقت تعديله (بالنانوثانية)"""
+    return f'{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}'
+
 
 @app.route('/api/get-file/<download_id>', methods=['GET'])
 def get_file(download_id):
     """رابط لتحميل الملف فعلياً من السيرفر للمستخدم"""
     if download_id not in downloads_status:
-        return jsonify({'error': 'Download ID not found'}), 404
+        return download_gone_response(download_id)
     
     status = downloads_status[download_id]
     if status.get('status') != 'completed':
+        if status.get('single_stream') and status.get('status') not in TERMINAL_STATES + ('queued',):
+            # إرسال الملف أثناء تحميله بدلاً من انتظار اكتماله
+            return progressive_file_response(download_id)
         return jsonify({'error': 'File not ready yet'}), 400
         
-    file_path = status.get('filename')
-    if not file_path or not os.path.exists(file_path):
-        return jsonify({'error': 'File deleted or not found'}), 404
+    file_path = status.get('filename')
+    if not file_path:
+        return jsonify({'error': 'File deleted or not found'}), 404
+    
+    # منع المنظف من حذف الملف حتى ينتهي إرساله
+    janitor.pin(file_path)
+    if not os.path.exists(file_path):
+        janitor.unpin(file_path)
+        return jsonify({'error': 'File deleted or not found'}), 404
+
+    body = None
+
+    def release():
+        if body is None:
+            janitor.unpin(file_path)
+        else:
+            body.close()
+
+    try:
+        janitor.touch(file_path)
+        
+        if FILE_SERVING_MODE == 'x-accel':
+            # nginx يرسل الملف بنفسه (Range و ETag و sendfile) - Flask يتحقق فقط
+            # والمهلة تحميه من الحذف أثناء قراءة nginx له
+            janitor.lease(file_path)
+            janitor.unpin(file_path)
+            # الحجم الكامل تقديراً - لا نرى ما يرسله nginx فعلاً
+            metrics.inc('ytdl_served_bytes_total', os.path.getsize(file_path), mode='x-accel')
+            return x_accel_response(file_path)
+        
+        if FILE_SERVING_MODE == 'x-sendfile':
+            st = os.stat(file_path)
+            response = send_file(file_path, conditional=True, **file_send_options(file_path, st))
+            # Apache يقرأ الملف بعد انتهاء الاستجابة الفارغة - المهلة تحميه بدلاً من التثبيت
+            janitor.lease(file_path)
+            janitor.unpin(file_path)
+        else:
+            # الملف المفتوح يملك التثبيت من هنا ويحرره عند إغلاقه، ويُمرر كما هو إلى
+            # wsgi.file_wrapper فيبقى sendfile في gunicorn وغيره فعالاً
+            body = PinnedFile(file_path)
+            st = os.fstat(body.fileno())
+            response = send_file(body, **file_send_options(file_path, st))
+            response.content_length = st.st_size
+            # دعم Range/206 و If-None-Match/If-Modified-Since لاستكمال التحميل
+            response = response.make_conditional(request.environ, accept_ranges=True, complete_length=st.st_size)
+            if bandwidth.shapes_egress:
+                # الإرسال عبر دلاء الرموز بدلاً من sendfile دفعة واحدة
+                # (ClosingIterator يغلق الملف حتى لو لم يبدأ المولّد، كما في HEAD)
+                response.response = ClosingIterator(
+                    bandwidth.throttle(response.response, request.remote_addr), body.close
+                )
+        if response.status_code in (200, 206):
+            metrics.inc('ytdl_served_bytes_total', response.content_length or 0, mode=FILE_SERVING_MODE)
+        return response
+    except HTTPException:
+        # 416 مع Content-Range: bytes */الحجم (Range غير ممكن) كما في نسخة ASGI
+        release()
+        raise
+    except Exception as e:
+        release()
+        return jsonify({'error': str(e)}), 500
+
+
+def file_send_options(file_path, st):
+    """خيارات send_file المشتركة: اسم التحميل و ETag قوي وتاريخ التعديل والتخزين المؤقت"""
+    return {
+        'as_attachment': True,
+        'download_name': os.path.basename(file_path),
+        'etag': file_etag(st),
+        'last_modified': st.st_mtime,
+        'max_age': FILE_CACHE_MAX_AGE,
+    }
+
+
+class PinnedFile(io.FileIO):
+    """
+    ملف مفتوح للإرسال يحرر تثبيت الملف عند إغلاقه - مرة واحدة فقط
+    wsgi.file_wrapper يغلقه بعد الإرسال أو انقطاع العميل، و Response.close يغلقه لـ 304 و HEAD
+    """
+    def __init__(self, path):
+        # فشل الفتح لا يحرر التثبيت - يبقى لمن استدعى
+        self._released = True
+        super().__init__(path, 'rb')
+        self.path = path
+        self._released = False
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if not self._released:
+                self._released = True
+                janitor.unpin(self.path)
+
+
+def count_served(chunks, mode):
+    """عدّ البايتات المرسلة فعلاً من استجابة تُبث قطعةً قطعة"""
+    for chunk in chunks:
+        metrics.inc('ytdl_served_bytes_total', len(chunk), mode=mode)
+        yield chunk
+
+
+def follow_growing_file(download_id):
+    """
+    قراءة ملف .part أثناء كتابته: إرسال ما هو متاح ثم النوم حتى يصل
+    تحديث تقدم جديد (أي بايتات جديدة)، والتوقف عند انتهاء التحميل
+    الملف يبقى مفتوحاً حتى لو أعاد yt-dlp تسميته إلى الاسم النهائي
+    """
+    deadline = time.time() + TAIL_FOLLOW_TIMEOUT
+    version = status_events.version(download_id)
+    
+    # انتظار بدء الكتابة
+    while True:
+        status = downloads_status.get(download_id) or {}
+        part_path = status.get('tmpfilename')
+        if part_path and os.path.exists(part_path):
+            break
+        if status.get('status') in TERMINAL_STATES or time.time() > deadline:
+            return
+        version = status_events.wait_for_change(download_id, version, TAIL_FOLLOW_TIMEOUT)
+    
+    with open(part_path, 'rb') as f:
+        while True:
+            chunk = f.read(STREAM_CHUNK_SIZE)
+            if chunk:
+                deadline = time.time() + TAIL_FOLLOW_TIMEOUT
+                yield chunk
+                continue
+            
+            status = downloads_status.get(download_id) or {}
+            state = status.get('status')
+            if state == 'error':
+                return
+            if state in ('finished', 'completed') or status.get('tmpfilename') != part_path:
+                # انتهت كتابة هذا الملف - قراءة ما تبقى ثم الإنهاء
+                rest = f.read()
+                if rest:
+                    yield rest
+                return
+            if time.time() > deadline:
+                print(f"Progressive download timed out ({download_id})")
+                return
+            version = status_events.wait_for_change(download_id, version, TAIL_FOLLOW_POLL)
+
+
+def progressive_file_response(download_id):
+    """استجابة /api/get-file لملف ما زال قيد التحميل (بدون Range أو Content-Length)"""
+    status = downloads_status[download_id]
+    filename = os.path.basename(status.get('filename') or f'{download_id}.mp4')
+    chunks = count_served(follow_growing_file(download_id), 'progressive')
+    if bandwidth.shapes_egress:
+        chunks = bandwidth.throttle(chunks, request.remote_addr)
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        headers={
+            'Content-Disposition': content_disposition_header(filename),
+            'X-Progressive': 'true',
+            'X-Accel-Buffering': 'no',
+        }
+    )
+
+
+def x_accel_response(file_path):
+    """
+    استجابة فارغة مع X-Accel-Redirect ليقرأ nginx الملف من القرص مباشرة
+    يتطلب في إعداد nginx موقعاً داخلياً مثل:
+        location /protected-downloads/ { internal; alias /tmp/downloads/; }
+    """
+    response = Response(status=200)
+    response.headers['X-Accel-Redirect'] = x_accel_location(file_path)
+    response.headers['Content-Disposition'] = content_disposition_header(os.path.basename(file_path))
+    # نوع المحتوى يحدده nginx حسب امتداد الملف
+    del response.headers['Content-Type']
+    return response
+
+
+def x_accel_location(file_path):
+    """المسار الداخلي في nginx المقابل لملف داخل DOWNLOAD_DIR"""
+    relative_path = os.path.relpath(file_path, DOWNLOAD_DIR)
+    return X_ACCEL_PREFIX.rstrip('/') + '/' + quote(relative_path)
+
+
+def download_video_thread1(url, download_id, options):
+    """تنزيل الفيديو في خيط منفصل"""
+    try:
+        download_video_inprocess(url, download_id, options)
+    except Exception as e:
+        update_download_status(download_id, download_error_fields(e), replace=True)
+
+
+def download_video_inprocess(url, download_id, options):
+    """التنزيل عبر مكتبة yt-dlp (داخل أحد العمال الجاهزين) - يرفع الاستثناء عند الفشل"""
+    # الحصة الأولية من عرض النطاق وإعدادات الأجزاء (تقرؤها get_ydl_opts)
+    bandwidth.start_job(download_id)
+    fragment_tuner.start_job(download_id, url)
+    ydl_opts = get_ydl_opts(
+        download_id,
+        format_type=options.get('format_type', 'best'),
+        quality=options.get('quality', 'best')
+    )
+    
+    if options.get('format'):
+        ydl_opts['format'] = options['format']
+    
+    try:
+        info = run_ytdlp_download(url, ydl_opts, download_id)
+    finally:
+        # قبل تحرير الحصة: الضابط يقارن الإنتاجية بها
+        fragment_tuner.finish_job(download_id)
+        bandwidth.finish_job(download_id)
+    
+    # المسارات النهائية كما سجلها yt-dlp بعد الدمج
+    files = info['files']
+    for path in files:
+        janitor.track(path)
+    
+    # حفظ معلومات الفيديو
+    update_download_status(download_id, {
+        'status': 'completed',
+        'progress': '100%',
+        'filename': files[-1] if files else info['filename'],
+        'files': files,
+        'title': info.get('title') or 'Unknown',
+        'duration': info.get('duration') or 0,
+        'views': info.get('view_count') or 0,
+    })
+    if info.get('entries_count') is None and files:
+        # فيديو واحد (لا قائمة) - يُسجل في الأرشيف لتجاوز تحميله مستقبلاً
+        archive_download(url, options, info.get('extractor_key'), info.get('id'), files[-1], info.get('format_id'))
+
+
+def download_error_fields(error):
+    """سجل الخطأ المحفوظ عند فشل التحميل نهائياً"""
+    metrics.inc('ytdl_errors_total', stage='download', error=error_class(error))
+    if isinstance(error, subprocess.CalledProcessError):
+        print(f"YT-DLP Error: {error}") # طباعة الخطأ في اللوج للمراجعة
+        message = "YouTube detected a bot. Try updating cookies or yt-dlp."
+    else:
+        message = str(error)
+    return {
+        'status': 'error',
+        'error': message,
+        'progress': '0%'
+    }
+
+# بادئات الأسطر التي نطلب من yt-dlp طباعتها لنميزها عن باقي المخرجات
+PROGRESS_LINE_PREFIX = '[progress] '
+FILEPATH_LINE_PREFIX = '[filepath] '
+ARCHIVE_LINE_PREFIX = '[archive] '
+# سطر لكل معالج لاحق يبدأ أو ينتهي: "الحالة المعالج المسار" (يبدأ مرحلة في JobTimeline)
+POSTPROCESS_LINE_PREFIX = '[postprocess] '
+
+
+class YtdlpOutput:
+    """
+    تفسير مخرجات yt-dlp سطراً بسطر أثناء التحميل
+    أسطر التقدم تذهب إلى DownloadProgress، ومسارات الملفات النهائية تُجمع في files
+    ومفاتيح الأرشيف (extractor, id, format_id) لكل فيديو في archive_keys
+    """
+    def __init__(self, download_id):
+        self.download_id = download_id
+        self.progress_tracker = DownloadProgress(download_id)
+        self.files = []
+        self.archive_keys = []
+        # آخر الأسطر فقط لرسالة الخطأ - لا نخزن كل المخرجات
+        self.recent_output = deque(maxlen=20)
+    
+    def feed(self, line):
+        line = line.rstrip('\n')
+        if line.startswith(PROGRESS_LINE_PREFIX):
+            try:
+                self.progress_tracker.update(json.loads(line[len(PROGRESS_LINE_PREFIX):]))
+            except ValueError:
+                pass
+        elif line.startswith(FILEPATH_LINE_PREFIX):
+            self.files.append(line[len(FILEPATH_LINE_PREFIX):].strip())
+        elif line.startswith(ARCHIVE_LINE_PREFIX):
+            fields = line[len(ARCHIVE_LINE_PREFIX):].split()
+            if len(fields) == 3:
+                self.archive_keys.append(tuple(fields))
+        elif line.startswith(POSTPROCESS_LINE_PREFIX):
+            self.track_phase(line[len(POSTPROCESS_LINE_PREFIX):])
+        elif line:
+            print(line)
+            self.recent_output.append(line)
+    
+    def track_phase(self, line):
+        """بدء معالج لاحق: Merger يبدأ الدمج، والمعالجات الأخرى المعالجة اللاحقة (كما في العامل)"""
+        status, _, rest = line.partition(' ')
+        name, _, path = rest.partition(' ')
+        phase = postprocessor_phase(name)
+        if status == 'started' and phase:
+            # الملف الذي تكتبه المرحلة (NA إن لم يُعرف بعد)
+            enter_phase(self.download_id, phase, path=path if path and path != 'NA' else None)
+    
+    def check(self, returncode, command):
+        """رفع CalledProcessError مع آخر المخرجات إن فشل yt-dlp، وإلا إرجاع المخرجات نفسها"""
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command, output='\n'.join(self.recent_output))
+        return self
+
+    def complete(self, url, download_id, options):
+        """تسجيل نجاح التحميل (مشترك بين محرك الخيوط ومحرك asyncio)"""
+        files = self.files
+        for path in files:
+            janitor.track(path)
+        
+        update_download_status(download_id, {
+            'status': 'completed',
+            'progress': '100%',
+            'filename': files[-1] if files else "Unknown",
+            'files': files,
+        })
+        if len(self.archive_keys) == 1 and files:
+            # فيديو واحد (لا قائمة) - يُسجل في الأرشيف لتجاوز تحميله مستقبلاً
+            extractor, video_id, format_id = self.archive_keys[0]
+            archive_download(url, options, extractor, video_id, files[-1], format_id)
 
+
+def run_ytdlp_command(command, download_id):
+    """تشغيل yt-dlp وقراءة مخرجاته سطراً بسطر أثناء التحميل، وإرجاع YtdlpOutput بعد نجاحه"""
+    output = YtdlpOutput(download_id)
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors='replace',
+        bufsize=1
+    )
+    timeline = job_timelines.get(download_id)
+    if timeline is not None:
+        timeline.attach(lambda: process_usage(process.pid))
     try:
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name=os.path.basename(file_path)
-        )
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        for line in process.stdout:
+            output.feed(line)
+    finally:
+        process.stdout.close()
+        # آخر ذروة ذاكرة قبل أن تُحصد العملية (بعدها لا يبقى لها /proc)
+        sample = process_usage(process.pid) if timeline is not None else None
+        # wait4 بدلاً من wait: وقت CPU للعملية كاملاً مع ffmpeg الذي شغّلته للدمج
+        _, wait_status, rusage = os.wait4(process.pid, 0)
+        returncode = process.returncode = os.waitstatus_to_exitcode(wait_status)
+        if timeline is not None:
+            timeline.exited(rusage_usage(process.pid, rusage, sample))
+    
+    return output.check(returncode, command)
 
 
-def download_video_thread1(url, download_id, options):
-    """تنزيل الفيديو في خيط منفصل"""
-    try:
-        # تنظيف الملفات القديمة قبل البدء
-        cleanup_old_downloads()
+def build_ytdlp_command(url, options, rate_limit=None, tuning=None):
+    """أمر yt-dlp مع محاولات لتجاوز اكتشاف البوت - يعيد (الأمر، الصيغة المطلوبة)"""
+    # التأكد من مسار الكوكيز
+    cookies_path = "$PWD/cookies.txt"
+    # تحقق هل ملف الكوكيز موجود فعلاً؟
+    has_cookies = os.path.exists(cookies_path)
+    
+    output_template = f"{str(DOWNLOAD_DIR)}/%(title)s_%(format_id)s.%(ext)s"
+    # صيغة يحددها المستخدم، وإلا الافتراضية (صوت + فيديو مدمجان)
+    format_spec = options.get('format') or "bestaudio+bestvideo[height<=480]"
+    command = [
+        "yt-dlp",
+        "-f", format_spec,
+        "--continue",
+        "--cookies",cookies_path,
+        "-o", output_template,
+        "--merge-output-format", "mp4",
+        "--no-mtime",
+        "--retries", str(RETRY_COUNT),
+        "--fragment-retries", str(FRAGMENT_RETRIES),
         
-        ydl_opts = get_ydl_opts(
-            download_id,
-            format_type=options.get('format_type', 'best'),
-            quality=options.get('quality', 'best')
-        )
+        # طباعة المسار النهائي لكل ملف بعد الدمج والنقل
+        # حتى نعرف ملف هذه المهمة تحديداً دون البحث في المجلد
+        "--print", f"after_move:{FILEPATH_LINE_PREFIX}%(filepath)s",
+        # ومفتاح الفيديو في أرشيف التحميلات
+        "--print", f"after_move:{ARCHIVE_LINE_PREFIX}%(extractor_key)s %(id)s %(format_id)s",
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            
-            # حفظ معلومات الفيديو
-            downloads_status[download_id].update({
-                'status': 'completed',
-                'progress': '100%',
-                'filename': ydl.prepare_filename(info),
-                'title': info.get('title', 'Unknown'),
-                'duration': info.get('duration', 0),
-                'views': info.get('view_count', 0),
-            })
-            
-    except Exception as e:
-        downloads_status[download_id] = {
-            'status': 'error',
-            'error': str(e),
-            'progress': '0%'
-        }
+        # التقدم كسطر JSON مستقل لكل تحديث (يقرأه YtdlpOutput)
+        "--progress", "--newline",
+        "--progress-template", f"download:{PROGRESS_LINE_PREFIX}%(progress)j",
+        # بدء كل معالج لاحق (الدمج ثم الصورة المصغرة...) لمراحل JobTimeline
+        # أسطر [Merger] المعتادة لا تظهر لأن --print يجعل yt-dlp صامتاً، وهذه تظهر دائماً
+        "--progress-template",
+        f"postprocess:{POSTPROCESS_LINE_PREFIX}%(progress.status)s %(progress.postprocessor)s %(info.filepath)s",
+        
+        # --- إضافات لتجاوز الحظر ---
+        # 1. انتحال صفة متصفح حقيقي
+        "--user-agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+        
+        # 2. محاولة استخدام واجهة الويب أو أندرويد لتجنب التدقيق
+        "--extractor-args", "youtube:player_client=web,android",
+        
+        # 3. تجاهل أخطاء SSL التي قد تحدث في السيرفرات
+        "--no-check-certificate",
+    ]
+
+    # إضافة الكوكيز فقط إذا كان الملف موجوداً
+    # if has_cookies:
+    #     command.extend(["--cookies", cookies_path])
+    # else:
+    #     print("WARNING: cookies.txt not found! Download might fail for bot detection.")
+
+    if '+' in format_spec:
+        # دمج الصورة المصغرة يعيد كتابة الملف بعد تحميله، فلا يُطلب لملف واحد بدون دمج
+        # لأن /api/get-file قد يرسله أثناء تحميله ويجب أن تطابق بايتاته الملف النهائي
+        command.append("--embed-thumbnail")
+
+    if rate_limit:
+        # حصة المهمة من RATE_LIMIT عند بدئها - لا يمكن تغييرها بعد تشغيل الأمر
+        command.extend(["--limit-rate", str(rate_limit)])
+    if tuning:
+        # ما اختاره FragmentTuner لهذه المهمة
+        command.extend([
+            "--concurrent-fragments", str(tuning['concurrent_fragment_downloads']),
+            "--http-chunk-size", str(tuning['http_chunk_size']),
+        ])
+
+    # إضافة الرابط في النهاية
+    command.append(url)
+    return command, format_spec
+
 
 def download_video_thread(url, download_id, options):
     """تنفيذ أمر yt-dlp مع محاولات لتجاوز اكتشاف البوت"""
     try:
-        cleanup_old_downloads()
-        
-        # التأكد من مسار الكوكيز
-        cookies_path = "$PWD/cookies.txt"
-        # تحقق هل ملف الكوكيز موجود فعلاً؟
-        has_cookies = os.path.exists(cookies_path)
-        
-        output_template = f"{str(DOWNLOAD_DIR)}/%(title)s_%(format_id)s.%(ext)s"
-        print("+"*100)
-        subprocess.run("ls", check=True)
-        command = [
-            "yt-dlp",
-            "-f", "bestaudio+bestvideo[height<=480]",
-            "--continue",
-            "--cookies",cookies_path,
-            "-o", output_template,
-            "--merge-output-format", "mp4",
-            "--embed-thumbnail",
-            "--no-mtime",
-            
-            # --- إضافات لتجاوز الحظر ---
-            # 1. انتحال صفة متصفح حقيقي
-            "--user-agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-            
-            # 2. محاولة استخدام واجهة الويب أو أندرويد لتجنب التدقيق
-            "--extractor-args", "youtube:player_client=web,android",
-            
-            # 3. تجاهل أخطاء SSL التي قد تحدث في السيرفرات
-            "--no-check-certificate",
-        ]
+        download_video_cli(url, download_id, options)
+    except Exception as e:
+        update_download_status(download_id, download_error_fields(e), replace=True)
 
-        # إضافة الكوكيز فقط إذا كان الملف موجوداً
-        # if has_cookies:
-        #     command.extend(["--cookies", cookies_path])
-        # else:
-        #     print("WARNING: cookies.txt not found! Download might fail for bot detection.")
 
-        # إضافة الرابط في النهاية
-        command.append(url)
-        
-        downloads_status[download_id].update({
-            'status': 'downloading',
-            'progress': 'Processing...',
-        })
-        # cmd = "echo '"
-        # for i in command:
-        #     cmd = f"{cmd} {i}"
-        # cmd = f"{cmd} '"
-        # subprocess.run(cmd, check=True)
-        subprocess.run(command, check=True)
-        
-        list_of_files = list(DOWNLOAD_DIR.glob('*'))
-        if list_of_files:
-            latest_file = max(list_of_files, key=os.path.getctime)
-            filename = str(latest_file)
-        else:
-            filename = "Unknown"
+def download_video_cli(url, download_id, options):
+    """التنزيل عبر أمر yt-dlp - يرفع الاستثناء عند الفشل"""
+    rate_limit = bandwidth.start_job(download_id, adjustable=False)
+    tuning = fragment_tuner.start_job(download_id, url)
+    command, format_spec = build_ytdlp_command(url, options, rate_limit, tuning)
+    print("+"*100)
+    subprocess.run("ls", check=True)
+    
+    update_download_status(download_id, {
+        'status': 'downloading',
+        'progress': '0%',
+        # ملف واحد بدون دمج - يمكن إرساله أثناء التحميل (/api/get-file)
+        'single_stream': '+' not in format_spec,
+    })
+    # cmd = "echo '"
+    # for i in command:
+    #     cmd = f"{cmd} {i}"
+    # cmd = f"{cmd} '"
+    # subprocess.run(cmd, check=True)
+    try:
+        output = run_ytdlp_command(command, download_id)
+    finally:
+        fragment_tuner.finish_job(download_id)
+        bandwidth.finish_job(download_id)
+    output.complete(url, download_id, options)
 
-        downloads_status[download_id].update({
-            'status': 'completed',
-            'progress': '100%',
-            'filename': filename,
-        })
-            
-    except subprocess.CalledProcessError as e:
-        print(f"YT-DLP Error: {e}") # طباعة الخطأ في اللوج للمراجعة
-        downloads_status[download_id] = {
-            'status': 'error',
-            'error': "YouTube detected a bot. Try updating cookies or yt-dlp.",
-            'progress': '0%'
-        }
+
+def download_playlist_entry(url, download_id, options, fanout, attempt=1):
+    """
+    محاولة واحدة لعنصر من قائمة تشغيل: عند الفشل يعود العنصر إلى طابور القائمة بعد مهلة
+    (حالته retrying وليست نهائية، فلا تُحسب المجموعة منتهية بينما العنصر ما زال يُعاد)
+    والخطأ يُسجل بعد آخر محاولة فقط
+    """
+    download = download_video_inprocess if DOWNLOAD_ENGINE == 'pool' else download_video_cli
+    try:
+        download(url, download_id, options)
     except Exception as e:
-        downloads_status[download_id] = {
-            'status': 'error',
-            'error': str(e),
-            'progress': '0%'
-        }
+        if attempt <= PLAYLIST_ENTRY_RETRIES:
+            update_download_status(download_id, {
+                'status': 'retrying',
+                'attempts': attempt,
+                'last_error': str(e),
+            })
+            fanout.retry(url, download_id, attempt + 1, min(2 ** attempt, 30))
+            return
+        update_download_status(download_id, {
+            **download_error_fields(e),
+            'url': url,
+            'attempts': attempt,
+        }, replace=True)
+    fanout.entry_done()
 
 
 @app.route('/')
@@ -390,10 +3708,18 @@ def home():
         'endpoints': {
             'GET /': 'API Information',
             'GET /api/health': 'Health check',
+            'GET /metrics': 'Prometheus metrics',
             'POST /api/info': 'Get video information',
+            'POST /api/info/batch': 'Get information for many videos (NDJSON)',
             'POST /api/download': 'Download video',
+            'POST /api/download/batch': 'Download many URLs as one job group',
+            'GET /api/download/batch/<id>': 'Job group status with per-URL status',
             'POST /api/download/playlist': 'Download playlist',
+            'POST /api/playlist/entries': 'List playlist/channel entries page by page (NDJSON)',
+            'GET /api/stream?url=...': 'Stream video straight to the client',
             'GET /api/status/<id>': 'Get download status',
+            'GET /api/status/<id>/stream': 'Download status as Server-Sent Events',
+            'WS /api/ws/progress': 'Progress of many downloads over one WebSocket',
             'GET /api/downloads': 'List all downloads',
             'POST /api/formats': 'Get available formats',
         },
@@ -401,20 +3727,90 @@ def home():
             'max_file_size_mb': MAX_FILE_SIZE_MB,
             'storage': '/tmp (ephemeral)',
         },
-        'note': 'Files are automatically deleted after 1 hour'
+        'note': 'Files are automatically deleted after 1 hour without use, or earlier when disk space runs low'
     }), 200
 
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """فحص صحة API"""
-    return jsonify({
+    return jsonify(health_payload()), 200
+
+
+def health_payload():
+    jobs_by_status = downloads_status.count_by_status()
+    return {
         'status': 'healthy',
         'timestamp': datetime.now().isoformat(),
-        'active_downloads': len([d for d in downloads_status.values() if d.get('status') == 'downloading']),
+        # عدادات محدّثة مع كل تغيير حالة - بدون المرور على كل السجلات
+        'active_downloads': jobs_by_status.get('downloading', 0),
+        'jobs_by_status': jobs_by_status,
+        'queued_downloads': scheduler.queue_depth(),
+        'busy_workers': scheduler.active,
+        'max_concurrent_downloads': scheduler.max_workers,
+        'metadata_cache': metadata_cache.snapshot(),
+        'ytdlp_pool': ytdlp_pool.snapshot() if ytdlp_pool else None,
+        'job_groups': job_groups.snapshot(),
+        'disk_janitor': janitor.snapshot(),
+        'bandwidth': bandwidth.snapshot(),
+        'fragment_tuner': fragment_tuner.snapshot(),
+        'download_archive': download_archive.snapshot() if download_archive else None,
+        # أين يذهب وقت المهام: مجموع كل مرحلة ونصيبها، والمرحلة الغالبة
+        'job_phases': phase_summary(),
+        'job_retention': {**retention_stats, 'ttls': JOB_TTLS, 'max_records': JOB_MAX_RECORDS},
         'storage_path': str(DOWNLOAD_DIR),
         'port': PORT
-    }), 200
+    }
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """مقاييس الخدمة بصيغة Prometheus"""
+    return Response(metrics_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def metrics_text():
+    """
+    العدادات والمدرجات المتراكمة من المسارات الساخنة، مع القيم الحالية
+    التي تُقرأ عند الطلب من عدادات موجودة أصلاً (الطابور، المنظف، الذاكرة المؤقتة)
+    """
+    family = Metrics.family
+    jobs_by_status = downloads_status.count_by_status()
+    cache = metadata_cache.snapshot()
+    disk = janitor.snapshot()
+    lines = []
+    lines += family('ytdl_queue_depth', 'gauge', 'Jobs waiting in the scheduler queue',
+                    [((), scheduler.queue_depth())])
+    lines += family('ytdl_active_workers', 'gauge', 'Scheduler workers running a job',
+                    [((), scheduler.active)])
+    lines += family('ytdl_max_workers', 'gauge', 'Scheduler worker limit',
+                    [((), scheduler.max_workers)])
+    lines += family('ytdl_jobs', 'gauge', 'Job records by status',
+                    [((('status', state),), count) for state, count in sorted(jobs_by_status.items())])
+    if ytdlp_pool:
+        pool = ytdlp_pool.snapshot()
+        lines += family('ytdl_pool_workers', 'gauge', 'yt-dlp worker processes',
+                        [((('state', 'idle'),), pool['idle_workers']),
+                         ((('state', 'busy'),), pool['workers'] - pool['idle_workers'])])
+    lines += family('ytdl_fragment_connections', 'gauge', 'Fragment connections of running jobs',
+                    [((), fragment_tuner.snapshot()['active_connections'])])
+    lines += family('ytdl_metadata_cache_lookups_total', 'counter', 'Metadata cache lookups by result',
+                    [((('result', key),), cache[key]) for key in ('hits', 'disk_hits', 'misses', 'coalesced')])
+    lines += family('ytdl_metadata_cache_hit_ratio', 'gauge', 'Share of metadata lookups served without extraction',
+                    [((), cache['hit_ratio'] or 0)])
+    if download_archive:
+        archive = download_archive.snapshot()
+        lookups = archive['hits'] + archive['misses'] + archive['stale']
+        lines += family('ytdl_archive_lookups_total', 'counter', 'Download archive lookups by result',
+                        [((('result', key),), archive[key]) for key in ('hits', 'misses', 'stale')])
+        lines += family('ytdl_archive_hit_ratio', 'gauge', 'Share of downloads answered from the archive',
+                        [((), round(archive['hits'] / lookups, 4) if lookups else 0)])
+    lines += family('ytdl_disk_usage_bytes', 'gauge', 'Bytes used by files in DOWNLOAD_DIR',
+                    [((), disk['usage_bytes'])])
+    lines += family('ytdl_disk_quota_bytes', 'gauge', 'Disk quota for DOWNLOAD_DIR',
+                    [((), disk['quota_bytes'])])
+    lines += metrics.render()
+    return '\n'.join(lines) + '\n'
 
 
 @app.route('/api/info', methods=['POST'])
@@ -427,179 +3823,783 @@ def get_video_info():
         if not url:
             return jsonify({'error': 'URL is required'}), 400
         
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'age_limit': None,
-            'geo_bypass': True,
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            # استخراج الصيغ المتاحة
-            formats = []
-            if 'formats' in info:
-                for f in info['formats']:
-                    filesize = f.get('filesize', 0)
-                    # تصفية الصيغ الكبيرة جداً
-                    if filesize and filesize > MAX_FILE_SIZE_MB * 1024 * 1024:
-                        continue
-                        
-                    formats.append({
-                        'format_id': f.get('format_id'),
-                        'ext': f.get('ext'),
-                        'quality': f.get('format_note'),
-                        'resolution': f.get('resolution'),
-                        'filesize': f.get('filesize'),
-                        'fps': f.get('fps'),
-                        'vcodec': f.get('vcodec'),
-                        'acodec': f.get('acodec'),
-                    })
-            
-            result = {
-                'title': info.get('title'),
-                'description': info.get('description'),
-                'duration': info.get('duration'),
-                'views': info.get('view_count'),
-                'likes': info.get('like_count'),
-                'uploader': info.get('uploader'),
-                'upload_date': info.get('upload_date'),
-                'thumbnail': info.get('thumbnail'),
-                'age_limited': info.get('age_limit', 0) > 0,
-                'is_live': info.get('is_live', False),
-                'formats': formats[:20],  # الحد من عدد الصيغ
-                'categories': info.get('categories', []),
-                'tags': info.get('tags', [])[:10],  # أول 10 وسوم فقط
-            }
-            
-            return jsonify(result), 200
+        # الاستخراج يمر عبر الذاكرة المؤقتة المشتركة مع /api/formats
+        info = metadata_cache.get(url)
+        return jsonify(video_info_payload(info)), 200
             
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/info/batch', methods=['POST'])
+def get_video_info_batch():
+    """
+    معلومات عدة فيديوهات في طلب واحد
+    كل نتيجة تُرسل كسطر JSON (NDJSON) فور انتهائها، بترتيب الانتهاء لا ترتيب الطلب
+    فشل رابط واحد يظهر في سطره فقط ولا يوقف الباقي
+    """
+    try:
+        urls = parse_info_batch(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    def generate():
+        # عدد محدود من الاستخراجات في نفس الوقت، والذاكرة المؤقتة توحد الروابط المكررة
+        executor = ThreadPoolExecutor(min(INFO_BATCH_CONCURRENCY, len(urls)))
+        try:
+            futures = {
+                executor.submit(metadata_cache.get, url): (index, url)
+                for index, url in enumerate(urls)
+            }
+            for future in as_completed(futures):
+                index, url = futures[future]
+                yield info_batch_line(index, url, future)
+        finally:
+            # العميل أغلق الاتصال - لا داعي لإكمال ما لم يبدأ بعد
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'X-Accel-Buffering': 'no'}
+    )
+
+
+def parse_info_batch(data):
+    """قائمة الروابط من جسم /api/info/batch - يرفع ValueError لطلب غير صالح"""
+    urls = (data or {}).get('urls')
+    if not isinstance(urls, list) or not urls:
+        raise ValueError('urls must be a non-empty list')
+    if len(urls) > INFO_BATCH_MAX_URLS:
+        raise ValueError(f'Too many URLs (max {INFO_BATCH_MAX_URLS})')
+    if not all(isinstance(url, str) and url for url in urls):
+        raise ValueError('Every URL must be a non-empty string')
+    return urls
+
+
+def info_batch_line(index, url, future):
+    """سطر NDJSON لنتيجة رابط واحد (future منتهٍ من metadata_cache.get)"""
+    try:
+        item = {'index': index, 'url': url, 'ok': True, 'info': video_info_payload(future.result())}
+    except Exception as e:
+        item = {'index': index, 'url': url, 'ok': False, 'error': str(e)}
+    return json.dumps(item) + '\n'
+
+
+def video_info_payload(info):
+    """استجابة /api/info من معلومات yt-dlp"""
+    # استخراج الصيغ المتاحة
+    formats = []
+    if 'formats' in info:
+        for f in info['formats']:
+            filesize = f.get('filesize', 0)
+            # تصفية الصيغ الكبيرة جداً
+            if filesize and filesize > MAX_FILE_SIZE_MB * 1024 * 1024:
+                continue
+                
+            formats.append({
+                'format_id': f.get('format_id'),
+                'ext': f.get('ext'),
+                'quality': f.get('format_note'),
+                'resolution': f.get('resolution'),
+                'filesize': f.get('filesize'),
+                'fps': f.get('fps'),
+                'vcodec': f.get('vcodec'),
+                'acodec': f.get('acodec'),
+            })
+    
+    return {
+        'title': info.get('title'),
+        'description': info.get('description'),
+        'duration': info.get('duration'),
+        'views': info.get('view_count'),
+        'likes': info.get('like_count'),
+        'uploader': info.get('uploader'),
+        'upload_date': info.get('upload_date'),
+        'thumbnail': info.get('thumbnail'),
+        'age_limited': info.get('age_limit', 0) > 0,
+        'is_live': info.get('is_live', False),
+        'formats': formats[:20],  # الحد من عدد الصيغ
+        'categories': info.get('categories', []),
+        'tags': info.get('tags', [])[:10],  # أول 10 وسوم فقط
+    }
+
+
 @app.route('/api/download', methods=['POST'])
 def download_video():
     """تحميل فيديو"""
     try:
         data = request.get_json()
         url = data.get('url')
-        format_type = data.get('format_type', 'best')
-        quality = data.get('quality', 'best')
         is_async = data.get('async', True)
+        try:
+            priority = request_priority(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         if not url:
             return jsonify({'error': 'URL is required'}), 400
         
-        # إنشاء معرف فريد للتحميل
-        download_id = str(uuid.uuid4())
-        downloads_status[download_id] = {
-            'status': 'starting',
-            'progress': '0%',
-            'url': url
-        }
+        download_id, job, reused, replayed = submit_download(
+            url, download_options(data), priority, request.headers.get('Idempotency-Key')
+        )
+        if replayed:
+            return jsonify({
+                'download_id': download_id,
+                **status_with_queue_info(download_id),
+                'idempotent_replay': True,
+                'status_url': f'/api/status/{download_id}',
+            }), 200
         
-        options = {
-            'format_type': format_type,
-            'quality': quality
-        }
+        if reused and downloads_status[download_id].get('status') == 'completed':
+            # الملف موجود مسبقاً - لا حاجة لتحميله مرة أخرى
+            return jsonify({
+                'download_id': download_id,
+                **downloads_status[download_id],
+                'reused': True,
+            }), 200
         
         if is_async:
             # تحميل غير متزامن
-            thread = threading.Thread(
-                target=download_video_thread,
-                args=(url, download_id, options)
-            )
-            thread.daemon = True  # مهم لـ Render
-            thread.start()
-            
             return jsonify({
                 'download_id': download_id,
-                'message': 'Download started',
+                'status': downloads_status[download_id].get('status'),
+                'message': 'Attached to in-progress download' if reused else 'Download queued',
+                'attached': reused,
+                **(scheduler.queue_info(download_id) or {}),
                 'status_url': f'/api/status/{download_id}',
                 'note': 'Files will be automatically deleted after 1 hour'
             }), 202
         else:
-            # تحميل متزامن
-            download_video_thread(url, download_id, options)
+            # تحميل متزامن - ننتظر انتهاء المهمة مع احترام حد التزامن
+            job.done.wait()
             return jsonify(downloads_status[download_id]), 200
             
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/download/batch', methods=['POST'])
+def download_batch():
+    """
+    تحميل عدة روابط كوحدة عمل واحدة
+    يعيد معرف مجموعة واحداً: تقدمها الإجمالي في /api/status/<group_id> (و SSE)،
+    وحالة كل رابط على حدة في /api/download/batch/<group_id>
+    entries: [{url, download_id, deduplicated, reused}] بنفس ترتيب الروابط في الطلب
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        urls = parse_download_batch(data)
+        priority = request_priority(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        group_id, replayed = submit_download_batch(
+            urls, download_options(data), priority, request.headers.get('Idempotency-Key')
+        )
+        return jsonify({
+            'group_id': group_id,
+            **downloads_status[group_id],
+            'idempotent_replay': replayed,
+            'status_url': f'/api/download/batch/{group_id}',
+            'events_url': f'/api/status/{group_id}/stream',
+        }), 200 if replayed else 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/download/batch/<group_id>', methods=['GET'])
+def get_download_batch(group_id):
+    """حالة مجموعة التحميل مع حالة كل رابط فيها"""
+    if group_id not in downloads_status:
+        return download_gone_response(group_id)
+    
+    group = downloads_status[group_id]
+    if group.get('type') not in ('group', 'playlist'):
+        return jsonify({'error': 'Not a download group'}), 404
+    return jsonify({**group, 'jobs': group_children_status(group)}), 200
+
+
+@app.route('/api/playlist/entries', methods=['POST'])
+def list_playlist_entries():
+    """
+    عناصر قائمة تشغيل أو قناة صفحة صفحة، كسطور NDJSON تُرسل فور اكتشاف كل عنصر
+    
+    الجسم: {"url": "...", "cursor": 0, "limit": 50}
+    السطور: {"type": "playlist", ...} ثم {"type": "entry", ...} لكل عنصر
+    ثم {"type": "page", "count": n, "next_cursor": ...} (null في الصفحة الأخيرة)
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        url = data.get('url')
+        cursor = max(int(data.get('cursor') or 0), 0)
+        limit = min(max(int(data.get('limit') or PLAYLIST_PAGE_LIMIT), 1), PLAYLIST_PAGE_MAX)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid parameter: {e}'}), 400
+    if not url:
+        return jsonify({'error': 'URL is required'}), 400
+    
+    items = iter_playlist_page(url, cursor, limit)
+    try:
+        # أول سطر بعد استخراج القائمة - الأخطاء هنا ترجع كاستجابة عادية
+        first = next(items)
+    except Exception as e:
+        items.close()
+        return jsonify({'error': str(e)}), 500
+    
+    def generate():
+        try:
+            yield json.dumps(first) + '\n'
+            for item in items:
+                yield json.dumps(item) + '\n'
+        except Exception as e:
+            yield json.dumps({'type': 'error', 'error': str(e)}) + '\n'
+        finally:
+            items.close()
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'X-Accel-Buffering': 'no'}
+    )
+
+
 @app.route('/api/download/playlist', methods=['POST'])
 def download_playlist():
-    """تحميل قائمة تشغيل - محدود للخطة المجانية"""
+    """
+    تحميل قائمة تشغيل: تُحل القائمة أولاً (flat) ثم يصبح كل عنصر مهمة مستقلة
+    في المجدول، بحد أقصى PLAYLIST_CONCURRENCY عنصر من نفس القائمة في نفس الوقت
+    حالة كل عنصر في /api/download/batch/<id>
+    """
     try:
         data = request.get_json()
         url = data.get('url')
-        format_type = data.get('format_type', 'best')
-        max_downloads = min(data.get('max_downloads', 10), 10)  # حد أقصى 10 على الخطة المجانية
+        try:
+            max_downloads = request_max_downloads(data)
+            priority = request_priority(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         if not url:
             return jsonify({'error': 'URL is required'}), 400
         
-        download_id = str(uuid.uuid4())
-        downloads_status[download_id] = {
-            'status': 'starting',
-            'progress': '0%',
-            'type': 'playlist'
-        }
-        
-        def download_playlist_thread():
-            try:
-                cleanup_old_downloads()
-                
-                ydl_opts = get_ydl_opts(download_id, format_type=format_type)
-                ydl_opts['max_downloads'] = max_downloads
-                ydl_opts['playlist_items'] = f'1:{max_downloads}'
-                
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=True)
-                    
-                    downloads_status[download_id].update({
-                        'status': 'completed',
-                        'progress': '100%',
-                        'playlist_title': info.get('title'),
-                        'playlist_count': len(info.get('entries', [])),
-                    })
-                    
-            except Exception as e:
-                downloads_status[download_id] = {
-                    'status': 'error',
-                    'error': str(e)
-                }
+        idempotency_key = request.headers.get('Idempotency-Key')
+        with jobs_lock:
+            if idempotency_key:
+                existing_id = lookup_idempotency_key(idempotency_key)
+                if existing_id:
+                    return jsonify({
+                        'download_id': existing_id,
+                        **status_with_queue_info(existing_id),
+                        'idempotent_replay': True,
+                        'status_url': f'/api/status/{existing_id}',
+                    }), 200
+            
+            download_id = str(uuid.uuid4())
+            update_download_status(download_id, {
+                'status': 'queued',
+                'progress': '0%',
+                'type': 'playlist',
+                'url': url,
+                'queued_at': datetime.now().isoformat(),
+            }, replace=True)
+            if idempotency_key:
+                remember_idempotency_key(idempotency_key, download_id)
         
-        thread = threading.Thread(target=download_playlist_thread)
-        thread.daemon = True
-        thread.start()
+        # حل القائمة مهمة قصيرة في المجدول - العناصر نفسها مهام منفصلة بعدها
+        scheduler.submit(
+            download_id,
+            resolve_playlist,
+            args=(url, download_id, download_options(data), max_downloads, priority),
+            priority=priority
+        )
         
         return jsonify({
             'download_id': download_id,
-            'message': f'Playlist download started (max {max_downloads} videos)',
-            'status_url': f'/api/status/{download_id}'
+            'status': 'queued',
+            'message': f'Playlist download queued (max {max_downloads} videos)',
+            **(scheduler.queue_info(download_id) or {}),
+            'status_url': f'/api/status/{download_id}',
+            'entries_url': f'/api/download/batch/{download_id}',
         }), 202
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+class PlaylistFanout:
+    """
+    يرسل عناصر قائمة تشغيل واحدة إلى المجدول تدريجياً: عند انتهاء عنصر يدخل التالي
+    حتى لا تحتكر قائمة طويلة كل العمال وتؤخر باقي الطلبات
+    """
+    def __init__(self, options, priority, limit):
+        self.options = options
+        self.priority = priority
+        self.limit = max(1, limit)
+        self._pending = deque()
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def add(self, url, download_id):
+        self._pending.append((url, download_id, 1))
+
+    def start(self):
+        self._fill()
+
+    def entry_done(self):
+        with self._lock:
+            self._running -= 1
+        self._fill()
+
+    def retry(self, url, download_id, attempt, delay):
+        """
+        إعادة عنصر فشل إلى طابور القائمة بعد delay ثانية
+        المهلة لا تحجز عاملاً في المجدول ولا مكاناً من حد القائمة، فتتقدم العناصر الأخرى أثناءها
+        """
+        self.entry_done()
+        timer = threading.Timer(delay, self._requeue, args=(url, download_id, attempt))
+        timer.daemon = True
+        timer.start()
+
+    def _requeue(self, url, download_id, attempt):
+        with self._lock:
+            # قبل العناصر التي لم تبدأ بعد
+            self._pending.appendleft((url, download_id, attempt))
+        self._fill()
+
+    def _fill(self):
+        with self._lock:
+            while self._pending and self._running < self.limit:
+                url, download_id, attempt = self._pending.popleft()
+                self._running += 1
+                job = scheduler.submit(
+                    download_id,
+                    download_playlist_entry,
+                    args=(url, download_id, self.options, self, attempt),
+                    priority=self.priority
+                )
+                with jobs_lock:
+                    jobs_by_key[job_dedup_key(url, self.options)] = (download_id, job)
+
+
+def resolve_playlist(url, playlist_id, options, max_downloads, priority):
+    """حل قائمة التشغيل ثم إنشاء مهمة لكل عنصر (أو ربط مهمة مطابقة موجودة)"""
+    try:
+        update_download_status(playlist_id, {'status': 'resolving'})
+        title, entries = extract_playlist_entries(url, max_downloads)
+        
+        fanout = PlaylistFanout(options, priority, PLAYLIST_CONCURRENCY)
+        child_ids = []
+        with jobs_lock:
+            for index, entry in enumerate(entries, 1):
+                dedup_key = job_dedup_key(entry['url'], options)
+                download_id, _ = find_reusable_job(dedup_key)
+                archived = None if download_id else lookup_archive(
+                    entry['url'], options, entry.get('ie_key'), entry.get('id')
+                )
+                if archived:
+                    # العنصر محمل من قبل - ابن مكتمل دون المرور بالمجدول
+                    download_id = str(uuid.uuid4())
+                    update_download_status(download_id, {
+                        **archived_status(entry['url'], archived),
+                        'title': entry.get('title'),
+                        'playlist_id': playlist_id,
+                        'playlist_index': index,
+                    }, replace=True)
+                    jobs_by_key[dedup_key] = (download_id, None)
+                elif download_id is None:
+                    download_id = str(uuid.uuid4())
+                    update_download_status(download_id, {
+                        'status': 'queued',
+                        'progress': '0%',
+                        'url': entry['url'],
+                        'title': entry.get('title'),
+                        'playlist_id': playlist_id,
+                        'playlist_index': index,
+                        'queued_at': datetime.now().isoformat(),
+                        'single_stream': '+' not in options.get('format', '+'),
+                    }, replace=True)
+                    fanout.add(entry['url'], download_id)
+                child_ids.append(download_id)
+        
+        job_groups.create(playlist_id, child_ids, {
+            **(downloads_status.get(playlist_id) or {}),
+            'playlist_title': title,
+            'playlist_count': len(entries),
+            'max_concurrent': fanout.limit,
+        }, kind='playlist')
+        fanout.start()
+    except Exception as e:
+        update_download_status(playlist_id, {
+            'status': 'error',
+            'error': str(e)
+        }, replace=True)
+
+
+# وضع البث المباشر: الصيغة الافتراضية يجب أن تكون ملفاً واحداً (بدون دمج)
+STREAM_DEFAULT_FORMAT = 'best[height<=480]/best'
+STREAM_MAX_CONCURRENT = int(os.environ.get('STREAM_MAX_CONCURRENT', 4))
+STREAM_INFO_PREFIX = '[stream-info] '
+stream_slots = threading.BoundedSemaphore(STREAM_MAX_CONCURRENT)
+
+
+def safe_filename(name):
+    """اسم ملف صالح من عنوان الفيديو"""
+    return re.sub(r'[\\/:*?"<>|\x00-\x1f]', '_', name).strip()[:150] or 'video'
+
+
+@app.route('/api/stream', methods=['GET'])
+def stream_video():
+    """
+    بث الفيديو مباشرة من yt-dlp إلى المستخدم دون حفظه أولاً في DOWNLOAD_DIR
+    
+    مثال الاستخدام:
+    GET /api/stream?url=https://youtu.be/...&format=18
+    GET /api/stream?url=...&cache=1   (حفظ نسخة في DOWNLOAD_DIR أثناء البث)
+    """
+    url = request.args.get('url')
+    if not url:
+        return jsonify({'error': 'URL is required'}), 400
+    
+    format_spec = request.args.get('format', STREAM_DEFAULT_FORMAT)
+    if '+' in format_spec:
+        return jsonify({'error': 'Stream mode needs a single-file format (merging is not possible on a pipe)'}), 400
+    tee = request.args.get('cache', '').lower() in ('1', 'true', 'yes')
+    
+    if not stream_slots.acquire(blocking=False):
+        response = jsonify({'error': 'Too many active streams, try again shortly'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    
+    command = [
+        "yt-dlp",
+        "-f", format_spec,
+        "-o", "-",
+        "--quiet", "--no-warnings",
+        "--no-part",
+        # معلومات الملف تُكتب على stderr قبل أول بايت حتى نجهز الترويسات
+        "--print-to-file", f"before_dl:{STREAM_INFO_PREFIX}%(.{{id,title,ext}})j", "/dev/stderr",
+        "--user-agent", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+        "--extractor-args", "youtube:player_client=web,android",
+        "--no-check-certificate",
+    ]
+    cookies = get_cookies_for_age_restricted()
+    if cookies:
+        command.extend(["--cookies", cookies])
+    command.append(url)
+    
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+    errors = deque(maxlen=20)
+    finished = threading.Event()
+    
+    def cleanup(succeeded=False):
+        """
+        إيقاف yt-dlp وتحرير المكان وإنهاء سجل النسخة المحفوظة - مرة واحدة فقط
+        يُستدعى من generate أو من إغلاق الاستجابة إن انقطع العميل قبل أن تبدأ
+        """
+        if finished.is_set():
+            return
+        finished.set()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        process.stdout.close()
+        stream_slots.release()
+        if download_id is None:
+            return
+        if succeeded:
+            os.replace(f'{cache_path}.part', cache_path)
+            janitor.track(str(cache_path))
+            update_download_status(download_id, {
+                'status': 'completed',
+                'progress': '100%',
+                'filename': str(cache_path),
+                'files': [str(cache_path)],
+            })
+        else:
+            Path(f'{cache_path}.part').unlink(missing_ok=True)
+            update_download_status(download_id, {
+                'status': 'error',
+                'error': 'Stream interrupted before completion',
+            })
+    
+    download_id = None
+    # انتظار انتهاء الاستخراج (زمن أول بايت = زمن الاستخراج)
+    info = None
+    for raw_line in process.stderr:
+        line = raw_line.decode('utf-8', 'replace').rstrip()
+        if line.startswith(STREAM_INFO_PREFIX):
+            info = json.loads(line[len(STREAM_INFO_PREFIX):])
+            break
+        if line:
+            errors.append(line)
+    if info is None:
+        cleanup()
+        return jsonify({'error': '\n'.join(errors) or 'Extraction failed'}), 502
+    
+    def drain_stderr():
+        # قراءة stderr حتى لا يمتلئ الأنبوب ويتوقف yt-dlp
+        for raw_line in process.stderr:
+            errors.append(raw_line.decode('utf-8', 'replace').rstrip())
+        process.stderr.close()
+    
+    threading.Thread(target=drain_stderr, daemon=True).start()
+    
+    filename = f"{safe_filename(info.get('title') or info.get('id') or 'video')}.{info.get('ext') or 'mp4'}"
+    if tee:
+        download_id = str(uuid.uuid4())
+        cache_path = DOWNLOAD_DIR / f"{Path(filename).stem}_{safe_filename(str(info.get('id')))}.{info.get('ext') or 'mp4'}"
+        update_download_status(download_id, {
+            'status': 'downloading',
+            'type': 'stream',
+            'url': url,
+            'title': info.get('title'),
+        }, replace=True)
+    
+    def generate():
+        cache_file = open(f'{cache_path}.part', 'wb') if tee else None
+        succeeded = False
+        try:
+            while True:
+                # قطعة واحدة في الذاكرة كحد أقصى - الباقي ينتظر في أنبوب النظام
+                chunk = process.stdout.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if cache_file:
+                    cache_file.write(chunk)
+                yield chunk
+            succeeded = process.wait() == 0
+        finally:
+            # ينفذ أيضاً عند انقطاع اتصال المستخدم (GeneratorExit)
+            if cache_file:
+                cache_file.close()
+            cleanup(succeeded)
+    
+    headers = {
+        'Content-Disposition': content_disposition_header(filename),
+        'X-Accel-Buffering': 'no',
+    }
+    if download_id:
+        headers['X-Download-Id'] = download_id
+    response = Response(
+        generate(),
+        mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        headers=headers
+    )
+    response.call_on_close(cleanup)
+    return response
+
+
 @app.route('/api/status/<download_id>', methods=['GET'])
 def get_download_status(download_id):
     """الحصول على حالة التحميل"""
     if download_id not in downloads_status:
-        return jsonify({'error': 'Download ID not found'}), 404
+        return download_gone_response(download_id)
+    
+    return jsonify(status_with_queue_info(download_id)), 200
+
+
+@app.route('/api/status/<download_id>/stream', methods=['GET'])
+def stream_download_status(download_id):
+    """
+    بث حالة التحميل عبر Server-Sent Events
+    يُرسل حدث فقط عند تغير الحالة، مع heartbeat دوري لإبقاء الاتصال
+    ويدعم الاستكمال عبر Last-Event-ID بعد انقطاع الاتصال
+    """
+    if download_id not in downloads_status:
+        return download_gone_response(download_id)
+    
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        last_event_id = 0
+    
+    def format_event(version, status):
+        event = 'done' if status.get('status') in TERMINAL_STATES else 'progress'
+        return f"id: {version}\nevent: {event}\ndata: {json.dumps(status)}\n\n"
+    
+    def generate():
+        version = last_event_id
+        yield f"retry: {SSE_HEARTBEAT_INTERVAL * 1000}\n\n"
+        while True:
+            current = status_events.wait_for_change(download_id, version, SSE_HEARTBEAT_INTERVAL)
+            if download_id not in downloads_status:
+                yield "event: gone\ndata: {}\n\n"
+                return
+            status = status_with_queue_info(download_id)
+            
+            if current != version:
+                version = current
+                yield format_event(version, status)
+            elif status.get('status') == 'queued':
+                # ترتيب الطابور يتغير دون تغيير السجل نفسه
+                yield format_event(version, status)
+            elif status.get('status') in TERMINAL_STATES:
+                # استكمال بعد انتهاء التحميل - لا جديد لإرساله
+                yield format_event(version, status)
+            else:
+                yield ": heartbeat\n\n"
+            
+            if status.get('status') in TERMINAL_STATES:
+                return
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            # منع nginx من تجميع الأحداث قبل إرسالها
+            'X-Accel-Buffering': 'no',
+        }
+    )
+
+
+class ProgressDeltas:
+    """الحقول التي تغيرت في كل سجل منذ آخر دفعة أُرسلت لاتصال WebSocket"""
+    def __init__(self):
+        # آخر نسخة أُرسلت من كل سجل لحساب الفروقات فقط
+        self.last_sent = {}
+    
+    def forget(self, job_ids):
+        for download_id in job_ids:
+            self.last_sent.pop(download_id, None)
+    
+    def build(self, changed):
+        jobs = {}
+        removed = []
+        for download_id in changed:
+            if download_id not in downloads_status:
+                if self.last_sent.pop(download_id, None) is not None:
+                    removed.append(download_id)
+                continue
+            status = status_with_queue_info(download_id)
+            previous = self.last_sent.get(download_id, {})
+            delta = {k: v for k, v in status.items() if previous.get(k) != v}
+            delta.update({k: None for k in previous if k not in status})
+            if delta:
+                jobs[download_id] = delta
+            if status.get('status') in TERMINAL_STATES:
+                # لن تتغير بعد الآن - لا داعي لإبقاء نسختها
+                self.last_sent.pop(download_id, None)
+            else:
+                self.last_sent[download_id] = dict(status)
+        return jobs, removed
+
+
+@sock.route('/api/ws/progress')
+def progress_websocket(ws):
+    """
+    قناة WebSocket واحدة لمتابعة عدة تحميلات (لوحات المتابعة)
+    
+    رسائل العميل (JSON):
+        {"action": "subscribe", "ids": ["<id>", ...]}
+        {"action": "subscribe", "all": true}
+        {"action": "unsubscribe", "ids": ["<id>", ...]}   أو  "all": true
+        {"action": "set_rate", "max_rate": 2}
+    
+    رسائل الخادم: دفعة واحدة كل فترة تحتوي فقط الحقول التي تغيرت
+        {"type": "progress", "jobs": {"<id>": {...}}, "removed": ["<id>", ...]}
+    """
+    subscriber = status_events.subscribe()
+    deltas = ProgressDeltas()
+    rate = [WS_MAX_UPDATE_RATE]
+    
+    def handle_message(message):
+        try:
+            data = json.loads(message)
+        except ValueError:
+            ws.send(json.dumps({'type': 'error', 'error': 'Invalid JSON'}))
+            return
+        action = data.get('action')
+        ids = [str(i) for i in data.get('ids', [])]
+        if action == 'subscribe':
+            subscriber.watch(ids, all_jobs=bool(data.get('all')))
+        elif action == 'unsubscribe':
+            subscriber.unwatch(ids, all_jobs=bool(data.get('all')))
+            deltas.forget(ids)
+        elif action == 'set_rate':
+            try:
+                rate[0] = ws_update_rate(data.get('max_rate', WS_MAX_UPDATE_RATE))
+            except ValueError as e:
+                # خطأ في رسالة واحدة لا يغلق الاتصال ومتابعاته
+                ws.send(json.dumps({'type': 'error', 'error': str(e)}))
+        else:
+            ws.send(json.dumps({'type': 'error', 'error': f'Unknown action: {action}'}))
     
-    return jsonify(downloads_status[download_id]), 200
+    try:
+        args = request.args
+        subscriber.watch(
+            [i for i in args.get('ids', '').split(',') if i],
+            all_jobs=args.get('all') in ('1', 'true')
+        )
+        if args.get('max_rate'):
+            handle_message(json.dumps({'action': 'set_rate', 'max_rate': args.get('max_rate')}))
+        
+        last_message_at = time.time()
+        while True:
+            # انتظار رسائل العميل يحدد أيضاً إيقاع الدفعات
+            message = ws.receive(timeout=1 / rate[0])
+            if message:
+                handle_message(message)
+            
+            jobs, removed = deltas.build(subscriber.drain())
+            if jobs or removed:
+                ws.send(json.dumps({'type': 'progress', 'jobs': jobs, 'removed': removed}))
+                last_message_at = time.time()
+            elif time.time() - last_message_at >= SSE_HEARTBEAT_INTERVAL:
+                ws.send(json.dumps({'type': 'heartbeat'}))
+                last_message_at = time.time()
+    finally:
+        status_events.unsubscribe(subscriber)
 
 
 @app.route('/api/downloads', methods=['GET'])
 def list_downloads():
-    """قائمة جميع التحميلات"""
-    return jsonify(downloads_status), 200
+    """
+    قائمة التحميلات مقسمة إلى صفحات
+    
+    المعاملات (اختيارية):
+        status: تصفية حسب الحالة (أو عدة حالات مفصولة بفواصل)
+        since:  المهام المنشأة بعد هذا الوقت (ISO أو Unix timestamp)
+        limit:  عدد النتائج في الصفحة (افتراضي 100)
+        cursor: قيمة X-Next-Cursor من الصفحة السابقة
+    """
+    try:
+        statuses, since, limit, cursor = parse_downloads_query(request.args)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query parameter: {e}'}), 400
+    
+    page, next_cursor = downloads_status.query(statuses or None, since or None, cursor, limit)
+    
+    def generate():
+        # بناء JSON تدريجياً بدلاً من تجهيز الاستجابة كاملة في الذاكرة
+        yield '{'
+        for i, (download_id, status) in enumerate(page):
+            separator = ', ' if i else ''
+            yield f'{separator}{json.dumps(download_id)}: {json.dumps(status_with_queue_info(download_id, status))}'
+        yield '}'
+    
+    headers = {}
+    if next_cursor is not None:
+        headers['X-Next-Cursor'] = str(next_cursor)
+        query = urlencode({**request.args.to_dict(), 'cursor': next_cursor})
+        headers['Link'] = f'</api/downloads?{query}>; rel="next"'
+    return Response(generate(), mimetype='application/json', headers=headers), 200
+
+
+def parse_downloads_query(args):
+    """معاملات /api/downloads - يرفع ValueError للقيم غير الصالحة"""
+    statuses = [s for s in args.get('status', '').split(',') if s]
+    since = args.get('since')
+    if since:
+        try:
+            since = float(since)
+        except ValueError:
+            since = datetime.fromisoformat(since).timestamp()
+    limit = min(max(int(args.get('limit', DOWNLOADS_PAGE_LIMIT)), 1), DOWNLOADS_PAGE_MAX)
+    cursor = int(args.get('cursor', 0))
+    return statuses, since, limit, cursor
 
 
 @app.route('/api/formats', methods=['POST'])
@@ -612,42 +4612,40 @@ def get_available_formats():
         if not url:
             return jsonify({'error': 'URL is required'}), 400
         
-        ydl_opts = {
-            'quiet': True,
-            'listformats': True,
-            'age_limit': None,
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            formats_list = []
-            for f in info.get('formats', []):
-                filesize = f.get('filesize', 0)
-                
-                formats_list.append({
-                    'format_id': f.get('format_id'),
-                    'ext': f.get('ext'),
-                    'resolution': f.get('resolution', 'audio only'),
-                    'fps': f.get('fps'),
-                    'filesize': f.get('filesize'),
-                    'filesize_mb': round(filesize / (1024 * 1024), 2) if filesize else None,
-                    'within_limit': filesize < MAX_FILE_SIZE_MB * 1024 * 1024 if filesize else True,
-                    'vcodec': f.get('vcodec'),
-                    'acodec': f.get('acodec'),
-                    'format_note': f.get('format_note'),
-                })
-            
-            return jsonify({
-                'title': info.get('title'),
-                'formats': formats_list,
-                'max_file_size_mb': MAX_FILE_SIZE_MB
-            }), 200
+        # نفس الذاكرة المؤقتة المستخدمة في /api/info
+        info = metadata_cache.get(url)
+        return jsonify(formats_payload(info)), 200
             
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def formats_payload(info):
+    """استجابة /api/formats من معلومات yt-dlp"""
+    formats_list = []
+    for f in info.get('formats', []):
+        filesize = f.get('filesize', 0)
+        
+        formats_list.append({
+            'format_id': f.get('format_id'),
+            'ext': f.get('ext'),
+            'resolution': f.get('resolution', 'audio only'),
+            'fps': f.get('fps'),
+            'filesize': f.get('filesize'),
+            'filesize_mb': round(filesize / (1024 * 1024), 2) if filesize else None,
+            'within_limit': filesize < MAX_FILE_SIZE_MB * 1024 * 1024 if filesize else True,
+            'vcodec': f.get('vcodec'),
+            'acodec': f.get('acodec'),
+            'format_note': f.get('format_note'),
+        })
+    
+    return {
+        'title': info.get('title'),
+        'formats': formats_list,
+        'max_file_size_mb': MAX_FILE_SIZE_MB
+    }
+
+
 @app.route('/cmd', methods=['GET'])
 def execute_command():
     """
@@ -772,8 +4770,5 @@ if __name__ == '__main__':
     print(f"📊 Max file size: {MAX_FILE_SIZE_MB}MB")
     print("=" * 60)
     
-    # تنظيف الملفات القديمة عند البدء
-    cleanup_old_downloads()
-    
     # تشغيل التطبيق
     app.run(host='0.0.0.0', port=PORT, debug=False, threaded=True)
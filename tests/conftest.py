@@ -0,0 +1,41 @@
+"""
+إعدادات الاختبارات: تُضبط متغيرات البيئة قبل استيراد index
+(بلا عمال yt-dlp جاهزين، ومجلد تحميلات وأرشيف مؤقتان)
+"""
+
+import os
+import tempfile
+
+TEST_DIR = tempfile.mkdtemp(prefix='ytdl-tests-')
+os.environ.setdefault('DOWNLOAD_DIR', os.path.join(TEST_DIR, 'downloads'))
+os.environ.setdefault('DOWNLOAD_ARCHIVE_PATH', '')
+os.environ.setdefault('YTDLP_POOL_SIZE', '0')
+os.environ.setdefault('JOB_STORE', 'memory')
+
+import pytest
+
+import index
+
+
+@pytest.fixture
+def client():
+    index.app.config['TESTING'] = True
+    return index.app.test_client()
+
+
+@pytest.fixture
+def completed_file():
+    """سجل مهمة مكتملة وملفها (1000 بايت)"""
+    path = os.path.join(str(index.DOWNLOAD_DIR), 'sample.mp4')
+    with open(path, 'wb') as f:
+        f.write(b'x' * 1000)
+    download_id = 'test-completed'
+    index.update_download_status(download_id, {
+        'status': 'completed',
+        'filename': path,
+        'files': [path],
+    }, replace=True)
+    yield download_id, path
+    index.downloads_status.remove(download_id)
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,34 @@
+"""
+توزيع RATE_LIMIT على المهام: الحصص الثابتة لأوامر yt-dlp لا تُحسب مرتين
+"""
+
+import index
+
+
+def allocations(manager):
+    return manager.snapshot()['allocations']
+
+
+def test_fixed_jobs_stay_within_limit():
+    manager = index.BandwidthManager(1_000_000, 400_000, 0, 0)
+    for download_id in ('cli-1', 'cli-2', 'cli-3'):
+        manager.start_job(download_id, adjustable=False)
+    assert allocations(manager) == {'cli-1': 400_000, 'cli-2': 400_000, 'cli-3': 200_000}
+
+
+def test_mixed_jobs_stay_within_limit():
+    manager = index.BandwidthManager(1_000_000, 0, 0, 0)
+    manager.start_job('pool-1')
+    manager.start_job('cli-1', adjustable=False)
+    manager.start_job('pool-2')
+    manager.start_job('cli-2', adjustable=False)
+    assert sum(allocations(manager).values()) <= 1_000_000
+    
+    assert allocations(manager)['cli-1'] == 500_000
+    
+    # انتهاء أمر ثابت يعيد حصته للمهام القابلة للتعديل فقط
+    manager.finish_job('cli-1')
+    after = allocations(manager)
+    assert after['cli-2'] == 166_666
+    assert after['pool-1'] + after['pool-2'] + after['cli-2'] <= 1_000_000
+    assert after['pool-1'] > 166_666
@@ -0,0 +1,48 @@
+"""
+أمر yt-dlp (محرك cli) وقراءة مخرجاته
+"""
+
+import time
+
+import yt_dlp
+from yt_dlp.postprocessor import EmbedThumbnailPP, FFmpegMergerPP, MoveFilesAfterDownloadPP
+
+import index
+
+
+def test_embed_thumbnail_only_when_merging():
+    merged, _ = index.build_ytdlp_command('https://example.com/v', {})
+    assert '--embed-thumbnail' in merged
+    # ملف واحد قد يُرسل أثناء تحميله - لا يُعاد كتابته بعد ذلك
+    single, _ = index.build_ytdlp_command('https://example.com/v', {'format': '18'})
+    assert '--embed-thumbnail' not in single
+
+
+def test_postprocessor_lines_start_phases(monkeypatch, capsys):
+    # نفس خيارات الأمر الفعلي: --print يجعل yt-dlp صامتاً فلا تظهر أسطر [Merger] المعتادة
+    command, _ = index.build_ytdlp_command('https://example.com/v', {})
+    options = yt_dlp.parse_options(command[1:]).ydl_opts
+    assert options['quiet']
+    
+    ydl = yt_dlp.YoutubeDL(options)
+    info = {'id': 'v', 'title': 'v', 'filepath': '/d/v_137+140.mp4'}
+    for pp in (FFmpegMergerPP(ydl), EmbedThumbnailPP(ydl), MoveFilesAfterDownloadPP(ydl)):
+        pp._hook_progress({'status': 'started'}, info)
+        ydl.to_screen('[%s] human-readable line' % pp.pp_key())
+        pp._hook_progress({'status': 'finished'}, info)
+    # yt-dlp الصامت يكتبها إلى stderr، وأمر cli يدمجه مع stdout
+    lines = capsys.readouterr().err.splitlines()
+    assert lines and all(line.startswith(index.POSTPROCESS_LINE_PREFIX) for line in lines)
+    
+    download_id = 'test-cli-phases'
+    now = time.time()
+    timeline = index.JobTimeline(download_id, now, now)
+    monkeypatch.setitem(index.job_timelines, download_id, timeline)
+    output = index.YtdlpOutput(download_id)
+    for line in lines:
+        output.feed(line + '\n')
+    timeline.finish()
+    
+    assert [entry['phase'] for entry in timeline.phases] == [
+        'queued', 'extracting', 'merging', 'postprocessing', 'done'
+    ]
@@ -0,0 +1,90 @@
+"""/api/get-file: تحرير تثبيت الملف بعد الإرسال، و Range غير الممكن"""
+
+import os
+
+from werkzeug.test import EnvironBuilder
+
+import index
+
+
+def pins(path):
+    return index.janitor._pins.get(path, 0)
+
+
+def test_full_get_releases_pin(client, completed_file):
+    download_id, path = completed_file
+    response = client.get(f'/api/get-file/{download_id}')
+    assert response.status_code == 200
+    assert len(response.data) == 1000
+    response.close()
+    assert pins(path) == 0
+
+
+def test_range_get_releases_pin(client, completed_file):
+    download_id, path = completed_file
+    response = client.get(f'/api/get-file/{download_id}', headers={'Range': 'bytes=0-9'})
+    assert response.status_code == 206
+    assert response.data == b'x' * 10
+    response.close()
+    assert pins(path) == 0
+
+
+def test_not_modified_releases_pin(client, completed_file):
+    download_id, path = completed_file
+    first = client.get(f'/api/get-file/{download_id}')
+    etag = first.headers['ETag']
+    first.close()
+    response = client.get(f'/api/get-file/{download_id}', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    response.close()
+    assert pins(path) == 0
+
+
+def test_leased_file_survives_removal(completed_file):
+    # x-accel / x-sendfile: خادم الويب يقرأ الملف بعد انتهاء الطلب
+    _, path = completed_file
+    index.janitor.lease(path)
+    try:
+        assert not index.janitor.remove(path)
+        assert os.path.exists(path)
+    finally:
+        index.janitor._leases.pop(path, None)
+
+
+def test_unsatisfiable_range_is_416(client, completed_file):
+    download_id, path = completed_file
+    response = client.get(f'/api/get-file/{download_id}', headers={'Range': 'bytes=5000-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */1000'
+    response.close()
+    assert pins(path) == 0
+
+
+class SendfileWrapper:
+    """wsgi.file_wrapper كما في gunicorn: يغلق الملف عند إغلاقه"""
+    def __init__(self, filelike, block_size=8192):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.block_size), b'')
+
+    def close(self):
+        self.filelike.close()
+
+
+def test_file_wrapper_is_kept(completed_file):
+    # ما يصل إلى خادم WSGI هو غلاف الملف نفسه (لا غلاف حوله يخفي sendfile)
+    download_id, path = completed_file
+    environ = EnvironBuilder(
+        path=f'/api/get-file/{download_id}',
+        environ_overrides={'wsgi.file_wrapper': SendfileWrapper},
+    ).get_environ()
+    statuses = []
+    body = index.app(environ, lambda status, headers: statuses.append(status))
+    assert statuses == ['200 OK']
+    assert isinstance(body, SendfileWrapper)
+    assert pins(path) == 1
+    assert b''.join(body) == b'x' * 1000
+    body.close()
+    assert pins(path) == 0
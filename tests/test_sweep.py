@@ -0,0 +1,60 @@
+"""
+فهرس مسارات الملفات في مخازن المهام، وكنس السجلات المنتهية مع ملفاتها
+"""
+
+import os
+
+import pytest
+
+import index
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'sqlite':
+        return index.SQLiteJobStore(tmp_path / 'jobs.sqlite3', flush_interval=3600)
+    return index.MemoryJobStore()
+
+
+def test_path_references(store):
+    store.put('a', {'status': 'downloading', 'filename': '/d/a.mp4.part'})
+    store.merge('a', {'status': 'completed', 'filename': '/d/a.mp4', 'files': ['/d/a.mp4']})
+    store.put('b', {'status': 'completed', 'filename': '/d/a.mp4', 'files': ['/d/a.mp4']})
+    assert not store.references('/d/a.mp4.part')
+    assert store.references('/d/a.mp4')
+    
+    store.remove('a')
+    assert store.references('/d/a.mp4')
+    store.remove('b')
+    assert not store.references('/d/a.mp4')
+
+
+def test_progress_filename_is_indexed(store):
+    store.put('a', {'status': 'downloading'})
+    store.merge('a', {'status': 'downloading', 'filename': '/d/a.f137.mp4'})
+    assert store.references('/d/a.f137.mp4')
+
+
+def test_sweep_keeps_shared_file(monkeypatch):
+    path = os.path.join(str(index.DOWNLOAD_DIR), 'shared.mp4')
+    with open(path, 'wb') as f:
+        f.write(b'x')
+    fields = {'status': 'completed', 'filename': path, 'files': [path]}
+    index.update_download_status('sweep-old', dict(fields), replace=True)
+    index.update_download_status('sweep-new', dict(fields), replace=True)
+    # السجل الأقدم وحده انتهت صلاحيته
+    monkeypatch.setattr(
+        index.downloads_status, 'expired',
+        lambda ttls, max_records: [('sweep-old', index.downloads_status['sweep-old'])]
+    )
+    
+    index.sweep_expired_jobs()
+    assert 'sweep-old' not in index.downloads_status
+    assert os.path.exists(path)
+    
+    monkeypatch.setattr(
+        index.downloads_status, 'expired',
+        lambda ttls, max_records: [('sweep-new', index.downloads_status['sweep-new'])]
+    )
+    index.sweep_expired_jobs()
+    assert not os.path.exists(path)
@@ -0,0 +1,25 @@
+"""JobTimeline: ذروة الذاكرة لعملية yt-dlp وحدها لا حجم الخادم الذي شغّلها"""
+
+import time
+
+import index
+
+
+def test_trivial_child_peak_rss_is_its_own(monkeypatch):
+    # خادم كبير: عملية fork تبدأ بنفس الذاكرة قبل exec
+    ballast = bytearray(300 * 1024 * 1024)
+    ballast[::4096] = b'x' * len(ballast[::4096])
+    download_id = 'test-timeline'
+    now = time.time()
+    timeline = index.JobTimeline(download_id, now, now)
+    monkeypatch.setitem(index.job_timelines, download_id, timeline)
+
+    index.run_ytdlp_command(['/bin/sh', '-c', 'sleep 0.2'], download_id)
+    timeline.finish()
+
+    extracting = timeline.phases[1]
+    assert extracting['phase'] == 'extracting'
+    assert extracting['cpu_seconds'] is not None
+    assert extracting['peak_rss'] is not None
+    assert extracting['peak_rss'] < 64 * 1024 * 1024
+    del ballast
@@ -0,0 +1,23 @@
+"""
+قيم الطلب غير الصالحة تعيد 400 قبل إنشاء أي مهمة
+"""
+
+import pytest
+
+
+@pytest.mark.parametrize('endpoint, body', [
+    ('/api/download', {'url': 'https://example.com/v', 'priority': 'x'}),
+    ('/api/download/batch', {'urls': ['https://example.com/v'], 'priority': 'x'}),
+    ('/api/download/playlist', {'url': 'https://example.com/p', 'priority': 'x'}),
+])
+def test_non_numeric_priority(client, endpoint, body):
+    response = client.post(endpoint, json=body)
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'priority must be an integer'
+
+
+@pytest.mark.parametrize('value', [0, -1, 2.5, 'x', None, True])
+def test_invalid_max_downloads(client, value):
+    response = client.post('/api/download/playlist', json={'url': 'https://example.com/p', 'max_downloads': value})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'max_downloads must be a positive integer'
@@ -0,0 +1,314 @@
+"""
+عامل yt-dlp دائم - عملية مستقلة يديرها YtdlpWorkerPool في index.py
+يُستورد yt_dlp مرة واحدة عند التشغيل ثم ينفذ المهام واحدة تلو الأخرى:
+المهام تصل كأسطر JSON على stdin، والتقدم والنتيجة تعود كأسطر JSON على stdout
+رسائل التحكم (kind=rate) قد تصل أثناء تنفيذ مهمة فتُقرأ في خيط مستقل
+انتقالات مراحل التنزيل تُرسل كرسائل تقدم بحالة phase مع استهلاك العامل التراكمي
+"""
+
+import itertools
+import json
+import os
+import queue
+import resource
+import sys
+import threading
+import time
+
+import yt_dlp
+
+# أقل فاصل بين رسالتي تقدم متتاليتين (ثوانٍ) - لا داعي لإغراق القناة
+PROGRESS_INTERVAL = 0.25
+# عدد كائنات YoutubeDL المحفوظة للاستخراج (واحد لكل مجموعة إعدادات)
+EXTRACTOR_CACHE_SIZE = 8
+
+# الحقول التي يحتاجها DownloadProgress.update من قاموس التقدم
+PROGRESS_FIELDS = (
+    'status', 'filename', 'tmpfilename',
+    'downloaded_bytes', 'total_bytes', 'total_bytes_estimate', 'speed', 'eta',
+    '_percent_str', '_speed_str', '_eta_str',
+    '_downloaded_bytes_str', '_total_bytes_str',
+)
+
+
+class Channel:
+    """قناة الرسائل إلى العملية الأم"""
+    def __init__(self, stream):
+        self.stream = stream
+
+    def send(self, message_type, **fields):
+        self.stream.write(json.dumps({'type': message_type, **fields}, default=str) + '\n')
+        self.stream.flush()
+
+
+class RateControl:
+    """
+    حد السرعة الحي للتنزيل الجاري - يعدّله خيط القراءة عند وصول رسالة rate
+    FileDownloader في yt-dlp يقرأ params['ratelimit'] في كل دورة فالتعديل يسري فوراً
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._task_id = None
+        self._params = None
+        # حد وصل قبل أن يبدأ التنزيل نفسه
+        self._pending = {}
+
+    def set(self, task_id, rate):
+        with self._lock:
+            if self._params is not None and task_id == self._task_id:
+                self._params['ratelimit'] = rate
+            else:
+                self._pending = {task_id: rate}
+
+    def attach(self, task_id, params):
+        with self._lock:
+            self._task_id = task_id
+            self._params = params
+            if task_id in self._pending:
+                params['ratelimit'] = self._pending.pop(task_id)
+
+    def detach(self):
+        with self._lock:
+            self._task_id = None
+            self._params = None
+            self._pending = {}
+
+
+def postprocessor_phase(name):
+    """
+    مرحلة JobTimeline للمعالج اللاحق: Merger دمج، والباقي معالجة
+    MoveFiles مجرد نقل للملف - لا يبدأ مرحلة (في المحركين)
+    """
+    if name == 'Merger':
+        return 'merging'
+    if name and name != 'MoveFiles':
+        return 'postprocessing'
+    return None
+
+
+def reset_peak_rss():
+    """
+    إعادة VmHWM إلى الذاكرة الحالية في بداية كل مهمة (Linux فقط)
+    حتى لا ترث مهمة صغيرة ذروة مهمة كبيرة سبقتها على نفس العامل
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """VmHWM للعامل بالبايت منذ آخر reset_peak_rss، أو None خارج Linux"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def usage():
+    """
+    (pid، ثواني CPU للعامل وأبنائه المنتهين مثل ffmpeg، ذروة RSS للعامل في هذه المهمة)
+    ru_maxrss لا يُستخدم: ذروة طوال عمر العامل لا تعود للصفر بين المهام
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    return [os.getpid(), cpu, peak_rss()]
+
+
+def send_phase(channel, phase, filepath=None):
+    """انتقال مرحلة (phase=None: انتهت المهمة) - القياس يُطرح في العملية الأم"""
+    channel.send('progress', data={'status': 'phase', 'phase': phase, 'usage': usage(), 'filepath': filepath})
+
+
+def postprocessor_hook(channel):
+    def hook(d):
+        phase = postprocessor_phase(d.get('postprocessor'))
+        if d.get('status') == 'started' and phase:
+            send_phase(channel, phase, (d.get('info_dict') or {}).get('filepath'))
+
+    return hook
+
+
+def progress_hook(channel):
+    """hook يرسل التقدم للعملية الأم مع تقليل عدد الرسائل"""
+    state = {'sent_at': 0, 'status': None, 'downloading': False}
+
+    def hook(d):
+        if not state['downloading']:
+            # أول تقدم ينهي الاستخراج
+            state['downloading'] = True
+            send_phase(channel, 'downloading')
+        now = time.monotonic()
+        status = d.get('status')
+        if status == state['status'] and now - state['sent_at'] < PROGRESS_INTERVAL:
+            return
+        state['sent_at'] = now
+        state['status'] = status
+        channel.send('progress', data={key: d.get(key) for key in PROGRESS_FIELDS if key in d})
+
+    return hook
+
+
+def requested_files(info):
+    """المسارات النهائية كما سجلها yt-dlp (تشمل عناصر القوائم)"""
+    files = [
+        d['filepath'] for d in info.get('requested_downloads') or []
+        if d.get('filepath')
+    ]
+    for entry in info.get('entries') or []:
+        if entry:
+            files.extend(requested_files(entry))
+    return files
+
+
+def run_extract(task, extractors):
+    """استخراج المعلومات فقط - كائن YoutubeDL يُعاد استخدامه لنفس الإعدادات"""
+    key = json.dumps(task['opts'], sort_keys=True)
+    ydl = extractors.get(key)
+    if ydl is None:
+        if len(extractors) >= EXTRACTOR_CACHE_SIZE:
+            extractors.clear()
+        ydl = extractors[key] = yt_dlp.YoutubeDL(task['opts'])
+    info = ydl.extract_info(task['url'], download=False)
+    return ydl.sanitize_info(info)
+
+
+def iter_playlist_entries(opts, url, start, count):
+    """
+    صفحة من عناصر قائمة تشغيل أو قناة دون استخراج أي فيديو منها
+    process=False يبقي العناصر مولّداً كسولاً: لا تُجلب إلا الصفحات حتى نهاية هذه الصفحة
+    يعيد أولاً وصف القائمة، ثم عنصراً عنصراً فور اكتشافه، ثم سطر الصفحة مع المؤشر التالي
+    """
+    ydl = yt_dlp.YoutubeDL(opts)
+    info = ydl.extract_info(url, download=False, process=False)
+    # روابط القنوات وما شابه تحيل إلى رابط آخر (مثل تبويب /videos)
+    for _ in range(3):
+        if info.get('_type') not in ('url', 'url_transparent'):
+            break
+        info = ydl.extract_info(info['url'], download=False, process=False, ie_key=info.get('ie_key'))
+
+    yield {
+        'type': 'playlist',
+        'id': info.get('id'),
+        'title': info.get('title'),
+        'uploader': info.get('uploader') or info.get('channel'),
+        'extractor': info.get('extractor_key') or info.get('ie_key'),
+    }
+
+    entries = info.get('entries')
+    if entries is None:
+        # رابط فيديو واحد
+        entries = [info]
+    emitted = 0
+    has_more = False
+    # عنصر إضافي واحد فقط لمعرفة هل توجد صفحة تالية
+    for index, entry in enumerate(itertools.islice(entries, start, start + count + 1), start):
+        if index == start + count:
+            has_more = True
+            break
+        entry = entry or {}
+        yield {
+            'type': 'entry',
+            'index': index,
+            'id': entry.get('id'),
+            'title': entry.get('title'),
+            'duration': entry.get('duration'),
+            'url': entry.get('url') or entry.get('webpage_url'),
+        }
+        emitted += 1
+
+    yield {
+        'type': 'page',
+        'count': emitted,
+        'next_cursor': start + count if has_more else None,
+    }
+
+
+def run_entries(task, channel):
+    for item in iter_playlist_entries(task['opts'], task['url'], task['start'], task['count']):
+        channel.send('progress', data=item)
+    return {}
+
+
+def run_download(task, channel, rate_control):
+    """تنزيل كامل مع إرسال التقدم، ويعيد ملخصاً صغيراً بدلاً من info كاملة"""
+    ydl_opts = dict(task['opts'])
+    ydl_opts['progress_hooks'] = [progress_hook(channel)]
+    ydl_opts['postprocessor_hooks'] = [postprocessor_hook(channel)]
+    reset_peak_rss()
+    send_phase(channel, 'extracting')
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        rate_control.attach(task.get('id'), ydl.params)
+        try:
+            info = ydl.extract_info(task['url'], download=True)
+        finally:
+            rate_control.detach()
+            send_phase(channel, None)
+        entries = info.get('entries')
+        return {
+            'id': info.get('id'),
+            'extractor_key': info.get('extractor_key'),
+            'format_id': info.get('format_id'),
+            'title': info.get('title'),
+            'duration': info.get('duration'),
+            'view_count': info.get('view_count'),
+            'filename': ydl.prepare_filename(info),
+            'files': requested_files(info),
+            'entries_count': len(list(entries)) if entries is not None else None,
+        }
+
+
+def read_messages(tasks, rate_control):
+    """خيط قراءة stdin: رسائل التحكم تُطبق فوراً، والمهام تنتظر دورها في tasks"""
+    try:
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            message = json.loads(line)
+            if message.get('kind') == 'rate':
+                rate_control.set(message.get('id'), message.get('ratelimit'))
+            else:
+                tasks.put(message)
+    finally:
+        # العملية الأم أغلقت القناة
+        tasks.put(None)
+
+
+def main():
+    # stdout محجوز للبروتوكول - كل ما يطبعه yt-dlp يذهب إلى stderr
+    channel = Channel(os.fdopen(os.dup(1), 'w', buffering=1))
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    extractors = {}
+    tasks = queue.Queue()
+    rate_control = RateControl()
+    threading.Thread(target=read_messages, args=(tasks, rate_control), daemon=True).start()
+    try:
+        channel.send('ready', pid=os.getpid())
+        for task in iter(tasks.get, None):
+            try:
+                if task['kind'] == 'extract':
+                    result = run_extract(task, extractors)
+                elif task['kind'] == 'download':
+                    result = run_download(task, channel, rate_control)
+                elif task['kind'] == 'entries':
+                    result = run_entries(task, channel)
+                else:
+                    raise ValueError(f"Unknown task kind: {task['kind']}")
+                channel.send('result', data=result)
+            except Exception as e:
+                channel.send('error', error=str(e), error_type=type(e).__name__)
+    except (BrokenPipeError, KeyboardInterrupt):
+        # العملية الأم انتهت - لا أحد ينتظر النتيجة
+        pass
+
+
+if __name__ == '__main__':
+    main()